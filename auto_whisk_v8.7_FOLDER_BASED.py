@@ -11,29 +11,42 @@ Date: 2025-12-23
 
 import sys
 import json
-import requests
-import base64
+import argparse
 import os
 import time
-import re
-import queue
-import random
+import hashlib
+import collections
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from whisk_core import (
+    APP_VERSION, APP_DIR, AUTH_FILE, RATIO_DATA, KARAKTER_FOLDER, MEKAN_FOLDER, STIL_FOLDER,
+    DEFAULT_CONCURRENCY, MAX_CONCURRENCY, DEFAULT_ENGINE, ENGINE_BACKENDS, METRICS_PORT, METRICS,
+    LIBRARY_ROOTS, FOLDER_POLL_INTERVAL, FOLDER_SETTLE_MS,
+    LibraryStore, FolderIndex, library_folders, changed_paths, WhiskClient, fetch_access_token, MediaCache, AccountPool,
+    upload_cached, build_plan, describe_plan, create_engine, JobJournal, TaskScheduler
+)
+
+# Headless mode (whisk_cli) never imports Qt
+if __name__ == '__main__' and '--headless' in sys.argv:
+    from whisk_cli import main as cli_main
+    sys.exit(cli_main([a for a in sys.argv[1:] if a != '--headless']))
 
 from PySide6.QtWidgets import (
-    QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit,
+    QApplication, QWidget, QVBoxLayout, QHBoxLayout, QGridLayout, QLabel, QLineEdit,
     QPushButton, QComboBox, QPlainTextEdit, QMessageBox, QFileDialog,
-    QTableWidget, QTableWidgetItem, QHeaderView, QAbstractItemView,
-    QProgressBar, QGroupBox, QSplitter, QCheckBox, QSpinBox, QFrame
+    QTableView, QStyledItemDelegate, QStyleOptionViewItem, QStyle, QHeaderView, QAbstractItemView,
+    QProgressBar, QGroupBox, QSplitter, QCheckBox, QSpinBox, QFrame, QMenu
+)
+from PySide6.QtGui import (
+    QPixmap, QImage, QImageReader, QColor, QPalette, QDesktopServices, QFont, QIcon, QPainter, QPen
+)
+from PySide6.QtCore import (
+    Qt, Signal, QObject, QSize, QRect, QPointF, QEvent, QThread, QUrl, QTimer, QFileSystemWatcher,
+    QAbstractTableModel, QModelIndex
 )
-from PySide6.QtGui import QPixmap, QColor, QDesktopServices, QFont, QIcon
-from PySide6.QtCore import Qt, Signal, QThread, QUrl, QTimer
 
 # ==================== CONFIGURATION ====================
-APP_VERSION = 'v8.7.0 FOLDER BASED'
-USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-API_AUTH_SESSION = 'https://labs.google/fx/api/auth/session'
-
 def resource_path(relative_path):
     try:
         base_path = sys._MEIPASS
@@ -43,29 +56,19 @@ def resource_path(relative_path):
 
 ICON_FILE = resource_path('icon.ico')
 
-APP_NAME = 'AutoWhisk'
-if sys.platform == 'win32':
-    app_data = os.getenv('APPDATA') or os.path.expanduser('~\\AppData\\Roaming')
-elif sys.platform == 'darwin':
-    app_data = os.path.expanduser('~/Library/Application Support')
-else:
-    app_data = os.path.expanduser('~/.local/share')
-
-APP_DIR = os.path.join(app_data, APP_NAME)
-os.makedirs(APP_DIR, exist_ok=True)
-AUTH_FILE = os.path.join(APP_DIR, 'auth_session.json')
-
-# Folder paths (relative to EXE location)
-BASE_DIR = os.path.dirname(sys.executable if getattr(sys, 'frozen', False) else __file__)
-KARAKTER_FOLDER = os.path.join(BASE_DIR, 'KARAKTER')
-MEKAN_FOLDER = os.path.join(BASE_DIR, 'MEKAN')
-STIL_FOLDER = os.path.join(BASE_DIR, 'STIL')
+# Result thumbnails
+THUMB_SIZE = 180
+THUMB_WORKERS = 2
+THUMB_DIR = os.path.join(APP_DIR, 'thumbs')
+THUMB_MAX_AGE = 30 * 24 * 3600   # seconds before an unused cached thumbnail is deleted
+THUMB_MEMORY = 500               # decoded thumbnails kept for the results view
+ROW_HEIGHT = 100
+UI_TICK_MS = 50   # results buffered by the worker reach the table at most this often
 
-RATIO_DATA = [
-    ('Landscape 16:9', 'IMAGE_ASPECT_RATIO_LANDSCAPE'),
-    ('Portrait 9:16', 'IMAGE_ASPECT_RATIO_PORTRAIT'),
-    ('Square 1:1', 'IMAGE_ASPECT_RATIO_SQUARE')
-]
+# Live dashboard
+DASHBOARD_INTERVAL_MS = 1000   # refresh period, however fast results arrive
+DASHBOARD_WINDOW = 60          # seconds behind the rolling images/min and error rate
+DASHBOARD_HISTORY = 120        # points per chart
 
 # ==================== TRANSLATIONS ====================
 TRANSLATIONS = {
@@ -75,10 +78,16 @@ TRANSLATIONS = {
         'lbl_cookie': 'Cookie (JSON):',
         'placeholder_cookie': 'Paste cookie...',
         'btn_check': 'Check & Save',
+        'btn_add_account': 'Add to Pool',
+        'btn_clear_accounts': 'Clear Pool',
+        'lbl_accounts': 'Accounts: {count}',
+        'alert_account_added': 'Account added to the pool.\nExpires: ',
+        'alert_auth_paused': 'Access token could not be refreshed, generation is paused.\nIt resumes by itself once a token is available (check the cookie).',
         'grp_folders': 'Folder Status',
         'grp_config': 'Configuration',
         'lbl_ratio': 'Aspect Ratio:',
         'lbl_count': 'Image Count:',
+        'lbl_concurrency': 'Concurrency:',
         'lbl_prompts': 'Prompts (one per line):',
         'placeholder_prompts': 'Enter prompts...',
         'btn_import': 'Import TXT',
@@ -90,6 +99,8 @@ TRANSLATIONS = {
         'btn_browse': 'Browse',
         'btn_open': 'Open Folder',
         'chk_auto_open': 'Auto-open when done',
+        'chk_group_refs': 'Group by references',
+        'tip_group_refs': 'Run prompts that use the same KARAKTER/MEKAN/STIL files together;\nreferences are uploaded when their group starts instead of all up front',
         'alert_no_prompts': 'Enter at least one prompt!',
         'alert_no_token': 'Check and save cookie first!',
         'alert_cookie_valid': 'Token OK!\nExpires: ',
@@ -97,7 +108,19 @@ TRANSLATIONS = {
         'status_idle': 'Ready',
         'status_running': 'Running...',
         'status_done': '✓ Done',
-        'status_error': '✗ Error'
+        'status_error': '✗ Error',
+        'alert_resume': 'An unfinished batch was found ({missing} of {total} images missing).\nResume it?',
+        'grp_dashboard': 'Live Statistics',
+        'dash_rate': 'Images/min',
+        'dash_in_flight': 'In flight',
+        'dash_queue': 'Queue',
+        'dash_queue_value': '{queued} queued, {waiting} waiting',
+        'dash_upload': 'Upload p50/p95',
+        'dash_generate': 'Generation p50/p95',
+        'dash_errors': 'HTTP errors',
+        'dash_eta': 'Remaining',
+        'dash_error_rate': 'Error rate %',
+        'menu_run_next': '⏫ Run next'
     },
     'tr': {
         'window_title': f'Auto Whisk {APP_VERSION}',
@@ -105,10 +128,16 @@ TRANSLATIONS = {
         'lbl_cookie': 'Cookie (JSON):',
         'placeholder_cookie': 'Cookie yapıştır...',
         'btn_check': 'Kontrol Et',
+        'btn_add_account': 'Havuza Ekle',
+        'btn_clear_accounts': 'Havuzu Temizle',
+        'lbl_accounts': 'Hesaplar: {count}',
+        'alert_account_added': 'Hesap havuza eklendi.\n',
+        'alert_auth_paused': 'Token yenilenemedi, üretim duraklatıldı.\nToken alınınca kendiliğinden devam eder (cookie kontrol et).',
         'grp_folders': 'Klasör Durumu',
         'grp_config': 'Yapılandırma',
         'lbl_ratio': 'Oran:',
         'lbl_count': 'Sayı:',
+        'lbl_concurrency': 'Paralel:',
         'lbl_prompts': 'Promptlar:',
         'placeholder_prompts': 'Prompt gir...',
         'btn_import': 'TXT Al',
@@ -120,6 +149,8 @@ TRANSLATIONS = {
         'btn_browse': 'Gözat',
         'btn_open': 'Klasör Aç',
         'chk_auto_open': 'Bitince otomatik aç',
+        'chk_group_refs': 'Referansa göre grupla',
+        'tip_group_refs': 'Aynı KARAKTER/MEKAN/STIL dosyalarını kullanan promptlar birlikte çalışır;\nreferanslar en başta değil, grubu başlarken yüklenir',
         'alert_no_prompts': 'Prompt gir!',
         'alert_no_token': 'Cookie kaydet!',
         'alert_cookie_valid': 'Token OK!\n',
@@ -127,7 +158,19 @@ TRANSLATIONS = {
         'status_idle': 'Hazır',
         'status_running': 'Çalışıyor',
         'status_done': '✓ Tamam',
-        'status_error': '✗ Hata'
+        'status_error': '✗ Hata',
+        'alert_resume': 'Yarım kalan bir iş bulundu ({missing}/{total} görsel eksik).\nDevam edilsin mi?',
+        'grp_dashboard': 'Canlı İstatistik',
+        'dash_rate': 'Görsel/dk',
+        'dash_in_flight': 'İstekte',
+        'dash_queue': 'Kuyruk',
+        'dash_queue_value': '{queued} sırada, {waiting} bekliyor',
+        'dash_upload': 'Yükleme p50/p95',
+        'dash_generate': 'Üretim p50/p95',
+        'dash_errors': 'HTTP hataları',
+        'dash_eta': 'Kalan süre',
+        'dash_error_rate': 'Hata oranı %',
+        'menu_run_next': '⏫ Öne al'
     }
 }
 
@@ -139,219 +182,11 @@ QLineEdit, QPlainTextEdit, QComboBox { border: 1px solid #ccc; border-radius: 4p
 QLineEdit:focus, QPlainTextEdit:focus { border: 1px solid #3498db; }
 QPushButton { border-radius: 5px; padding: 6px 12px; font-weight: bold; color: white; }
 QPushButton:disabled { background: #bdc3c7 !important; color: #7f8c8d !important; }
-QTableWidget { background: white; border: 1px solid #e0e0e0; border-radius: 4px; gridline-color: #f0f0f0; }
+QTableView { background: white; border: 1px solid #e0e0e0; border-radius: 4px; gridline-color: #f0f0f0; }
 QHeaderView::section { background: #ecf0f1; padding: 6px; border: none; border-bottom: 2px solid #dcdcdc; font-weight: bold; }
 '''
 
 
-# ==================== FOLDER MANAGEMENT ====================
-
-def normalize_turkish(text):
-    """Normalize Turkish characters and lowercase"""
-    replacements = {
-        'ı': 'i', 'İ': 'i', 'I': 'i',
-        'ş': 's', 'Ş': 's',
-        'ğ': 'g', 'Ğ': 'g',
-        'ü': 'u', 'Ü': 'u',
-        'ö': 'o', 'Ö': 'o',
-        'ç': 'c', 'Ç': 'c'
-    }
-    for old, new in replacements.items():
-        text = text.replace(old, new)
-    return text.lower()
-
-def get_file_base_name(filename):
-    """
-    Extract clean name from filename
-    'Kırmızı_Şapkalı_Kedi.jpg' → 'kirmizi sapkali kedi'
-    """
-    name = os.path.splitext(filename)[0]  # Remove extension
-    name = name.replace('_', ' ')  # Underscores to spaces
-    name = normalize_turkish(name)
-    return name.strip()
-
-def scan_folder(folder_path):
-    """
-    Scan folder for image files
-    Returns: list of (filename, base_name) tuples
-    """
-    if not os.path.exists(folder_path):
-        return []
-    
-    files = []
-    for filename in os.listdir(folder_path):
-        if filename.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')):
-            base_name = get_file_base_name(filename)
-            files.append((filename, base_name))
-    
-    return files
-
-def is_exact_match(file_base_name, prompt):
-    """
-    Check if file base name EXACTLY matches in prompt
-    Uses word boundaries and Turkish suffixes
-    
-    Examples:
-        file: "ahmet", prompt: "ahmet parkta" → TRUE
-        file: "ahmet", prompt: "ahmetin arabası" → TRUE (suffix)
-        file: "park", prompt: "otopark" → FALSE (word boundary)
-    """
-    prompt_norm = normalize_turkish(prompt)
-    file_norm = file_base_name  # Already normalized
-    
-    # Exact match
-    if file_norm in prompt_norm:
-        # Check word boundaries
-        pattern = r'\b' + re.escape(file_norm) + r'\b'
-        if re.search(pattern, prompt_norm):
-            return True
-    
-    # Check Turkish suffixes (possessive, locative, etc.)
-    suffixes = [
-        'in', 'nin', 'un', 'nun', 'ın', 'nın', 'ün', 'nün',  # Possessive
-        'da', 'de', 'ta', 'te', 'nda', 'nde',  # Locative
-        'a', 'e', 'na', 'ne', 'ya', 'ye',  # Dative
-        'i', 'ı', 'u', 'ü', 'ni', 'nı', 'nu', 'nü',  # Accusative
-        'dan', 'den', 'tan', 'ten', 'ndan', 'nden'  # Ablative
-    ]
-    
-    for suffix in suffixes:
-        pattern = r'\b' + re.escape(file_norm) + suffix + r'\b'
-        if re.search(pattern, prompt_norm):
-            return True
-    
-    return False
-
-def match_files_in_folder(folder_files, prompt):
-    """
-    Match files from folder against prompt
-    Returns: list of matching filenames
-    """
-    matches = []
-    
-    for filename, base_name in folder_files:
-        if is_exact_match(base_name, prompt):
-            matches.append(filename)
-            print(f"[MATCH] '{base_name}' → {filename}")
-    
-    return matches
-
-# ==================== API UTILITIES ====================
-
-def parse_cookie_input(raw):
-    """Parse various cookie formats"""
-    raw = raw.strip()
-    if not raw:
-        return ''
-    
-    # JSON format
-    if raw.startswith('[') or raw.startswith('{'):
-        try:
-            data = json.loads(raw)
-            if isinstance(data, dict):
-                data = [data]
-            cookies = [f"{c['name']}={c['value']}" for c in data if 'name' in c and 'value' in c]
-            if cookies:
-                return '; '.join(cookies)
-        except:
-            pass
-    
-    # JWT token
-    if raw.startswith('ey'):
-        return f'__Secure-next-auth.session-token={raw}'
-    
-    return raw
-
-def upload_image_to_google(file_path, category, cookie_str, token):
-    """
-    Upload image to Google Labs
-    Returns: (media_id, caption, error)
-    """
-    if not os.path.exists(file_path):
-        return (None, '', 'File not found')
-    
-    try:
-        # Read and encode
-        with open(file_path, 'rb') as f:
-            b64 = base64.b64encode(f.read()).decode('utf-8')
-        
-        # Detect MIME
-        ext = os.path.splitext(file_path)[1].lower()
-        if '.png' in ext:
-            mime = 'image/png'
-        elif '.webp' in ext:
-            mime = 'image/webp'
-        else:
-            mime = 'image/jpeg'
-        
-        data_uri = f'data:{mime};base64,{b64}'
-        sess_id = f';{int(datetime.now().timestamp() * 1000)}'
-        
-        headers = {
-            'Authorization': f'Bearer {token}',
-            'Content-Type': 'application/json',
-            'User-Agent': USER_AGENT,
-            'Origin': 'https://labs.google',
-            'Referer': 'https://labs.google/fx/tools/whisk',
-            'Cookie': parse_cookie_input(cookie_str)
-        }
-        
-        # Get caption
-        caption = ''
-        try:
-            r = requests.post(
-                'https://labs.google/fx/api/trpc/backbone.captionImage',
-                headers=headers,
-                json={
-                    'json': {
-                        'clientContext': {'workflowId': '', 'sessionId': sess_id},
-                        'captionInput': {
-                            'candidatesCount': 1,
-                            'mediaInput': {
-                                'mediaCategory': category,
-                                'rawBytes': data_uri
-                            }
-                        }
-                    }
-                },
-                timeout=40
-            )
-            if r.status_code == 200:
-                cands = r.json().get('result', {}).get('data', {}).get('json', {}).get('result', {}).get('candidates', [])
-                if cands:
-                    caption = cands[0].get('output', '')
-        except:
-            pass
-        
-        # Upload
-        r = requests.post(
-            'https://labs.google/fx/api/trpc/backbone.uploadImage',
-            headers=headers,
-            json={
-                'json': {
-                    'clientContext': {'workflowId': '', 'sessionId': sess_id},
-                    'uploadMediaInput': {
-                        'mediaCategory': category,
-                        'rawBytes': data_uri
-                    }
-                }
-            },
-            timeout=60
-        )
-        
-        if r.status_code != 200:
-            return (None, '', f'HTTP {r.status_code}')
-        
-        mid = r.json().get('result', {}).get('data', {}).get('json', {}).get('result', {}).get('uploadMediaGenerationId')
-        if mid:
-            return (mid, caption, None)
-        
-        return (None, '', 'No media ID')
-        
-    except Exception as e:
-        return (None, '', str(e))
-
-
 # ==================== WORKERS ====================
 
 class CookieValidatorWorker(QThread):
@@ -361,360 +196,675 @@ class CookieValidatorWorker(QThread):
     def __init__(self, cookie_str):
         super().__init__()
         self.cookie_str = cookie_str
+        self.client = WhiskClient(cookie_str)
+    
+    def run(self):
+        token, exp = fetch_access_token(self.client)
+        self.result.emit(bool(token), token, exp)
+
+
+class BackgroundTask(QThread):
+    """Run fn(*args) off the GUI thread; `done` delivers the result (None if it raised)"""
+    done = Signal(object)
+    
+    def __init__(self, fn, *args):
+        super().__init__()
+        self.fn = fn
+        self.args = args
     
     def run(self):
         try:
-            headers = {
-                'Cookie': parse_cookie_input(self.cookie_str),
-                'User-Agent': USER_AGENT
-            }
-            
-            r = requests.get(API_AUTH_SESSION, headers=headers, timeout=20)
-            
-            if r.status_code != 200:
-                self.result.emit(False, '', 0)
-                return
-            
-            token = r.json().get('access_token') or r.json().get('accessToken')
-            if not token:
-                self.result.emit(False, '', 0)
-                return
-            
-            # Get expiry
-            try:
-                ri = requests.get(f'https://www.googleapis.com/oauth2/v3/tokeninfo?access_token={token}', timeout=10)
-                exp = int(ri.json().get('exp', 0)) if ri.status_code == 200 else 0
-                self.result.emit(True, token, exp)
-            except:
-                self.result.emit(True, token, 0)
-                
-        except:
-            self.result.emit(False, '', 0)
+            result = self.fn(*self.args)
+        except Exception as e:
+            print(f"[TASK] {getattr(self.fn, '__name__', 'task')}: {e}")
+            result = None
+        self.done.emit(result)
 
 
 class GenerationWorker(QThread):
     """
-    FOLDER-BASED GENERATION WORKER
-    - Scans folders for matches per prompt
-    - No manual upload needed
-    - Guarantees no character mixing
+    Runs a generation engine on this thread. With the async backend the
+    asyncio loop lives here.
+    - Per-image callbacks (started/success/failed) are appended to a deque
+      (atomic, no lock, no Qt event per image); a GUI-thread timer drains
+      it every UI_TICK_MS and emits them as one `events` batch
+    - all_done / auth_* stay plain queued signals
     """
-    task_started = Signal(int, str)
-    task_success = Signal(int, int, str)
-    task_failed = Signal(int, int, str)
+    events = Signal(list)   # [('started', row, text) | ('success', row, col, path) | ('failed', row, col, error)]
     all_done = Signal()
+    auth_paused = Signal(str)
+    auth_resumed = Signal()
     
     def __init__(self, task_queue, settings, output_dir, num_images, 
                  karakter_files, mekan_files, stil_file, stil_media_id,
-                 cookie_str, token):
+                 cookie_str, token, concurrency=DEFAULT_CONCURRENCY, media_cache=None,
+                 plans=None, client=None, backend=DEFAULT_ENGINE, journal=None, stil_files=None,
+                 accounts=None, locality=False):
         super().__init__()
-        self.task_queue = task_queue
-        self.settings = settings
-        self.output_dir = output_dir
-        self.num_images = num_images
-        self.karakter_files = karakter_files
-        self.mekan_files = mekan_files
-        self.stil_file = stil_file
-        self.stil_media_id = stil_media_id
-        self.cookie_str = cookie_str
-        self.token = token
-        self.running = True
-        self.paused = False
-        
-        # Cache for uploaded media IDs
-        self.media_cache = {}
+        self.engine = create_engine(
+            backend, task_queue, settings, output_dir, num_images,
+            karakter_files, mekan_files, stil_file, stil_media_id,
+            cookie_str, token, concurrency, media_cache=media_cache, plans=plans,
+            client=client, journal=journal, stil_files=stil_files, accounts=accounts,
+            locality=locality
+        )
+        self.buffer = collections.deque()
+        self.engine.on_task_started = lambda row, text: self.buffer.append(('started', row, text))
+        self.engine.on_task_success = lambda row, col, path: self.buffer.append(('success', row, col, path))
+        self.engine.on_task_failed = lambda row, col, error: self.buffer.append(('failed', row, col, error))
+        self.engine.on_all_done = self.all_done.emit
+        self.engine.on_auth_paused = self.auth_paused.emit
+        self.engine.on_auth_resumed = self.auth_resumed.emit
+        
+        self.tick = QTimer(self)   # lives on the GUI thread, like this QThread object
+        self.tick.setInterval(UI_TICK_MS)
+        self.tick.timeout.connect(self.flush)
     
-    def upload_if_needed(self, file_path, category):
-        """Upload file if not cached, return media_id"""
-        if file_path in self.media_cache:
-            return self.media_cache[file_path]
-        
-        mid, cap, err = upload_image_to_google(file_path, category, self.cookie_str, self.token)
-        
-        if mid:
-            self.media_cache[file_path] = mid
-            print(f"[UPLOAD] {os.path.basename(file_path)} → {mid[:12]}...")
-            return mid
-        else:
-            raise Exception(f"Upload failed: {err}")
+    def start(self):
+        super().start()
+        self.tick.start()
+    
+    def flush(self):
+        """GUI thread: emit everything buffered so far as one batch"""
+        batch = []
+        while self.buffer:
+            batch.append(self.buffer.popleft())
+        if batch:
+            self.events.emit(batch)
+    
+    def finish(self):
+        """Engine is done: stop the tick and deliver what is left"""
+        self.tick.stop()
+        self.flush()
     
     def run(self):
-        while self.running:
-            while self.paused and self.running:
-                time.sleep(0.5)
-            
-            try:
-                item = self.task_queue.get(timeout=1)
-                row_idx, prompt = item if len(item) == 2 else (item[0], item[1])
-                indices = range(self.num_images) if len(item) == 2 else item[2]
-            except queue.Empty:
-                continue
-            
-            print(f"\n{'='*60}")
-            print(f"[PROMPT {row_idx+1}] {prompt[:50]}...")
-            
-            # === MATCH FILES FOR THIS PROMPT ===
-            karakter_matches = match_files_in_folder(self.karakter_files, prompt)
-            mekan_matches = match_files_in_folder(self.mekan_files, prompt)
-            
-            # Limit to 1 scene
-            if len(mekan_matches) > 1:
-                print(f"[INFO] Multiple scenes matched, using first: {mekan_matches[0]}")
-                mekan_matches = mekan_matches[:1]
-            
-            if not karakter_matches:
-                print("[INFO] No character matches")
-            if not mekan_matches:
-                print("[INFO] No scene matches")
-            
-            # === PREPARE REFERENCES ===
-            refs = []
-            
-            try:
-                # Characters
-                for filename in karakter_matches:
-                    file_path = os.path.join(KARAKTER_FOLDER, filename)
-                    mid = self.upload_if_needed(file_path, 'MEDIA_CATEGORY_SUBJECT')
-                    refs.append({
-                        'caption': get_file_base_name(filename),
-                        'mediaInput': {
-                            'mediaCategory': 'MEDIA_CATEGORY_SUBJECT',
-                            'mediaGenerationId': mid
-                        }
-                    })
-                
-                # Scenes
-                for filename in mekan_matches:
-                    file_path = os.path.join(MEKAN_FOLDER, filename)
-                    mid = self.upload_if_needed(file_path, 'MEDIA_CATEGORY_SCENE')
-                    refs.append({
-                        'caption': get_file_base_name(filename),
-                        'mediaInput': {
-                            'mediaCategory': 'MEDIA_CATEGORY_SCENE',
-                            'mediaGenerationId': mid
-                        }
-                    })
-                
-                # Style (always included if exists)
-                if self.stil_media_id:
-                    refs.append({
-                        'caption': get_file_base_name(self.stil_file) if self.stil_file else '',
-                        'mediaInput': {
-                            'mediaCategory': 'MEDIA_CATEGORY_STYLE',
-                            'mediaGenerationId': self.stil_media_id
-                        }
-                    })
-                    print(f"[INFO] Style: {self.stil_file}")
-                
-            except Exception as e:
-                print(f"[ERROR] Reference preparation: {str(e)}")
-                self.task_failed.emit(row_idx, 0, str(e)[:30])
-                self.task_queue.task_done()
-                continue
-            
-            print(f"[REFS] Total: {len(refs)} references prepared")
-            print(f"{'='*60}\n")
-            
-            # === GENERATE IMAGES ===
-            for i in indices:
-                if not self.running:
-                    break
-                
-                while self.paused and self.running:
-                    time.sleep(0.5)
-                
-                col_idx = i + 1
-                self.task_started.emit(row_idx, f'{i+1}/{self.num_images}')
-                
-                try:
-                    sess_id = f';{int(datetime.now().timestamp() * 1000)}'
-                    
-                    headers = {
-                        'Authorization': f'Bearer {self.token}',
-                        'Content-Type': 'application/json',
-                        'User-Agent': USER_AGENT,
-                        'Origin': 'https://labs.google',
-                        'Referer': 'https://labs.google/fx/tools/whisk',
-                        'Cookie': parse_cookie_input(self.cookie_str)
-                    }
-                    
-                    seed = random.randint(1, 2147483647)
-                    
-                    if refs:
-                        url = 'https://aisandbox-pa.googleapis.com/v1/whisk:runImageRecipe'
-                        settings = self.settings.copy()
-                        settings['imageModel'] = 'GEM_PIX' if len(refs) == 1 else 'R2I'
-                        
-                        payload = {
-                            'clientContext': {'workflowId': '', 'tool': 'BACKBONE', 'sessionId': sess_id},
-                            'imageModelSettings': settings,
-                            'userInstruction': prompt,
-                            'recipeMediaInputs': refs,
-                            'seed': seed
-                        }
-                    else:
-                        url = 'https://aisandbox-pa.googleapis.com/v1/whisk:generateImage'
-                        
-                        payload = {
-                            'clientContext': {'workflowId': '', 'tool': 'BACKBONE', 'sessionId': sess_id},
-                            'imageModelSettings': self.settings,
-                            'prompt': prompt,
-                            'mediaCategory': 'MEDIA_CATEGORY_BOARD',
-                            'seed': seed
-                        }
-                    
-                    r = requests.post(url, headers=headers, json=payload, timeout=60)
-                    
-                    if not self.running:
-                        self.task_queue.task_done()
-                        break
-                    
-                    if r.status_code == 200:
-                        panels = r.json().get('imagePanels', [])
-                        if panels and panels[0].get('generatedImages'):
-                            b64 = panels[0]['generatedImages'][0].get('encodedImage', '')
-                            
-                            safe_prompt = re.sub(r'[^\w\s-]', '', prompt).strip().replace(' ', '_')[:40]
-                            filename = f"{row_idx+1}_{safe_prompt}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{i+1}.jpg"
-                            filepath = os.path.join(self.output_dir, filename)
-                            
-                            with open(filepath, 'wb') as f:
-                                f.write(base64.b64decode(b64))
-                            
-                            self.task_success.emit(row_idx, col_idx, filepath)
-                        else:
-                            self.task_failed.emit(row_idx, col_idx, 'No image data')
-                    else:
-                        self.task_failed.emit(row_idx, col_idx, f'HTTP {r.status_code}')
-                        
-                except Exception as e:
-                    self.task_failed.emit(row_idx, col_idx, str(e)[:30])
-                
-                time.sleep(2)
-            
-            self.task_queue.task_done()
-            time.sleep(1)
-        
-        self.all_done.emit()
+        self.engine.run()
     
     def stop(self):
-        self.running = False
+        self.engine.stop()
     
     def pause(self):
-        self.paused = True
+        self.engine.pause()
     
     def resume(self):
-        self.paused = False
+        self.engine.resume()
+    
+    def update_references(self, **kwargs):
+        self.engine.update_references(**kwargs)
 
 
-# ==================== CUSTOM WIDGETS ====================
+# ==================== THUMBNAILS ====================
 
-class ImageCellWidget(QWidget):
-    """Display generated image in table cell"""
-    def __init__(self):
+class ThumbnailLoader(QObject):
+    """
+    Decodes and scales result images off the GUI thread
+    - QImageReader decodes straight to thumbnail size (QImage is safe to
+      build on worker threads; QPixmap is created on the GUI thread)
+    - Thumbnails are cached as small JPEGs in THUMB_DIR, keyed by
+      path + mtime + size, so reopening/resuming a batch skips decoding
+    """
+    ready = Signal(str, QImage)
+    
+    def __init__(self, workers=THUMB_WORKERS):
         super().__init__()
-        layout = QVBoxLayout(self)
-        layout.setContentsMargins(2, 2, 2, 2)
-        
-        self.lbl = QLabel()
-        self.lbl.setAlignment(Qt.AlignCenter)
-        self.lbl.setStyleSheet('border: 1px solid #ddd; background: #f9f9f9;')
-        layout.addWidget(self.lbl)
-    
-    def set_image(self, path):
-        pix = QPixmap(path)
-        if not pix.isNull():
-            self.lbl.setPixmap(pix.scaled(180, 180, Qt.KeepAspectRatio, Qt.SmoothTransformation))
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='whisk-thumb')
+        self.waiting = {}   # path → [callback(QPixmap)]
+        self.ready.connect(self.deliver)
+        os.makedirs(THUMB_DIR, exist_ok=True)
+        self.pool.submit(self.prune)
+    
+    def prune(self):
+        now = time.time()
+        for entry in os.scandir(THUMB_DIR):
+            try:
+                if now - entry.stat().st_mtime > THUMB_MAX_AGE:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+    
+    def request(self, path, callback):
+        """callback(QPixmap) runs on the GUI thread once the thumbnail is ready"""
+        if path in self.waiting:
+            self.waiting[path].append(callback)
+            return
+        self.waiting[path] = [callback]
+        self.pool.submit(self.load, path)
+    
+    def cache_path(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = f'{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}|{THUMB_SIZE}'
+        return os.path.join(THUMB_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.jpg')
+    
+    def load(self, path):
+        """Worker thread: cached thumbnail or a scaled decode"""
+        image = QImage()
+        try:
+            cached = self.cache_path(path)
+            if cached and os.path.exists(cached):
+                image = QImage(cached)
+                os.utime(cached)   # keep in-use thumbnails from being pruned
+            METRICS.count('cache_misses' if image.isNull() else 'cache_hits', cache='thumb')
+            if image.isNull():
+                with METRICS.span('thumbnail', file=os.path.basename(path)):
+                    reader = QImageReader(path)
+                    reader.setAutoTransform(True)
+                    size = reader.size()
+                    if size.isValid():
+                        reader.setScaledSize(size.scaled(QSize(THUMB_SIZE, THUMB_SIZE), Qt.KeepAspectRatio))
+                    image = reader.read()
+                    if not image.isNull() and cached:
+                        image.save(cached, 'JPG', 85)
+        except Exception as e:
+            print(f"[THUMB] {os.path.basename(path)}: {e}")
+        self.ready.emit(path, image)
+    
+    def deliver(self, path, image):
+        pix = QPixmap.fromImage(image) if not image.isNull() else QPixmap()
+        for callback in self.waiting.pop(path, []):
+            try:
+                callback(pix)
+            except RuntimeError:
+                pass   # cell was deleted (table rebuilt) before the thumbnail arrived
+    
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+THUMBNAILS = None   # ThumbnailLoader, created with the QApplication
 
 
-class PromptCellWidget(QWidget):
-    """Editable prompt cell"""
-    def __init__(self, text=''):
+# ==================== RESULTS VIEW ====================
+
+class RowState:
+    """One prompt row of the results table"""
+    __slots__ = ('prompt', 'plan', 'status', 'detail', 'error', 'images')
+    
+    def __init__(self, prompt, plan='', count=0):
+        self.prompt = prompt
+        self.plan = plan                  # describe_plan() summary
+        self.status = 'status_idle'       # TRANSLATIONS key
+        self.detail = ''                  # progress / error text (tooltip)
+        self.error = ''                   # last image error, shown once the row settles
+        self.images = [None] * count      # result path per image index
+
+
+class ResultsModel(QAbstractTableModel):
+    """
+    Results table: prompt, one column per image, status
+    - Row state lives in RowState objects, not widgets
+    - Thumbnails are requested only when a cell is painted (visible) and
+      kept in a small LRU
+    """
+    PlanRole = Qt.UserRole + 1
+    StatusRole = Qt.UserRole + 2
+    
+    STATUS_COLORS = {
+        'status_error': '#e74c3c',
+        'status_done': '#27ae60',
+        'status_running': '#3498db'
+    }
+    
+    def __init__(self, count, lang='en'):
         super().__init__()
-        layout = QVBoxLayout(self)
-        layout.setContentsMargins(2, 2, 2, 2)
-        
-        self.txt = QPlainTextEdit()
-        self.txt.setPlainText(text)
-        self.txt.setStyleSheet('border: 1px solid #ddd; font-size: 12px;')
-        layout.addWidget(self.txt)
+        self.count = count
+        self.lang = lang
+        self.rows = []
+        self.thumbs = collections.OrderedDict()   # path → QPixmap
+        self.pending = set()
+        self.cells = {}                           # path → (row, col)
+    
+    # --- Qt model interface ---
+    
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+    
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.count + 2
+    
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Vertical:
+            return str(section + 1)
+        if section == 0:
+            return 'Prompt'
+        return 'Status' if section == self.count + 1 else f'#{section}'
+    
+    def flags(self, index):
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if index.column() == 0:
+            flags |= Qt.ItemIsEditable
+        return flags
+    
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        col = index.column()
+        
+        if col == 0:
+            if role in (Qt.DisplayRole, Qt.EditRole):
+                return row.prompt
+            if role == self.PlanRole:
+                return row.plan
+            if role == Qt.ToolTipRole:
+                return row.prompt + (f'\n{row.plan}' if row.plan else '')
+        elif col == self.count + 1:
+            if role == Qt.DisplayRole:
+                return TRANSLATIONS[self.lang][row.status]
+            if role == self.StatusRole:
+                return row.status
+            if role == Qt.ForegroundRole:
+                return QColor(self.STATUS_COLORS.get(row.status, '#2c3e50'))
+            if role == Qt.ToolTipRole:
+                return row.detail or None
+        else:
+            path = row.images[col - 1] if col - 1 < len(row.images) else None
+            if path and role == Qt.DecorationRole:
+                return self.thumbnail(path)
+            if path and role == Qt.ToolTipRole:
+                return path
+        return None
+    
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole or index.column() != 0:
+            return False
+        self.rows[index.row()].prompt = value.strip()
+        self.dataChanged.emit(index, index)
+        return True
+    
+    # --- Thumbnails ---
+    
+    def thumbnail(self, path):
+        pix = self.thumbs.get(path)
+        if pix is not None:
+            self.thumbs.move_to_end(path)
+            return pix
+        if path not in self.pending:
+            self.pending.add(path)
+            THUMBNAILS.request(path, lambda pix, path=path: self.on_thumbnail(path, pix))
+        return None
+    
+    def on_thumbnail(self, path, pix):
+        self.pending.discard(path)
+        self.thumbs[path] = pix
+        while len(self.thumbs) > THUMB_MEMORY:
+            self.thumbs.popitem(last=False)
+        cell = self.cells.get(path)
+        if cell and cell[0] < len(self.rows):
+            index = self.index(*cell)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole])
+    
+    # --- Updates from the main window ---
+    
+    def set_batch(self, prompts, plans, count):
+        """Replace all rows (plans: describe_plan summaries)"""
+        self.beginResetModel()
+        self.count = count
+        self.rows = [RowState(prompt, plan, count) for prompt, plan in zip(prompts, plans)]
+        self.cells = {}
+        self.endResetModel()
+    
+    def set_count(self, count):
+        self.beginResetModel()
+        self.count = count
+        self.endResetModel()
+    
+    def set_plans(self, plans):
+        for row, plan in zip(self.rows, plans):
+            row.plan = plan
+        if self.rows:
+            self.dataChanged.emit(self.index(0, 0), self.index(len(self.rows) - 1, 0))
+    
+    def set_status(self, row_idx, status, detail=''):
+        row = self.rows[row_idx]
+        row.status = status
+        row.detail = detail
+        index = self.index(row_idx, self.count + 1)
+        self.dataChanged.emit(index, index)
+    
+    def set_image(self, row_idx, image_idx, path):
+        row = self.rows[row_idx]
+        if image_idx >= len(row.images):
+            return
+        row.images[image_idx] = path
+        self.cells[path] = (row_idx, image_idx + 1)
+        index = self.index(row_idx, image_idx + 1)
+        self.dataChanged.emit(index, index)
+
+
+class PromptDelegate(QStyledItemDelegate):
+    """Word-wrapped prompt with the reference plan underneath; edited in a QPlainTextEdit"""
+    
+    def paint(self, painter, option, index):
+        opt = QStyleOptionViewItem(option)
+        self.initStyleOption(opt, index)
+        opt.text = ''
+        widget = option.widget
+        widget.style().drawControl(QStyle.CE_ItemViewItem, opt, painter, widget)
+        
+        painter.save()
+        rect = option.rect.adjusted(6, 4, -6, -4)
+        plan = index.data(ResultsModel.PlanRole)
+        if plan:
+            h = option.fontMetrics.height()
+            painter.setPen(QColor('#7f8c8d'))
+            painter.drawText(QRect(rect.left(), rect.bottom() - h, rect.width(), h), Qt.AlignLeft | Qt.AlignVCenter,
+                             option.fontMetrics.elidedText(plan, Qt.ElideRight, rect.width()))
+            rect.setBottom(rect.bottom() - h - 2)
+        
+        selected = option.state & QStyle.State_Selected
+        painter.setPen(opt.palette.color(QPalette.HighlightedText if selected else QPalette.Text))
+        painter.drawText(rect, Qt.TextWordWrap | Qt.AlignLeft | Qt.AlignTop, index.data() or '')
+        painter.restore()
+    
+    def createEditor(self, parent, option, index):
+        editor = QPlainTextEdit(parent)
+        editor.setStyleSheet('border: 1px solid #3498db; font-size: 12px;')
+        return editor
+    
+    def setEditorData(self, editor, index):
+        editor.setPlainText(index.data(Qt.EditRole))
+    
+    def setModelData(self, editor, model, index):
+        model.setData(index, editor.toPlainText())
+
+
+class ImageDelegate(QStyledItemDelegate):
+    """Framed thumbnail, scaled to the cell (scaled copies are cached per cell size)"""
     
-    def get_text(self):
-        return self.txt.toPlainText().strip()
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.scaled = collections.OrderedDict()   # (pixmap cacheKey, width, height) → QPixmap
+    
+    def fit(self, pix, size):
+        key = (pix.cacheKey(), size.width(), size.height())
+        scaled = self.scaled.get(key)
+        if scaled is None:
+            scaled = self.scaled[key] = pix.scaled(size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            while len(self.scaled) > THUMB_MEMORY:
+                self.scaled.popitem(last=False)
+        else:
+            self.scaled.move_to_end(key)
+        return scaled
+    
+    def paint(self, painter, option, index):
+        widget = option.widget
+        widget.style().drawPrimitive(QStyle.PE_PanelItemViewItem, option, painter, widget)
+        
+        painter.save()
+        rect = option.rect.adjusted(2, 2, -2, -2)
+        painter.fillRect(rect, QColor('#f9f9f9'))
+        painter.setPen(QColor('#ddd'))
+        painter.drawRect(rect.adjusted(0, 0, -1, -1))
+        
+        pix = index.data(Qt.DecorationRole)
+        if pix is not None and not pix.isNull():
+            pix = self.fit(pix, rect.size() - QSize(2, 2))
+            painter.drawPixmap(rect.x() + (rect.width() - pix.width()) // 2,
+                               rect.y() + (rect.height() - pix.height()) // 2, pix)
+        painter.restore()
 
 
-class StatusCellWidget(QWidget):
-    """Status cell with retry/folder buttons"""
+class StatusDelegate(QStyledItemDelegate):
+    """Status text with retry (error) / open-folder (done) buttons drawn in the cell"""
     retry_requested = Signal(int)
     open_folder_requested = Signal(int)
     
-    def __init__(self, row_idx, lang='en'):
-        super().__init__()
-        self.row_idx = row_idx
-        self.lang = lang
-        
-        layout = QVBoxLayout(self)
-        layout.setContentsMargins(2, 2, 2, 2)
-        layout.setSpacing(4)
-        
-        self.lbl = QLabel(TRANSLATIONS[lang]['status_idle'])
-        self.lbl.setAlignment(Qt.AlignCenter)
-        self.lbl.setStyleSheet('font-weight: bold; padding: 4px;')
-        layout.addWidget(self.lbl)
-        
-        btn_layout = QHBoxLayout()
+    BUTTONS = {
+        'retry': ('🔄', '#3498db'),
+        'folder': ('📁', '#2ecc71')
+    }
+    
+    def buttons(self, option, index):
+        """Returns: [(action, QRect)] for the cell's visible buttons"""
+        status = index.data(ResultsModel.StatusRole)
+        actions = ['retry'] if status == 'status_error' else ['folder'] if status == 'status_done' else []
+        w, h, gap = 30, 25, 4
+        x = option.rect.center().x() - (len(actions) * (w + gap) - gap) // 2
+        y = option.rect.center().y() + 4
+        return [(action, QRect(x + i * (w + gap), y, w, h)) for i, action in enumerate(actions)]
+    
+    def paint(self, painter, option, index):
+        widget = option.widget
+        widget.style().drawPrimitive(QStyle.PE_PanelItemViewItem, option, painter, widget)
+        
+        painter.save()
+        font = QFont(option.font)
+        font.setBold(True)
+        painter.setFont(font)
+        painter.setPen(index.data(Qt.ForegroundRole))
+        text_rect = QRect(option.rect.left(), option.rect.top(), option.rect.width(), option.rect.height() // 2)
+        painter.drawText(text_rect, Qt.AlignHCenter | Qt.AlignBottom, index.data() or '')
+        
+        painter.setRenderHint(painter.RenderHint.Antialiasing)
+        for action, rect in self.buttons(option, index):
+            icon, color = self.BUTTONS[action]
+            painter.setPen(Qt.NoPen)
+            painter.setBrush(QColor(color))
+            painter.drawRoundedRect(rect, 5, 5)
+            painter.setPen(QColor('white'))
+            painter.drawText(rect, Qt.AlignCenter, icon)
+        painter.restore()
+    
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QEvent.MouseButtonRelease:
+            for action, rect in self.buttons(option, index):
+                if rect.contains(event.position().toPoint()):
+                    if action == 'retry':
+                        self.retry_requested.emit(index.row())
+                    else:
+                        self.open_folder_requested.emit(index.row())
+                    return True
+        return super().editorEvent(event, model, option, index)
+
+
+# ==================== DASHBOARD ====================
+
+class Sparkline(QWidget):
+    """Line chart of the last DASHBOARD_HISTORY values (scaled to the largest)"""
+    
+    def __init__(self, color, parent=None):
+        super().__init__(parent)
+        self.color = QColor(color)
+        self.values = collections.deque(maxlen=DASHBOARD_HISTORY)
+        self.setMinimumSize(160, 44)
+    
+    def add(self, value):
+        self.values.append(value)
+        self.update()
+    
+    def clear(self):
+        self.values.clear()
+        self.update()
+    
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        rect = self.rect().adjusted(0, 0, -1, -1)
+        painter.fillRect(rect, QColor('#fafafa'))
+        painter.setPen(QColor('#e0e0e0'))
+        painter.drawRect(rect)
+        if len(self.values) < 2:
+            return
         
-        self.btn_retry = QPushButton('🔄')
-        self.btn_retry.setFixedSize(30, 25)
-        self.btn_retry.setStyleSheet('background: #3498db;')
-        self.btn_retry.clicked.connect(lambda: self.retry_requested.emit(self.row_idx))
-        self.btn_retry.setVisible(False)
-        
-        self.btn_folder = QPushButton('📁')
-        self.btn_folder.setFixedSize(30, 25)
-        self.btn_folder.setStyleSheet('background: #2ecc71;')
-        self.btn_folder.clicked.connect(lambda: self.open_folder_requested.emit(self.row_idx))
-        self.btn_folder.setVisible(False)
-        
-        btn_layout.addWidget(self.btn_retry)
-        btn_layout.addWidget(self.btn_folder)
-        layout.addLayout(btn_layout)
-    
-    def set_status(self, key):
-        self.lbl.setText(TRANSLATIONS[self.lang][key])
-        
-        if key == 'status_error':
-            self.lbl.setStyleSheet('color: #e74c3c; font-weight: bold; padding: 4px;')
-            self.btn_retry.setVisible(True)
-        elif key == 'status_done':
-            self.lbl.setStyleSheet('color: #27ae60; font-weight: bold; padding: 4px;')
-            self.btn_folder.setVisible(True)
-        elif key == 'status_running':
-            self.lbl.setStyleSheet('color: #3498db; font-weight: bold; padding: 4px;')
+        top = max(max(self.values), 1e-9)
+        step = rect.width() / (DASHBOARD_HISTORY - 1)
+        left = rect.right() - step * (len(self.values) - 1)
+        height = rect.height() - 14
+        points = [QPointF(left + i * step, rect.bottom() - 2 - value / top * height)
+                  for i, value in enumerate(self.values)]
+        painter.setPen(QPen(self.color, 1.5))
+        painter.drawPolyline(points)
+        painter.setPen(QColor('#7f8c8d'))
+        painter.drawText(rect.adjusted(4, 0, 0, 0), Qt.AlignLeft | Qt.AlignTop, f'{top:.3g}')
+
+
+class DashboardPanel(QGroupBox):
+    """
+    Live batch statistics from the engine's counters and METRICS
+    - Polled on a DASHBOARD_INTERVAL_MS timer, never per result signal
+    - Rolling images/min and error rate over DASHBOARD_WINDOW seconds
+    """
+    
+    FIELDS = ('dash_rate', 'dash_in_flight', 'dash_queue', 'dash_upload', 'dash_generate',
+              'dash_errors', 'dash_eta')
+    
+    def __init__(self, lang, parent=None):
+        super().__init__(TRANSLATIONS[lang]['grp_dashboard'], parent)
+        self.lang = lang
+        self.engine = None
+        self.total = 0
+        self.samples = collections.deque()   # (time, done, responses, errors)
+        self.base = {}                       # METRICS response counts at batch start
+        
+        layout = QHBoxLayout(self)
+        grid = QGridLayout()
+        grid.setVerticalSpacing(2)
+        self.values = {}
+        for i, key in enumerate(self.FIELDS):
+            name = QLabel(TRANSLATIONS[lang][key] + ':')
+            name.setStyleSheet('color: #7f8c8d;')
+            self.values[key] = QLabel('–')
+            self.values[key].setStyleSheet('font-weight: bold;')
+            grid.addWidget(name, i // 2, (i % 2) * 2)
+            grid.addWidget(self.values[key], i // 2, (i % 2) * 2 + 1)
+        self.notice = QLabel()   # engine-side pauses (no modal dialog mid-batch)
+        self.notice.setStyleSheet('color: #e74c3c; font-weight: bold;')
+        self.notice.setWordWrap(True)
+        self.notice.setVisible(False)
+        grid.addWidget(self.notice, len(self.FIELDS) // 2 + 1, 0, 1, 4)
+        layout.addLayout(grid, 2)
+        
+        self.rate_chart = Sparkline('#27ae60')
+        self.error_chart = Sparkline('#e74c3c')
+        for key, chart in (('dash_rate', self.rate_chart), ('dash_error_rate', self.error_chart)):
+            box = QVBoxLayout()
+            box.setSpacing(2)
+            box.addWidget(QLabel(TRANSLATIONS[lang][key]))
+            box.addWidget(chart, 1)
+            layout.addLayout(box, 1)
+        self.setMaximumHeight(160)
+        
+        self.timer = QTimer(self)
+        self.timer.setInterval(DASHBOARD_INTERVAL_MS)
+        self.timer.timeout.connect(self.refresh)
+    
+    def start(self, engine, total):
+        """Follow a new batch of `total` images"""
+        self.engine = engine
+        self.total = total
+        self.samples.clear()
+        self.rate_chart.clear()
+        self.error_chart.clear()
+        self.base = METRICS.totals('responses', 'status')
+        self.set_notice('')
+        self.refresh()
+        self.timer.start()
+    
+    def set_notice(self, text):
+        self.notice.setText(text)
+        self.notice.setVisible(bool(text))
+    
+    def stop(self):
+        self.refresh()
+        self.timer.stop()
+    
+    def responses(self):
+        """Returns: {status: count} of this batch's API responses (exception name for network errors)"""
+        totals = METRICS.totals('responses', 'status')
+        return {status: n - self.base.get(status, 0) for status, n in totals.items() if n > self.base.get(status, 0)}
+    
+    def refresh(self):
+        if not self.engine:
+            return
+        stats = self.engine.stats()
+        responses = self.responses()
+        errors = {status: n for status, n in responses.items() if status != 200}
+        now = time.monotonic()
+        
+        self.samples.append((now, stats['done'], sum(responses.values()), sum(errors.values())))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= DASHBOARD_WINDOW:
+            self.samples.popleft()
+        start, done, sent, failed = self.samples[0]
+        elapsed = now - start
+        per_min = (stats['done'] - done) / elapsed * 60 if elapsed > 0 else 0.0
+        requests_in_window = self.samples[-1][2] - sent
+        error_rate = (self.samples[-1][3] - failed) / requests_in_window if requests_in_window else 0.0
+        
+        remaining = max(0, self.total - stats['done'] - stats['failed'])
+        if not remaining:
+            eta = '0:00'
+        elif per_min > 0:
+            seconds = int(remaining / per_min * 60)
+            eta = f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}' if seconds >= 3600 \
+                else f'{seconds // 60}:{seconds % 60:02d}'
         else:
-            self.lbl.setStyleSheet('font-weight: bold; padding: 4px;')
+            eta = '–'
+        
+        tr = TRANSLATIONS[self.lang]
+        self.values['dash_rate'].setText(f'{per_min:.1f}')
+        self.values['dash_in_flight'].setText(str(stats['in_flight']))
+        self.values['dash_queue'].setText(tr['dash_queue_value'].format(
+            queued=stats['queued'], waiting=max(0, stats['pending'] - stats['in_flight'])))
+        self.values['dash_upload'].setText(self.latency('upload'))
+        self.values['dash_generate'].setText(self.latency('generate'))
+        self.values['dash_errors'].setText(
+            '  '.join(f'{status}×{n}' for status, n in sorted(errors.items(), key=lambda e: -e[1])) or '0')
+        self.values['dash_eta'].setText(f'{eta} ({remaining})')
+        
+        self.rate_chart.add(per_min)
+        self.error_chart.add(error_rate * 100)
+    
+    @staticmethod
+    def latency(stage):
+        p50, p95 = METRICS.percentile(stage, 0.5), METRICS.percentile(stage, 0.95)
+        return f'{p50:.1f}s / {p95:.1f}s' if p50 is not None else '–'
 
 
 # ==================== MAIN WINDOW ====================
 
 class MainWindow(QWidget):
-    def __init__(self):
+    def __init__(self, engine_backend=DEFAULT_ENGINE):
         super().__init__()
+        self.engine_backend = engine_backend
         self.current_lang = 'tr'  # Default Turkish
         self.access_token = ''
+        self.token_exp = 0   # expiry of access_token (epoch seconds, 0 = unknown)
         self.cookie_str = ''
+        self.client = None
+        self.accounts = AccountPool.load()   # every account a batch may use
         self.worker = None
-        self.task_queue = queue.Queue()
-        
-        # Folder data
-        self.karakter_files = []
-        self.mekan_files = []
+        self.journal = None
+        self.output_dir = None
+        self.task_queue = None   # TaskScheduler of the running batch
+        
+        # Folder data (live name indexes over every library root)
+        self.library = LibraryStore()
+        self.karakter_index = FolderIndex(library_folders('KARAKTER'), self.library)
+        self.mekan_index = FolderIndex(library_folders('MEKAN'), self.library)
+        self.stil_index = FolderIndex(library_folders('STIL'), self.library, stat_files=True)
+        self.karakter_files = self.karakter_index.matcher
+        self.mekan_files = self.mekan_index.matcher
+        self.stil_files = self.stil_index.matcher
         self.stil_file = None
         self.stil_media_id = None
+        self.media_cache = MediaCache()
+        self.media_cache.hash_memo.update(self.library.hash_memo())
+        self.library.save()
+        self.tasks = set()            # running BackgroundTasks (kept alive until finished)
+        self.refreshing = False       # a folder rescan is running
+        self.refresh_again = False    # watcher fired during it
         
         self.init_ui()
         self.load_auth()
         self.scan_folders()
+        self.init_folder_watcher()
+        
+        # Offer to finish an interrupted batch once the window is up
+        QTimer.singleShot(0, self.offer_resume)
     
     def init_ui(self):
         self.setWindowTitle(TRANSLATIONS[self.current_lang]['window_title'])
@@ -742,6 +892,25 @@ class MainWindow(QWidget):
         cookie_layout.addWidget(self.btn_check)
         
         auth_layout.addLayout(cookie_layout)
+        
+        # Account pool: requests are spread over every validated cookie
+        pool_layout = QHBoxLayout()
+        self.lbl_accounts = QLabel()
+        pool_layout.addWidget(self.lbl_accounts)
+        pool_layout.addStretch()
+        
+        self.btn_add_account = QPushButton(TRANSLATIONS[self.current_lang]['btn_add_account'])
+        self.btn_add_account.setStyleSheet('background: #16a085; min-width: 120px;')
+        self.btn_add_account.clicked.connect(self.add_account)
+        pool_layout.addWidget(self.btn_add_account)
+        
+        self.btn_clear_accounts = QPushButton(TRANSLATIONS[self.current_lang]['btn_clear_accounts'])
+        self.btn_clear_accounts.setStyleSheet('background: #95a5a6; min-width: 120px;')
+        self.btn_clear_accounts.clicked.connect(self.clear_accounts)
+        pool_layout.addWidget(self.btn_clear_accounts)
+        
+        auth_layout.addLayout(pool_layout)
+        self.update_accounts_label()
         main_layout.addWidget(auth_group)
         
         # === FOLDER STATUS GROUP ===
@@ -777,6 +946,16 @@ class MainWindow(QWidget):
         self.spin_count.setValue(4)
         settings_layout.addWidget(self.spin_count)
         
+        settings_layout.addWidget(QLabel(TRANSLATIONS[self.current_lang]['lbl_concurrency']))
+        self.spin_concurrency = QSpinBox()
+        self.spin_concurrency.setRange(1, MAX_CONCURRENCY)
+        self.spin_concurrency.setValue(DEFAULT_CONCURRENCY)
+        settings_layout.addWidget(self.spin_concurrency)
+        
+        self.chk_group_refs = QCheckBox(TRANSLATIONS[self.current_lang]['chk_group_refs'])
+        self.chk_group_refs.setToolTip(TRANSLATIONS[self.current_lang]['tip_group_refs'])
+        settings_layout.addWidget(self.chk_group_refs)
+        
         settings_layout.addStretch()
         config_layout.addLayout(settings_layout)
         
@@ -850,14 +1029,25 @@ class MainWindow(QWidget):
         main_layout.addWidget(config_group)
         
         # === PROGRESS TABLE ===
-        self.table = QTableWidget()
-        self.table.setColumnCount(self.spin_count.value() + 2)
-        self.table.setHorizontalHeaderLabels(['Prompt'] + [f'#{i+1}' for i in range(self.spin_count.value())] + ['Status'])
+        self.results = ResultsModel(self.spin_count.value(), self.current_lang)
+        self.table = QTableView()
+        self.table.setModel(self.results)
         self.table.horizontalHeader().setStretchLastSection(False)
         self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.table.verticalHeader().setDefaultSectionSize(ROW_HEIGHT)
         self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
-        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setEditTriggers(QAbstractItemView.DoubleClicked | QAbstractItemView.EditKeyPressed)
         self.table.setMinimumHeight(250)
+        self.table.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.table.customContextMenuRequested.connect(self.show_table_menu)
+        
+        self.prompt_delegate = PromptDelegate(self.table)
+        self.image_delegate = ImageDelegate(self.table)
+        self.status_delegate = StatusDelegate(self.table)
+        self.status_delegate.retry_requested.connect(self.retry_row)
+        self.status_delegate.open_folder_requested.connect(self.open_output_folder)
+        self.update_table_columns()
         
         main_layout.addWidget(self.table)
         
@@ -865,14 +1055,17 @@ class MainWindow(QWidget):
         self.progress = QProgressBar()
         main_layout.addWidget(self.progress)
         
+        self.dashboard = DashboardPanel(self.current_lang)
+        main_layout.addWidget(self.dashboard)
+        
         # Connect spin count change
         self.spin_count.valueChanged.connect(self.update_table_columns)
     
-    def scan_folders(self):
-        """Scan KARAKTER, MEKAN, STIL folders"""
+    def scan_folders(self, reload_style=True):
+        """Scan KARAKTER, MEKAN, STIL folders (reload_style: re-pick and upload STIL)"""
         # Scan KARAKTER
-        self.karakter_files = scan_folder(KARAKTER_FOLDER)
-        if os.path.exists(KARAKTER_FOLDER):
+        self.karakter_files = self.karakter_index.matcher
+        if self.karakter_index.exists:
             self.lbl_karakter_status.setText(f"✅ KARAKTER/ → {len(self.karakter_files)} files found")
             self.lbl_karakter_status.setStyleSheet('color: #27ae60; font-weight: bold;')
         else:
@@ -880,50 +1073,183 @@ class MainWindow(QWidget):
             self.lbl_karakter_status.setStyleSheet('color: #f39c12; font-weight: bold;')
         
         # Scan MEKAN
-        self.mekan_files = scan_folder(MEKAN_FOLDER)
-        if os.path.exists(MEKAN_FOLDER):
+        self.mekan_files = self.mekan_index.matcher
+        self.stil_files = self.stil_index.matcher
+        if self.mekan_index.exists:
             self.lbl_mekan_status.setText(f"✅ MEKAN/ → {len(self.mekan_files)} files found")
             self.lbl_mekan_status.setStyleSheet('color: #27ae60; font-weight: bold;')
         else:
             self.lbl_mekan_status.setText(f"⚠️ MEKAN/ → Folder not found (will skip)")
             self.lbl_mekan_status.setStyleSheet('color: #f39c12; font-weight: bold;')
         
+        if not reload_style:
+            return
+        
         # Scan STIL
-        stil_files = scan_folder(STIL_FOLDER)
-        if stil_files:
-            self.stil_file = stil_files[0][0]  # First file
-            self.lbl_stil_status.setText(f"✅ STIL/ → {self.stil_file}")
+        self.stil_file = self.stil_index.first()  # Default style; prompts may name others
+        self.stil_media_id = None
+        if self.stil_file:
+            self.lbl_stil_status.setText(f"✅ STIL/ → {self.stil_label()}")
             self.lbl_stil_status.setStyleSheet('color: #27ae60; font-weight: bold;')
             
             # Upload style immediately if we have token
             if self.access_token:
                 self.upload_style()
         else:
-            if os.path.exists(STIL_FOLDER):
+            if self.stil_index.exists:
                 self.lbl_stil_status.setText(f"⚠️ STIL/ → No files (will skip)")
             else:
                 self.lbl_stil_status.setText(f"⚠️ STIL/ → Folder not found (will skip)")
             self.lbl_stil_status.setStyleSheet('color: #f39c12; font-weight: bold;')
     
+    def init_folder_watcher(self):
+        """Watch the reference folders; a burst of events triggers one refresh"""
+        self.folder_watcher = QFileSystemWatcher(self)
+        self.folder_watcher.directoryChanged.connect(lambda path: self.settle_timer.start())
+        
+        self.settle_timer = QTimer(self)
+        self.settle_timer.setSingleShot(True)
+        self.settle_timer.setInterval(FOLDER_SETTLE_MS)
+        self.settle_timer.timeout.connect(self.refresh_folders)
+        
+        # Polling fallback for folders the OS can't watch
+        self.poll_timer = QTimer(self)
+        self.poll_timer.setInterval(int(FOLDER_POLL_INTERVAL * 1000))
+        self.poll_timer.timeout.connect(self.refresh_folders)
+        
+        self.watch_folders()
+    
+    def stil_label(self):
+        others = len(self.stil_index) - 1
+        name = os.path.basename(self.stil_file)
+        return f"{name} (+{others} by name)" if others > 0 else name
+    
+    def watch_folders(self):
+        """(Re)register folders with the watcher; poll if any can't be watched"""
+        indexes = [self.karakter_index, self.mekan_index, self.stil_index]
+        folders = [d for index in indexes for d in index.dirs]
+        watched = set(self.folder_watcher.directories())
+        for folder in LIBRARY_ROOTS + folders:
+            if folder not in watched and os.path.isdir(folder):
+                self.folder_watcher.addPath(folder)
+        
+        watched = set(self.folder_watcher.directories())
+        # Missing category folders are noticed through their root once created
+        missing = [f for index in indexes for f in index.folders if not os.path.isdir(f)]
+        needs_poll = any(f not in watched for f in folders if os.path.isdir(f))
+        needs_poll = needs_poll or any(os.path.dirname(f) not in watched for f in missing)
+        if needs_poll and not self.poll_timer.isActive():
+            print("[WATCH] File notifications unavailable, polling reference folders")
+            self.poll_timer.start()
+        elif not needs_poll:
+            self.poll_timer.stop()
+    
+    def run_background(self, fn, callback, *args):
+        """fn(*args) on a BackgroundTask; callback(result) runs on the GUI thread"""
+        task = BackgroundTask(fn, *args)
+        task.done.connect(callback)
+        task.finished.connect(self.reap_tasks)
+        self.tasks.add(task)
+        task.start()
+    
+    def reap_tasks(self):
+        self.tasks = {task for task in self.tasks if not task.isFinished()}
+    
+    def refresh_folders(self):
+        """Rescan the reference folders off the GUI thread, one scan at a time"""
+        if self.refreshing:
+            self.refresh_again = True
+            return
+        self.refreshing = True
+        self.run_background(self.rescan_indexes, self.apply_folder_changes)
+    
+    def rescan_indexes(self):
+        """Worker thread: walk the folder trees. Returns: (karakter, mekan, stil) changes"""
+        return (self.karakter_index.refresh(), self.mekan_index.refresh(), self.stil_index.refresh())
+    
+    def apply_folder_changes(self, changes):
+        """Apply added/renamed/modified/deleted reference files, also to a running batch"""
+        self.refreshing = False
+        if self.refresh_again:
+            self.refresh_again = False
+            QTimer.singleShot(0, self.refresh_folders)
+        
+        karakter, mekan, stil = changes or (None, None, None)
+        self.watch_folders()
+        if not (karakter or mekan or stil):
+            return
+        
+        changed = changed_paths(karakter) + changed_paths(mekan) + changed_paths(stil)
+        stil_changed = self.stil_index.first() != self.stil_file or self.stil_file in changed
+        
+        self.media_cache.forget(changed)   # before a changed style is re-uploaded
+        self.scan_folders(reload_style=stil_changed)
+        if self.stil_file and not stil_changed:
+            self.lbl_stil_status.setText(f"✅ STIL/ → {self.stil_label()}")
+        
+        if self.worker and self.worker.isRunning():
+            kwargs = {}
+            if not (stil_changed and self.stil_file and self.access_token):
+                kwargs['stil'] = (self.stil_file, self.stil_media_id)   # else sent once uploaded
+            self.worker.update_references(
+                karakter_files=self.karakter_files,
+                mekan_files=self.mekan_files,
+                stil_files=self.stil_files,
+                changed=changed,
+                **kwargs
+            )
+        
+        self.library.save(self.media_cache.hash_memo)
+        self.refresh_plans()
+    
+    def refresh_plans(self):
+        """Re-resolve the reference summary shown under each prompt"""
+        prompts = [row.prompt for row in self.results.rows]
+        if not prompts:
+            return
+        
+        plans = build_plan(prompts, self.karakter_files, self.mekan_files, self.stil_file, self.stil_files)
+        self.results.set_plans([describe_plan(plans[prompt]) for prompt in prompts])
+    
     def upload_style(self):
-        """Upload style file immediately"""
+        """Upload the style file now (in the background)"""
         if not self.stil_file or not self.access_token:
             return
         
-        stil_path = os.path.join(STIL_FOLDER, self.stil_file)
-        print(f"[STYLE] Uploading: {self.stil_file}...")
-        
-        mid, cap, err = upload_image_to_google(stil_path, 'MEDIA_CATEGORY_STYLE', self.cookie_str, self.access_token)
+        print(f"[STYLE] Uploading: {os.path.basename(self.stil_file)}...")
+        self.run_background(self.upload_style_file, self.on_style_uploaded, self.stil_file, self.http_client())
+    
+    def upload_style_file(self, stil_file, client):
+        """Worker thread. Returns: (stil_file, media_id, error)"""
+        mid, cap, err = upload_cached(stil_file, 'MEDIA_CATEGORY_STYLE', client, self.media_cache)
+        return (stil_file, mid, err)
+    
+    def on_style_uploaded(self, result):
+        stil_file, mid, err = result or (self.stil_file, None, 'Upload failed')
+        if stil_file != self.stil_file:
+            return   # the default style changed while uploading
         
         if mid:
             self.stil_media_id = mid
             print(f"[STYLE] ✅ Uploaded: {mid[:12]}...")
-            self.lbl_stil_status.setText(f"✅ STIL/ → {self.stil_file} (uploaded)")
+            self.lbl_stil_status.setText(f"✅ STIL/ → {self.stil_label()} (uploaded)")
         else:
             print(f"[STYLE] ❌ Upload failed: {err}")
             self.lbl_stil_status.setText(f"❌ STIL/ → Upload failed: {err}")
             self.lbl_stil_status.setStyleSheet('color: #e74c3c; font-weight: bold;')
+        
+        if self.worker and self.worker.isRunning():
+            self.worker.update_references(stil=(self.stil_file, self.stil_media_id))
 
+    def http_client(self):
+        """Pooled client for the current cookie/token (rebuilt when they change)"""
+        if self.client is None or self.client.cookie_str != self.cookie_str:
+            if self.client:
+                self.client.close()
+            self.client = WhiskClient(self.cookie_str, self.access_token)
+        elif self.client.token != self.access_token:
+            self.client.set_token(self.access_token)
+        return self.client
     
     def load_auth(self):
         """Load saved authentication"""
@@ -931,8 +1257,11 @@ class MainWindow(QWidget):
             try:
                 with open(AUTH_FILE, 'r') as f:
                     data = json.load(f)
-                    self.txt_cookie.setPlainText(data.get('cookie', ''))
+                    self.cookie_str = data.get('cookie', '')
+                    self.txt_cookie.setPlainText(self.cookie_str)
                     self.access_token = data.get('token', '')
+                    # Saved before expiries were kept: 1 = refresh before first use
+                    self.token_exp = data.get('exp', 1 if self.access_token else 0)
             except:
                 pass
     
@@ -942,11 +1271,51 @@ class MainWindow(QWidget):
             with open(AUTH_FILE, 'w') as f:
                 json.dump({
                     'cookie': self.cookie_str,
-                    'token': self.access_token
+                    'token': self.access_token,
+                    'exp': self.token_exp
                 }, f)
         except:
             pass
     
+    def update_accounts_label(self):
+        self.lbl_accounts.setText(TRANSLATIONS[self.current_lang]['lbl_accounts'].format(count=len(self.accounts)))
+    
+    def add_account(self):
+        """Validate the pasted cookie and add it to the pool (the current account stays)"""
+        cookie_text = self.txt_cookie.toPlainText().strip()
+        
+        if not cookie_text:
+            QMessageBox.warning(self, 'Error', 'Please enter cookie!')
+            return
+        
+        self.btn_add_account.setEnabled(False)
+        self.account_worker = CookieValidatorWorker(cookie_text)
+        self.account_worker.result.connect(self.on_account_checked)
+        self.account_worker.start()
+    
+    def on_account_checked(self, success, token, exp):
+        self.btn_add_account.setEnabled(True)
+        
+        if not success:
+            QMessageBox.critical(self, 'Error', TRANSLATIONS[self.current_lang]['alert_cookie_invalid'])
+            return
+        
+        self.accounts.add(self.account_worker.cookie_str, token, exp)
+        self.accounts.save()
+        self.update_accounts_label()
+        
+        exp_date = datetime.fromtimestamp(exp).strftime('%Y-%m-%d %H:%M') if exp else 'Unknown'
+        QMessageBox.information(self, 'Success',
+            TRANSLATIONS[self.current_lang]['alert_account_added'] + exp_date)
+    
+    def clear_accounts(self):
+        """Drop every pooled account except the current one"""
+        self.accounts = AccountPool([], self.accounts.path)
+        if self.access_token:
+            self.accounts.add(self.cookie_str, self.access_token, self.token_exp, client=self.http_client())
+        self.accounts.save()
+        self.update_accounts_label()
+    
     def check_cookie(self):
         """Validate cookie and get token"""
         cookie_text = self.txt_cookie.toPlainText().strip()
@@ -970,7 +1339,11 @@ class MainWindow(QWidget):
         
         if success:
             self.access_token = token
+            self.token_exp = exp
             self.save_auth()
+            self.accounts.add(self.cookie_str, token, exp, client=self.http_client())
+            self.accounts.save()
+            self.update_accounts_label()
             
             exp_date = datetime.fromtimestamp(exp).strftime('%Y-%m-%d %H:%M') if exp else 'Unknown'
             QMessageBox.information(self, 'Success', 
@@ -1004,8 +1377,34 @@ class MainWindow(QWidget):
     def update_table_columns(self):
         """Update table columns when count changes"""
         count = self.spin_count.value()
-        self.table.setColumnCount(count + 2)
-        self.table.setHorizontalHeaderLabels(['Prompt'] + [f'#{i+1}' for i in range(count)] + ['Status'])
+        if self.results.count != count:
+            self.results.set_count(count)
+        
+        # Delegates are per column, so re-assign them for the new layout
+        for col in range(self.table.model().columnCount()):
+            self.table.setItemDelegateForColumn(col, None)
+        self.table.setItemDelegateForColumn(0, self.prompt_delegate)
+        for col in range(1, count + 1):
+            self.table.setItemDelegateForColumn(col, self.image_delegate)
+        self.table.setItemDelegateForColumn(count + 1, self.status_delegate)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+    
+    def open_output_folder(self, row_idx=None):
+        QDesktopServices.openUrl(QUrl.fromLocalFile(self.output_dir or self.txt_output.text()))
+    
+    def show_table_menu(self, pos):
+        rows = sorted({index.row() for index in self.table.selectionModel().selectedRows()})
+        if not rows or not (self.worker and self.worker.isRunning()):
+            return
+        menu = QMenu(self)
+        menu.addAction(TRANSLATIONS[self.current_lang]['menu_run_next'], lambda: self.bump_rows(rows))
+        menu.exec(self.table.viewport().mapToGlobal(pos))
+    
+    def bump_rows(self, rows):
+        """Queued images of these rows go ahead of the rest of the batch"""
+        bumped = [row for row in rows if self.task_queue.bump(row)]
+        if bumped:
+            print(f"[QUEUE] Run next: {', '.join(f'#{row + 1}' for row in bumped)}")
     
     def start_generation(self):
         """Start image generation"""
@@ -1022,38 +1421,9 @@ class MainWindow(QWidget):
         # Parse prompts
         prompts = [p.strip() for p in prompts_text.split('\n') if p.strip()]
         
-        # Create output folder
         output_dir = self.txt_output.text()
-        os.makedirs(output_dir, exist_ok=True)
-        
-        # Setup table
-        self.table.setRowCount(len(prompts))
         count = self.spin_count.value()
         
-        for row, prompt in enumerate(prompts):
-            # Prompt cell
-            prompt_widget = PromptCellWidget(prompt)
-            self.table.setCellWidget(row, 0, prompt_widget)
-            self.table.setRowHeight(row, 100)
-            
-            # Image cells
-            for col in range(count):
-                cell = ImageCellWidget()
-                self.table.setCellWidget(row, col + 1, cell)
-            
-            # Status cell
-            status_widget = StatusCellWidget(row, self.current_lang)
-            status_widget.retry_requested.connect(self.retry_row)
-            status_widget.open_folder_requested.connect(lambda r=row: QDesktopServices.openUrl(QUrl.fromLocalFile(output_dir)))
-            self.table.setCellWidget(row, count + 1, status_widget)
-            
-            # Queue task
-            self.task_queue.put((row, prompt))
-        
-        # Setup progress
-        self.progress.setMaximum(len(prompts) * count)
-        self.progress.setValue(0)
-        
         # Get model settings
         ratio_idx = self.combo_ratio.currentIndex()
         ratio_api = RATIO_DATA[ratio_idx][1]
@@ -1063,6 +1433,81 @@ class MainWindow(QWidget):
             'imageModel': 'R2I'
         }
         
+        journal = JobJournal.create(prompts, settings, output_dir, count)
+        self.launch_batch(journal)
+    
+    def offer_resume(self):
+        """On startup: offer to finish the newest interrupted batch"""
+        journal = JobJournal.find_unfinished()
+        if not journal:
+            return
+        
+        missing = sum(len(indices) for indices in journal.missing().values())
+        answer = QMessageBox.question(
+            self, 'Resume',
+            TRANSLATIONS[self.current_lang]['alert_resume'].format(missing=missing, total=journal.total)
+        )
+        if answer != QMessageBox.Yes:
+            return
+        
+        # Restore the batch configuration
+        self.txt_prompts.setPlainText('\n'.join(journal.prompts))
+        self.txt_output.setText(journal.output_dir)
+        self.spin_count.setValue(journal.num_images)
+        for idx, (_, api) in enumerate(RATIO_DATA):
+            if api == journal.settings.get('imageAspectRatio'):
+                self.combo_ratio.setCurrentIndex(idx)
+        
+        if not self.access_token:
+            QMessageBox.warning(self, 'Error', TRANSLATIONS[self.current_lang]['alert_no_token'])
+            journal.close()
+            return
+        
+        self.launch_batch(journal)
+    
+    def launch_batch(self, journal):
+        """Build the table from a job journal and queue everything still missing"""
+        prompts = journal.prompts
+        output_dir = journal.output_dir
+        count = journal.num_images
+        settings = journal.settings
+        self.journal = journal
+        
+        # Create output folder
+        os.makedirs(output_dir, exist_ok=True)
+        
+        # Resolve references for the whole batch before any request
+        plans = build_plan(prompts, self.karakter_files, self.mekan_files, self.stil_file, self.stil_files)
+        
+        missing = journal.missing()
+        
+        # Setup table
+        self.output_dir = output_dir
+        self.results.set_batch(prompts, [describe_plan(plans[prompt]) for prompt in prompts], count)
+        self.update_table_columns()
+        
+        # Images finished before an interruption
+        for row, index, path in journal.done_images():
+            self.results.set_image(row, index, path)
+        
+        # Queue tasks (only the missing images when resuming)
+        self.task_queue = TaskScheduler(count)
+        for row, prompt in enumerate(prompts):
+            if row not in missing:
+                self.results.set_status(row, 'status_done')
+            elif len(missing[row]) == count:
+                self.task_queue.put((row, prompt))
+            else:
+                self.task_queue.put((row, prompt, missing[row]))
+        
+        # Setup progress
+        self.progress.setMaximum(len(prompts) * count)
+        self.progress.setValue(len(prompts) * count - sum(len(indices) for indices in missing.values()))
+        
+        # Current account always takes part (shares the style upload's client)
+        self.accounts.add(self.cookie_str, self.access_token, self.token_exp, client=self.http_client())
+        self.update_accounts_label()
+        
         # Start worker
         self.worker = GenerationWorker(
             self.task_queue,
@@ -1074,15 +1519,25 @@ class MainWindow(QWidget):
             self.stil_file,
             self.stil_media_id,
             self.cookie_str,
-            self.access_token
+            self.access_token,
+            self.spin_concurrency.value(),
+            media_cache=self.media_cache,
+            plans=plans,
+            client=self.http_client(),
+            backend=self.engine_backend,
+            journal=journal,
+            stil_files=self.stil_files,
+            accounts=self.accounts,
+            locality=self.chk_group_refs.isChecked()
         )
         
-        self.worker.task_started.connect(self.on_task_started)
-        self.worker.task_success.connect(self.on_task_success)
-        self.worker.task_failed.connect(self.on_task_failed)
+        self.worker.events.connect(self.on_worker_events)
         self.worker.all_done.connect(self.on_all_done)
+        self.worker.auth_paused.connect(self.on_auth_paused)
+        self.worker.auth_resumed.connect(self.on_auth_resumed)
         
         self.worker.start()
+        self.dashboard.start(self.worker.engine, len(prompts) * count)
         
         # Update UI
         self.btn_start.setEnabled(False)
@@ -1119,58 +1574,88 @@ class MainWindow(QWidget):
         self.btn_resume.setVisible(False)
     
     def retry_row(self, row_idx):
-        """Retry failed row"""
-        prompt_widget = self.table.cellWidget(row_idx, 0)
-        if prompt_widget:
-            prompt = prompt_widget.get_text()
-            self.task_queue.put((row_idx, prompt))
+        """Retry the failed images of a row"""
+        if row_idx < len(self.results.rows) and self.worker:
+            prompt = self.results.rows[row_idx].prompt
+            missing = self.worker.engine.progress.missing(row_idx)
+            if not missing:
+                return
+            # Retries go ahead of the images still queued
+            self.task_queue.put((row_idx, prompt, missing), priority=TaskScheduler.RETRY)
             
             # Reset status
-            status_widget = self.table.cellWidget(row_idx, self.spin_count.value() + 1)
-            if status_widget:
-                status_widget.set_status('status_idle')
-    
-    def on_task_started(self, row_idx, progress_text):
-        """Handle task started"""
-        status_widget = self.table.cellWidget(row_idx, self.spin_count.value() + 1)
-        if status_widget:
-            status_widget.lbl.setText(progress_text)
-            status_widget.set_status('status_running')
-    
-    def on_task_success(self, row_idx, col_idx, image_path):
-        """Handle task success"""
-        cell_widget = self.table.cellWidget(row_idx, col_idx)
-        if cell_widget:
-            cell_widget.set_image(image_path)
-        
-        self.progress.setValue(self.progress.value() + 1)
-        
-        # Check if row is done
-        count = self.spin_count.value()
-        all_done = True
-        for c in range(1, count + 1):
-            widget = self.table.cellWidget(row_idx, c)
-            if widget and not widget.lbl.pixmap():
-                all_done = False
-                break
-        
-        if all_done:
-            status_widget = self.table.cellWidget(row_idx, count + 1)
-            if status_widget:
-                status_widget.set_status('status_done')
-    
-    def on_task_failed(self, row_idx, col_idx, error_msg):
-        """Handle task failure"""
-        self.progress.setValue(self.progress.value() + 1)
-        
-        # Set status to error
-        status_widget = self.table.cellWidget(row_idx, self.spin_count.value() + 1)
-        if status_widget:
-            status_widget.lbl.setText(error_msg)
-            status_widget.set_status('status_error')
+            self.results.set_status(row_idx, 'status_idle')
+    
+    def update_row_status(self, row_idx):
+        """Row status from the engine's per-image counts (no cell scan)"""
+        done, failed, pending = self.worker.engine.progress.row(row_idx)
+        if pending:
+            self.results.set_status(row_idx, 'status_running', f'{done}/{self.results.count}')
+        elif failed:
+            self.results.set_status(row_idx, 'status_error', self.results.rows[row_idx].error)
+        elif done >= self.results.count:
+            self.results.set_status(row_idx, 'status_done')
+    
+    def on_worker_events(self, events):
+        """
+        One tick's worth of task events: images and errors are applied in
+        order, then the progress bar and each touched row update once
+        """
+        with METRICS.span('ui', events=len(events)):
+            started = {}    # row → latest progress text
+            settled = {}    # rows with a finished image (ordered)
+            for event in events:
+                kind, row_idx = event[0], event[1]
+                if kind == 'started':
+                    started[row_idx] = event[2]
+                elif kind == 'success':
+                    self.results.set_image(row_idx, event[2] - 1, event[3])
+                    settled[row_idx] = True
+                else:
+                    # Error once the row's other images have settled
+                    self.results.rows[row_idx].error = event[3]
+                    settled[row_idx] = True
+            
+            if settled:
+                self.progress.setValue(self.progress.value() + sum(1 for e in events if e[0] != 'started'))
+            for row_idx, text in started.items():
+                if row_idx not in settled:
+                    self.results.set_status(row_idx, 'status_running', text)
+            for row_idx in settled:
+                self.update_row_status(row_idx)
+    
+    def on_auth_paused(self, message):
+        """Engine paused itself: no account could refresh its token"""
+        print(f"[AUTH] {message}")
+        self.btn_pause.setVisible(False)
+        self.btn_resume.setVisible(True)
+        self.btn_resume.setEnabled(True)
+        self.dashboard.set_notice('⏸ ' + TRANSLATIONS[self.current_lang]['alert_auth_paused'].replace('\n', ' '))
+    
+    def on_auth_resumed(self):
+        self.dashboard.set_notice('')
+        self.btn_pause.setVisible(True)
+        self.btn_pause.setEnabled(True)
+        self.btn_resume.setVisible(False)
+        self.sync_auth()
+    
+    def sync_auth(self):
+        """Keep the saved token in step with refreshes done by the engine"""
+        if self.client and self.client.token and self.client.token != self.access_token:
+            self.access_token = self.client.token
+            account = next((a for a in self.accounts if a.client is self.client), None)
+            self.token_exp = account.exp if account else 0
+            self.save_auth()
     
     def on_all_done(self):
         """Handle all tasks done"""
+        if self.worker:
+            self.worker.finish()
+        if self.journal:
+            self.journal.close()
+        self.dashboard.stop()
+        self.library.save(self.media_cache.hash_memo)
+        self.sync_auth()
         self.btn_start.setEnabled(True)
         self.btn_stop.setEnabled(False)
         self.btn_pause.setEnabled(False)
@@ -1186,20 +1671,34 @@ class MainWindow(QWidget):
 # ==================== MAIN ENTRY POINT ====================
 
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description=f'Auto Whisk {APP_VERSION}')
+    parser.add_argument('--engine', choices=sorted(ENGINE_BACKENDS), default=DEFAULT_ENGINE,
+                        help='generation backend: thread pool or asyncio (needs aiohttp)')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT, metavar='PORT',
+                        help='serve Prometheus metrics on http://127.0.0.1:PORT/metrics')
+    args, qt_args = parser.parse_known_args()
+    
+    app = QApplication(sys.argv[:1] + qt_args)
     app.setStyle('Fusion')
     app.setStyleSheet(STYLE)
     
     if os.path.exists(ICON_FILE):
         app.setWindowIcon(QIcon(ICON_FILE))
     
+    THUMBNAILS = ThumbnailLoader()
+    app.aboutToQuit.connect(THUMBNAILS.close)
+    app.aboutToQuit.connect(METRICS.close)
+    
+    if args.metrics_port:
+        METRICS.serve(args.metrics_port)
+    
     # Create folders if they don't exist
     for folder in [KARAKTER_FOLDER, MEKAN_FOLDER, STIL_FOLDER]:
         if not os.path.exists(folder):
             os.makedirs(folder)
             print(f"[INIT] Created folder: {folder}")
     
-    window = MainWindow()
+    window = MainWindow(args.engine)
     window.show()
     
     sys.exit(app.exec())
@@ -0,0 +1,301 @@
+"""
+Auto Whisk - Throughput Benchmark
+=================================
+Drives the generation engine against the local mock API (whisk_mock.py)
+and reports images/s, p50/p95 image latency, peak RSS and upload bytes,
+so concurrency, caching and I/O changes can be compared offline. Mean
+milliseconds per pipeline stage come from whisk_core.METRICS.
+
+Usage:
+    python whisk_bench.py --prompts 50 --count 4 --concurrency 4 8 16 --engine thread async
+    python whisk_bench.py --latency 2 --throttle-rate 0.05 --warm --json
+
+Each engine/concurrency combination runs in its own process. Peak RSS is
+sampled during the measured batch only (reference fixtures are made in a
+separate process, the --warm run is excluded). Latency is measured per
+image from the journal: request sent → image written.
+"""
+
+import sys
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import itertools
+import threading
+import subprocess
+import contextlib
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+
+import whisk_core
+from whisk_core import (
+    APP_VERSION, RATE_INITIAL, RATE_MAX, UPLOAD_CONCURRENCY, ENGINE_BACKENDS, Image,
+    WhiskClient, fetch_access_token, set_api_base, scan_folder, NameMatcher, MediaCache,
+    AdaptiveRateLimiter, JobJournal, TaskScheduler, METRICS, build_plan, create_engine
+)
+from whisk_mock import add_mock_args
+
+MOCK_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'whisk_mock.py')
+RSS_SAMPLE_INTERVAL = 0.05   # seconds between RSS samples during the measured run
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='whisk_bench',
+        description=f'Auto Whisk {APP_VERSION} - offline throughput benchmark'
+    )
+    parser.add_argument('--engine', nargs='+', choices=sorted(ENGINE_BACKENDS), default=['thread'])
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[4])
+    parser.add_argument('--prompts', type=int, default=20, help='prompts in the batch')
+    parser.add_argument('--count', type=int, default=4, help='images per prompt')
+    parser.add_argument('--refs', type=int, default=5, help='distinct KARAKTER references')
+    parser.add_argument('--ref-px', type=int, default=2048, help='reference image size (needs Pillow, else random bytes)')
+    parser.add_argument('--rate', type=float, default=RATE_INITIAL, help='initial request rate (req/s)')
+    parser.add_argument('--warm', action='store_true', help='run the batch once first so uploads are cache hits')
+    parser.add_argument('--group-by-refs', action='store_true', help='locality scheduling (see whisk_cli --group-by-refs)')
+    parser.add_argument('--url', help='use a running mock server instead of starting one')
+    parser.add_argument('--json', action='store_true', help='print results as JSON lines')
+    parser.add_argument('--verbose', action='store_true', help='show engine output')
+    add_mock_args(parser)
+    return parser.parse_args(argv)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+
+def current_rss_mb():
+    """Resident memory of this process right now in MB (None if unknown)"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+@contextlib.contextmanager
+def sample_rss(interval=RSS_SAMPLE_INTERVAL):
+    """Polls current RSS while the block runs. Yields: {'peak': MB or None}"""
+    result = {'peak': current_rss_mb()}
+    if result['peak'] is None:
+        yield result
+        return
+    stop = threading.Event()
+
+    def poll():
+        while not stop.wait(interval):
+            result['peak'] = max(result['peak'], current_rss_mb())
+
+    thread = threading.Thread(target=poll, name='bench-rss', daemon=True)
+    thread.start()
+    try:
+        yield result
+    finally:
+        stop.set()
+        thread.join()
+        result['peak'] = max(result['peak'], current_rss_mb())
+
+
+def start_mock(args):
+    """Returns: (url, process) of a mock server on a free port"""
+    cmd = [sys.executable, MOCK_SCRIPT, '--port', '0']
+    for name in ('latency', 'upload_latency', 'jitter', 'error_rate', 'throttle_rate',
+                 'retry_after', 'image_kb', 'token_ttl', 'seed'):
+        value = getattr(args, name)
+        if value is not None:
+            cmd += ['--' + name.replace('_', '-'), str(value)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline()
+    if 'Listening on' not in line:
+        proc.kill()
+        raise RuntimeError(f'Mock server did not start: {line.strip()}')
+    return line.split('Listening on', 1)[1].strip(), proc
+
+
+def mock_stats(url):
+    with urllib.request.urlopen(url + '/_stats', timeout=10) as r:
+        return json.load(r)
+
+
+def make_references(folder, count, px):
+    """KARAKTER files ref000..; real noise JPEGs with Pillow, random bytes without"""
+    os.makedirs(folder, exist_ok=True)
+    for i in range(count):
+        path = os.path.join(folder, f'ref{i:03d}.jpg')
+        if Image is not None:
+            Image.effect_noise((px, px), 64).convert('RGB').save(path, 'JPEG', quality=95)
+        else:
+            with open(path, 'wb') as f:
+                f.write(os.urandom(px * px // 4))
+
+
+def image_latencies(journal_path):
+    """Seconds from the last 'inflight' to 'done' of every finished image"""
+    sent, latencies = {}, []
+    with open(journal_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('type') != 'task':
+                continue
+            key = (record['row'], record['index'])
+            if record['state'] == 'inflight':
+                sent[key] = record['ts']
+            elif record['state'] == 'done' and key in sent:
+                latencies.append(record['ts'] - sent.pop(key))
+    return latencies
+
+
+def run_batch(args, backend, concurrency, client, token, work_dir, media_cache, name):
+    """One engine run over the whole batch. Returns: (ok, failed, seconds, journal path)"""
+    karakter = NameMatcher(scan_folder(os.path.join(work_dir, 'KARAKTER')), os.path.join(work_dir, 'KARAKTER'))
+    prompts = [f'ref{row % max(1, args.refs):03d} walks through scene {row}' for row in range(args.prompts)]
+    settings = {'imageAspectRatio': 'IMAGE_ASPECT_RATIO_LANDSCAPE', 'imageModel': 'R2I'}
+    output_dir = os.path.join(work_dir, name)
+    os.makedirs(output_dir, exist_ok=True)
+
+    journal = JobJournal.create(prompts, settings, output_dir, args.count, directory=work_dir)
+    task_queue = TaskScheduler(args.count)
+    for row, prompt in enumerate(prompts):
+        task_queue.put((row, prompt))
+
+    limiter = AdaptiveRateLimiter(rate=args.rate, max_rate=max(RATE_MAX, args.rate))
+    engine = create_engine(
+        backend, task_queue, settings, output_dir, args.count,
+        karakter, [], None, None, client.cookie_str, token, concurrency,
+        limiter=limiter, media_cache=media_cache, plans=build_plan(prompts, karakter, []),
+        client=client, exit_when_idle=True, journal=journal, locality=args.group_by_refs
+    )
+    stats = {'ok': 0, 'failed': 0}
+    engine.on_task_success = lambda row, col, path: stats.__setitem__('ok', stats['ok'] + 1)
+    engine.on_task_failed = lambda row, col, error: stats.__setitem__('failed', stats['failed'] + 1)
+
+    start = time.monotonic()
+    try:
+        engine.run()
+    finally:
+        journal.close()
+    return stats['ok'], stats['failed'], time.monotonic() - start, journal.path
+
+
+def run_one(args, backend, concurrency):
+    """Benchmark one engine/concurrency combination. Returns: result dict"""
+    url, proc = (args.url, None) if args.url else start_mock(args)
+    work_dir = tempfile.mkdtemp(prefix='whisk_bench_')
+    devnull = open(os.devnull, 'w')
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull)
+    try:
+        with quiet:
+            set_api_base(url)
+            whisk_core.REF_CACHE_DIR = os.path.join(work_dir, 'ref_cache')   # cold preprocessing cache
+            METRICS.path = os.path.join(work_dir, 'metrics.jsonl')
+            # Pillow's fixture buffers would otherwise stay in this process's RSS
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                pool.submit(make_references, os.path.join(work_dir, 'KARAKTER'), args.refs, args.ref_px).result()
+
+            client = WhiskClient('__Secure-next-auth.session-token=bench', pool_size=concurrency + UPLOAD_CONCURRENCY)
+            token, exp = fetch_access_token(client)
+            if not token:
+                raise RuntimeError(f'No token from the mock server at {url}')
+            client.set_token(token)
+            media_cache = MediaCache(os.path.join(work_dir, 'media_cache.json'))
+
+            if args.warm:
+                run_batch(args, backend, concurrency, client, token, work_dir, media_cache, 'warmup')
+            before = mock_stats(url)
+            stages_before = METRICS.summary()['stages']
+            with sample_rss() as rss:
+                ok, failed, seconds, journal_path = run_batch(args, backend, concurrency, client, token,
+                                                              work_dir, media_cache, 'out')
+            after = mock_stats(url)
+            stages_after = METRICS.summary()['stages']
+            latencies = image_latencies(journal_path)
+    finally:
+        devnull.close()
+        METRICS.close()
+        if proc:
+            proc.terminate()
+            proc.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    def delta(kind, endpoint):
+        return after[kind].get(endpoint, 0) - before[kind].get(endpoint, 0)
+
+    def status(code):
+        return after['status'].get(code, 0) - before['status'].get(code, 0)
+
+    def stage_ms():
+        """Mean milliseconds per stage over the measured run (warm-up excluded)"""
+        means = {}
+        for stage, agg in sorted(stages_after.items()):
+            count = agg['count'] - stages_before.get(stage, {}).get('count', 0)
+            if count:
+                means[stage] = round((agg['sum_s'] - stages_before.get(stage, {}).get('sum_s', 0.0)) / count * 1000, 1)
+        return means
+
+    return {
+        'engine': backend,
+        'concurrency': concurrency,
+        'images': ok,
+        'failed': failed,
+        'seconds': round(seconds, 2),
+        'images_per_s': round(ok / seconds, 3) if seconds else 0.0,
+        'p50_s': round(percentile(latencies, 0.50), 3),
+        'p95_s': round(percentile(latencies, 0.95), 3),
+        'peak_rss_mb': round(rss['peak'], 1) if rss['peak'] is not None else None,
+        'uploads': delta('requests', 'upload'),
+        'upload_mb': round(delta('bytes_in', 'upload') / (1024 * 1024), 2),
+        'generations': delta('requests', 'recipe') + delta('requests', 'generate'),
+        'http_429': status('429'),
+        'http_500': status('500'),
+        'stage_ms': stage_ms()
+    }
+
+
+def describe(result):
+    rss = f"{result['peak_rss_mb']:.0f} MB" if result['peak_rss_mb'] is not None else 'n/a'
+    return (f"[BENCH] {result['engine']} c={result['concurrency']}: {result['images']} images "
+            f"({result['failed']} failed) in {result['seconds']:.1f}s → {result['images_per_s']:.2f} img/s, "
+            f"p50 {result['p50_s']:.2f}s, p95 {result['p95_s']:.2f}s, RSS {rss}, "
+            f"upload {result['upload_mb']:.2f} MB ({result['uploads']} requests), "
+            f"429×{result['http_429']} 500×{result['http_500']}\n"
+            f"        mean ms: " + ', '.join(f'{stage} {ms:.0f}' for stage, ms in result['stage_ms'].items()))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    combos = list(itertools.product(args.engine, args.concurrency))
+
+    if len(combos) == 1:
+        results = [run_one(args, *combos[0])]
+    else:
+        # One process per combination: peak RSS and the HTTP pools start fresh
+        results = []
+        base = [a for a in argv if a not in ('--json', '--verbose')]
+        for backend, concurrency in combos:
+            cmd = [sys.executable, os.path.abspath(__file__)] + base + [
+                '--engine', backend, '--concurrency', str(concurrency), '--json']
+            out = subprocess.run(cmd, stdout=subprocess.PIPE, text=True, check=True).stdout
+            results.append(json.loads(out.strip().splitlines()[-1]))
+
+    for result in results:
+        print(json.dumps(result) if args.json else describe(result))
+    return 0 if all(r['images'] for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,270 @@
+"""
+Auto Whisk - Headless CLI
+=========================
+Runs a prompt batch without PySide6, using the same folder scanning,
+matching, upload and generation engines as the GUI.
+
+Usage:
+    python whisk_cli.py prompts.txt -o ./out --count 4 --concurrency 8
+    python whisk_cli.py --resume latest
+    AutoWhisk_v8.7_Folder.exe --headless prompts.txt -o ./out
+
+Auth: --cookie (or the cookie saved by the GUI) is exchanged for a fresh
+token on start; --token skips the exchange.
+"""
+
+import sys
+import os
+import json
+import time
+import signal
+import argparse
+import threading
+
+from whisk_core import (
+    APP_VERSION, AUTH_FILE, RATIO_DATA, KARAKTER_FOLDER, MEKAN_FOLDER, STIL_FOLDER,
+    DEFAULT_CONCURRENCY, MAX_CONCURRENCY, UPLOAD_CONCURRENCY, DEFAULT_ENGINE, ENGINE_BACKENDS,
+    METRICS_PORT, METRICS, LIBRARY_ROOTS, LibraryStore, FolderIndex, FolderWatcher, library_folders, changed_paths, WhiskClient, fetch_access_token, MediaCache, AccountPool,
+    upload_cached, build_plan, create_engine, JobJournal, TaskScheduler
+)
+
+# 'landscape' → 'IMAGE_ASPECT_RATIO_LANDSCAPE', ...
+RATIO_CHOICES = {name.split()[0].lower(): api for name, api in RATIO_DATA}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='whisk_cli',
+        description=f'Auto Whisk {APP_VERSION} - headless batch mode'
+    )
+    parser.add_argument('prompts', nargs='?', help="prompts file, one per line ('-' for stdin)")
+    parser.add_argument('-o', '--output', default=os.path.join(os.getcwd(), 'AutoWhisk_Output'),
+                        help='output folder')
+    parser.add_argument('--karakter', default=KARAKTER_FOLDER, help='KARAKTER folder')
+    parser.add_argument('--mekan', default=MEKAN_FOLDER, help='MEKAN folder')
+    parser.add_argument('--stil', default=STIL_FOLDER,
+                        help='STIL folder (first image is the default, prompts may name others)')
+    parser.add_argument('--library', action='append', default=LIBRARY_ROOTS[1:], metavar='ROOT',
+                        help='extra library root with KARAKTER/MEKAN/STIL subfolders (repeatable)')
+    parser.add_argument('--ratio', choices=sorted(RATIO_CHOICES), default='landscape')
+    parser.add_argument('--count', type=int, default=4, help='images per prompt (1-20)')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f'in-flight generation requests (1-{MAX_CONCURRENCY})')
+    parser.add_argument('--engine', choices=sorted(ENGINE_BACKENDS), default=DEFAULT_ENGINE)
+    parser.add_argument('--cookie', help='cookie (JSON, header string or session JWT); default: saved')
+    parser.add_argument('--token', help='access token (skips the cookie exchange)')
+    parser.add_argument('--account', action='append', default=[], metavar='COOKIE',
+                        help='add an account to the saved pool; requests are spread over all of them (repeatable)')
+    parser.add_argument('--quota', type=int, help='images per account per day (0 = unlimited)')
+    parser.add_argument('--group-by-refs', action='store_true',
+                        help='run prompts sharing a reference set together, uploading each set when its group starts')
+    parser.add_argument('--no-watch', dest='watch', action='store_false',
+                        help="don't pick up reference folder changes during the run")
+    parser.add_argument('--resume', metavar='JOURNAL',
+                        help="finish an interrupted batch: job journal path or 'latest'")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT, metavar='PORT',
+                        help='serve Prometheus metrics on http://127.0.0.1:PORT/metrics during the run')
+    args = parser.parse_args(argv)
+    if not args.prompts and not args.resume:
+        parser.error('a prompts file or --resume is required')
+    return args
+
+
+def read_prompts(path):
+    if path == '-':
+        text = sys.stdin.read()
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    return [p.strip() for p in text.split('\n') if p.strip()]
+
+
+def load_saved_auth():
+    """Returns: (cookie, token) saved by the GUI, or ('', '')"""
+    if not os.path.exists(AUTH_FILE):
+        return ('', '')
+    try:
+        with open(AUTH_FILE, 'r') as f:
+            data = json.load(f)
+        return (data.get('cookie', ''), data.get('token', ''))
+    except:
+        return ('', '')
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # === BATCH ===
+    if args.resume:
+        journal = JobJournal.find_unfinished() if args.resume == 'latest' else JobJournal.load(args.resume)
+        if not journal:
+            print('[RESUME] No unfinished batch found')
+            return 0
+        missing = journal.missing()
+        print(f"[RESUME] {os.path.basename(journal.path)}: {sum(map(len, missing.values()))}/{journal.total} images missing")
+        prompts = journal.prompts
+    else:
+        prompts = read_prompts(args.prompts)
+        if not prompts:
+            print('[ERROR] No prompts')
+            return 2
+
+    if args.metrics_port:
+        METRICS.serve(args.metrics_port)
+
+    # === AUTH ===
+    saved_cookie, saved_token = load_saved_auth()
+    cookie_str = args.cookie or saved_cookie
+    client = WhiskClient(cookie_str, pool_size=args.concurrency + UPLOAD_CONCURRENCY)
+
+    token = args.token
+    exp = 0
+    if not token and cookie_str:
+        token, exp = fetch_access_token(client)
+        if token:
+            print(f"[AUTH] Token OK (expires {time.strftime('%Y-%m-%d %H:%M', time.localtime(exp)) if exp else 'unknown'})")
+    token = token or saved_token
+    if not token:
+        print('[ERROR] No access token: pass --cookie/--token or save a cookie in the GUI first')
+        return 2
+    client.set_token(token)
+
+    # === ACCOUNTS ===
+    accounts = AccountPool.load(pool_size=args.concurrency + UPLOAD_CONCURRENCY)
+    accounts.add(cookie_str, token, exp, client=client)
+    for cookie in args.account:
+        account = accounts.add(cookie)
+        if not account.refresh():
+            print(f"[ACCOUNTS] {account.label}: cookie validation failed")
+    if args.quota is not None:
+        for account in accounts:
+            account.quota = max(0, args.quota)
+    accounts.save()
+    if len(accounts) > 1:
+        print(f"[ACCOUNTS] {len(accounts)} accounts in the pool")
+
+    # === FOLDERS ===
+    roots = [os.path.abspath(root) for root in args.library]
+    library = LibraryStore()
+    karakter_index = FolderIndex([args.karakter] + library_folders('KARAKTER', roots), library)
+    mekan_index = FolderIndex([args.mekan] + library_folders('MEKAN', roots), library)
+    stil_index = FolderIndex([args.stil] + library_folders('STIL', roots), library, stat_files=True)
+    karakter_files = karakter_index.matcher
+    mekan_files = mekan_index.matcher
+    stil_files = stil_index.matcher
+    print(f"[SCAN] KARAKTER: {len(karakter_files)} files, MEKAN: {len(mekan_files)} files, STIL: {len(stil_files)} files")
+
+    media_cache = MediaCache()
+    media_cache.hash_memo.update(library.hash_memo())
+    library.save()
+
+    def upload_style(stil_file):
+        if not stil_file:
+            return None
+        mid, cap, err = upload_cached(stil_file, 'MEDIA_CATEGORY_STYLE', client, media_cache)
+        if mid:
+            print(f"[STYLE] {os.path.basename(stil_file)} → {mid[:12]}...")
+        else:
+            print(f"[STYLE] ❌ Upload failed: {err} (continuing without style)")
+        return mid
+
+    stil_file = stil_index.first()
+    stil_media_id = upload_style(stil_file)
+
+    if not args.resume:
+        settings = {
+            'imageAspectRatio': RATIO_CHOICES[args.ratio],
+            'imageModel': 'R2I'
+        }
+        journal = JobJournal.create(prompts, settings, args.output, max(1, min(args.count, 20)))
+        print(f"[JOURNAL] {journal.path}")
+        missing = journal.missing()
+
+    # === QUEUE ===
+    output_dir = journal.output_dir
+    count = journal.num_images
+    os.makedirs(output_dir, exist_ok=True)
+    task_queue = TaskScheduler(count)
+    for row, indices in sorted(missing.items()):
+        task_queue.put((row, prompts[row], indices))
+
+    plans = build_plan(prompts, karakter_files, mekan_files, stil_file, stil_files)
+
+    engine = create_engine(
+        args.engine, task_queue, journal.settings, output_dir, count,
+        karakter_files, mekan_files, stil_file, stil_media_id,
+        cookie_str, token, args.concurrency,
+        media_cache=media_cache, plans=plans, client=client, exit_when_idle=True,
+        journal=journal, stil_files=stil_files, accounts=accounts, locality=args.group_by_refs
+    )
+
+    # === PROGRESS ===
+    total = sum(len(indices) for indices in missing.values())
+    stats = {'done': 0, 'failed': 0}
+    lock = threading.Lock()
+
+    def on_success(row_idx, col_idx, path):
+        with lock:
+            stats['done'] += 1
+            n = stats['done'] + stats['failed']
+        print(f"[{n}/{total}] ✓ #{row_idx+1}.{col_idx} → {os.path.basename(path)}")
+
+    def on_failed(row_idx, col_idx, error):
+        with lock:
+            # col 0: reference preparation failed, the whole row is lost
+            stats['failed'] += len(missing.get(row_idx, ())) if col_idx == 0 else 1
+            n = stats['done'] + stats['failed']
+        print(f"[{n}/{total}] ✗ #{row_idx+1}.{col_idx or '*'} → {error}")
+
+    engine.on_task_success = on_success
+    engine.on_task_failed = on_failed
+
+    def on_sigint(signum, frame):
+        print('\n[STOP] Finishing in-flight requests... (Ctrl+C again to abort)')
+        engine.stop()
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    signal.signal(signal.SIGINT, on_sigint)
+
+    # === LIVE FOLDERS ===
+    watcher = None
+    if args.watch:
+        style = {'file': stil_file}
+
+        def on_folder_change(index, changes):
+            kwargs = {'changed': changed_paths(changes)}
+            if index is karakter_index:
+                kwargs['karakter_files'] = karakter_index.matcher
+            elif index is mekan_index:
+                kwargs['mekan_files'] = mekan_index.matcher
+            else:
+                kwargs['stil_files'] = stil_index.matcher
+                new_file = stil_index.first()
+                if new_file != style['file'] or style['file'] in kwargs['changed']:
+                    style['file'] = new_file
+                    kwargs['stil'] = (new_file, upload_style(new_file))
+            engine.update_references(**kwargs)
+            library.save(media_cache.hash_memo)
+
+        watcher = FolderWatcher([karakter_index, mekan_index, stil_index], on_folder_change).start()
+
+    start = time.monotonic()
+    try:
+        engine.run()
+    finally:
+        if watcher:
+            watcher.stop()
+        journal.close()
+        media_cache.flush()
+        library.save(media_cache.hash_memo)
+    elapsed = time.monotonic() - start
+
+    rate = stats['done'] / elapsed * 60 if elapsed else 0
+    print(f"\n[DONE] {stats['done']} ok, {stats['failed']} failed, {elapsed:.0f}s ({rate:.1f} images/min)")
+    for stage, agg in METRICS.summary()['stages'].items():
+        print(f"[METRICS] {stage}: {agg['count']}× mean {agg['mean_ms']:.0f} ms, max {agg['max_s']:.2f}s")
+    return 0 if stats['failed'] == 0 and stats['done'] == total else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,3114 @@
+"""
+Auto Whisk - Core (Qt-free)
+===========================
+Folder scanning, name matching, uploads, batch planning and the
+generation engines. Shared by the GUI (auto_whisk_v8.7_FOLDER_BASED.py)
+and the headless CLI (whisk_cli.py); must never import PySide6.
+"""
+
+import sys
+import json
+import requests
+import base64
+import os
+import time
+import re
+import queue
+import random
+import threading
+import email.utils
+import hashlib
+import functools
+import tempfile
+import http.cookiejar
+import asyncio
+import atexit
+import collections
+import contextlib
+import logging
+import logging.handlers
+from concurrent.futures import ThreadPoolExecutor, Future
+from datetime import datetime
+
+try:
+    import aiohttp   # optional: asyncio engine backend
+except ImportError:
+    aiohttp = None
+
+try:
+    from PIL import Image, ImageOps   # optional: reference preprocessing
+except ImportError:
+    Image = ImageOps = None
+
+# ==================== CONFIGURATION ====================
+APP_VERSION = 'v8.7.0 FOLDER BASED'
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+API_AUTH_SESSION = 'https://labs.google/fx/api/auth/session'
+API_TOKEN_INFO = 'https://www.googleapis.com/oauth2/v3/tokeninfo'
+API_CAPTION_IMAGE = 'https://labs.google/fx/api/trpc/backbone.captionImage'
+API_UPLOAD_IMAGE = 'https://labs.google/fx/api/trpc/backbone.uploadImage'
+API_RUN_RECIPE = 'https://aisandbox-pa.googleapis.com/v1/whisk:runImageRecipe'
+API_GENERATE_IMAGE = 'https://aisandbox-pa.googleapis.com/v1/whisk:generateImage'
+API_ENDPOINTS = ('API_AUTH_SESSION', 'API_TOKEN_INFO', 'API_CAPTION_IMAGE', 'API_UPLOAD_IMAGE',
+                 'API_RUN_RECIPE', 'API_GENERATE_IMAGE')
+
+# Generation pool
+DEFAULT_CONCURRENCY = 4   # in-flight generation requests
+MAX_CONCURRENCY = 16
+UPLOAD_CONCURRENCY = 4    # parallel reference uploads before a batch
+DEFAULT_ENGINE = os.getenv('AUTOWHISK_ENGINE', 'thread')   # 'thread' or 'async' (--engine)
+
+# Output writing
+B64_CHUNK = 1 << 20       # base64 characters decoded per step (multiple of 4)
+BACKGROUND_WRITES = True  # decode/write images on a separate I/O thread
+
+# HTTP connection pool (per host)
+HTTP_POOL_SIZE = MAX_CONCURRENCY + UPLOAD_CONCURRENCY
+
+# Adaptive rate limiting (generation requests per second)
+RATE_INITIAL = 0.5        # old fixed pacing: one request every 2s
+RATE_MIN = 0.05
+RATE_MAX = 4.0
+RATE_STEP = 0.05          # additive increase per successful request
+RATE_BURST = 2
+TRANSIENT_STATUS = (429, 500, 502, 503, 504)
+MAX_RETRIES = 4
+BACKOFF_BASE = 2.0        # seconds, doubled per attempt (full jitter)
+BACKOFF_MAX = 60.0
+
+APP_NAME = 'AutoWhisk'
+if sys.platform == 'win32':
+    app_data = os.getenv('APPDATA') or os.path.expanduser('~\\AppData\\Roaming')
+elif sys.platform == 'darwin':
+    app_data = os.path.expanduser('~/Library/Application Support')
+else:
+    app_data = os.path.expanduser('~/.local/share')
+
+APP_DIR = os.path.join(app_data, APP_NAME)
+os.makedirs(APP_DIR, exist_ok=True)
+AUTH_FILE = os.path.join(APP_DIR, 'auth_session.json')
+ACCOUNTS_FILE = os.path.join(APP_DIR, 'accounts.json')
+ACCOUNT_DAILY_QUOTA = 0       # images per account per day (0 = unlimited)
+ACCOUNT_COOLDOWN = 15 * 60    # seconds an account rests after a final 429
+TOKEN_REFRESH_MARGIN = 5 * 60 # refresh an access token this long before it expires
+TOKEN_CHECK_INTERVAL = 30     # seconds between background token expiry checks
+AUTH_RETRY_INTERVAL = 60      # seconds before a failed token refresh is tried again
+AUTH_RETRIES = 2              # times an image is re-queued after HTTP 401
+MEDIA_CACHE_FILE = os.path.join(APP_DIR, 'media_cache.json')
+MEDIA_CACHE_TTL = 24 * 3600   # seconds an uploaded media ID is reused
+MEDIA_CACHE_FLUSH_INTERVAL = 30   # seconds between cache file rewrites during a burst of uploads
+JOURNAL_DIR = os.path.join(APP_DIR, 'jobs')
+JOURNAL_SYNC_EVERY = 50       # fsync the job journal every N records
+JOURNAL_SCAN_LIMIT = 10       # newest journals checked for unfinished work
+
+# Reference preprocessing (needs Pillow; originals are uploaded without it)
+REF_PREPROCESS = True
+REF_MAX_SIDE = 1536           # longest side sent to captionImage/uploadImage
+REF_JPEG_QUALITY = 90
+REF_CACHE_DIR = os.path.join(APP_DIR, 'ref_cache')
+REF_CACHE_MAX_AGE = 30 * 24 * 3600   # seconds before an unused upload copy is deleted
+
+# Reference library: every root may hold KARAKTER/, MEKAN/ and STIL/ with
+# nested subfolders (BASE_DIR first, then AUTOWHISK_LIBRARY, os.pathsep-separated)
+LIBRARY_INDEX_FILE = os.path.join(APP_DIR, 'library_index.json')
+
+# Reference folder watching
+FOLDER_POLL_INTERVAL = 2.0    # seconds between polls (headless / unwatchable folders)
+FOLDER_SETTLE_MS = 500        # GUI: wait for a burst of file events to settle
+
+# Metrics: timing spans + counters, JSONL log and optional Prometheus text endpoint
+METRICS_ENABLED = os.getenv('AUTOWHISK_METRICS', '1') != '0'
+METRICS_LOG = os.path.join(APP_DIR, 'metrics.jsonl')
+METRICS_LOG_MAX_BYTES = 5 * 1024 * 1024
+METRICS_LOG_BACKUPS = 3
+METRICS_PORT = int(os.getenv('AUTOWHISK_METRICS_PORT', '0') or 0)   # 0 = no endpoint
+METRICS_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS_WINDOW = 500          # recent samples per stage kept for percentiles
+
+# Folder paths (relative to EXE location)
+BASE_DIR = os.path.dirname(sys.executable if getattr(sys, 'frozen', False) else __file__)
+KARAKTER_FOLDER = os.path.join(BASE_DIR, 'KARAKTER')
+MEKAN_FOLDER = os.path.join(BASE_DIR, 'MEKAN')
+STIL_FOLDER = os.path.join(BASE_DIR, 'STIL')
+LIBRARY_ROOTS = [BASE_DIR] + [os.path.abspath(p) for p in os.getenv('AUTOWHISK_LIBRARY', '').split(os.pathsep) if p]
+
+RATIO_DATA = [
+    ('Landscape 16:9', 'IMAGE_ASPECT_RATIO_LANDSCAPE'),
+    ('Portrait 9:16', 'IMAGE_ASPECT_RATIO_PORTRAIT'),
+    ('Square 1:1', 'IMAGE_ASPECT_RATIO_SQUARE')
+]
+
+
+# ==================== METRICS ====================
+
+class Metrics:
+    """
+    Hot-path instrumentation
+    - span(stage, **fields): times a block (scan, match, preprocess, caption,
+      upload, rate_wait, generate, write, ui); aggregated per stage into a
+      histogram and logged as one JSONL event
+    - count(name, value, **labels): counters (bytes_sent, bytes_received,
+      responses, retries, cache_hits, cache_misses)
+    - percentile(stage, p) over the last METRICS_WINDOW samples of a stage
+    - Events go through a queue to a rotating METRICS_LOG (written on a
+      listener thread, never on the caller's)
+    - serve(port): Prometheus text format on http://127.0.0.1:port/metrics
+    """
+    
+    def __init__(self, path=METRICS_LOG, enabled=METRICS_ENABLED):
+        self.path = path
+        self.enabled = enabled
+        self.stages = {}     # stage → [count, sum, max, bucket counts...]
+        self.recent = {}     # stage → deque of the latest durations
+        self.counters = {}   # (name, ((label, value), ...)) → total
+        self.lock = threading.Lock()
+        self.listener = None
+        self.server = None
+        self.logger = logging.getLogger('autowhisk.metrics')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+    
+    def start_log(self):
+        """Open the JSONL log on first use (listener thread + rotating file)"""
+        with self.lock:
+            if self.listener or not self.enabled:
+                return
+            events = queue.SimpleQueue()
+            handler = logging.handlers.RotatingFileHandler(
+                self.path, maxBytes=METRICS_LOG_MAX_BYTES, backupCount=METRICS_LOG_BACKUPS,
+                encoding='utf-8', delay=True)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(logging.handlers.QueueHandler(events))
+            self.listener = logging.handlers.QueueListener(events, handler)
+            self.listener.start()
+    
+    def log(self, event):
+        if not self.enabled:
+            return
+        if not self.listener:
+            self.start_log()
+        self.logger.info(json.dumps(event, default=str))
+    
+    @contextlib.contextmanager
+    def span(self, stage, **fields):
+        """Time a block; the block may add fields (status, bytes, ...) to the yielded dict"""
+        start = time.perf_counter()
+        try:
+            yield fields
+        except BaseException as e:
+            fields.setdefault('error', type(e).__name__)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start, fields)
+    
+    def observe(self, stage, seconds, fields=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            agg = self.stages.get(stage)
+            if agg is None:
+                agg = self.stages[stage] = [0, 0.0, 0.0] + [0] * len(METRICS_BUCKETS)
+            agg[0] += 1
+            agg[1] += seconds
+            agg[2] = max(agg[2], seconds)
+            if stage not in self.recent:
+                self.recent[stage] = collections.deque(maxlen=METRICS_WINDOW)
+            self.recent[stage].append(seconds)
+            for i, bound in enumerate(METRICS_BUCKETS):
+                if seconds <= bound:
+                    agg[3 + i] += 1
+                    break
+        event = {'ts': round(time.time(), 3), 'stage': stage, 'ms': round(seconds * 1000, 2)}
+        if fields:
+            event.update(fields)
+        self.log(event)
+    
+    def count(self, name, value=1, **labels):
+        if not self.enabled or not value:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def percentile(self, stage, p):
+        """Returns: p-th percentile (0-1) of the stage's recent durations in seconds, or None"""
+        with self.lock:
+            values = sorted(self.recent.get(stage, ()))
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+    
+    def totals(self, name, label):
+        """Returns: {label value: total} of a counter, summed over its other labels"""
+        result = {}
+        with self.lock:
+            for (counter, labels), total in self.counters.items():
+                if counter == name:
+                    value = dict(labels).get(label)
+                    result[value] = result.get(value, 0) + total
+        return result
+    
+    def summary(self):
+        """Returns: {'stages': {stage: {count, sum_s, max_s, mean_ms}}, 'counters': {name{labels}: total}}"""
+        with self.lock:
+            stages = {stage: {'count': agg[0], 'sum_s': round(agg[1], 3), 'max_s': round(agg[2], 3),
+                              'mean_ms': round(agg[1] / agg[0] * 1000, 2) if agg[0] else 0.0}
+                      for stage, agg in self.stages.items()}
+            counters = {name + (''.join(f'{{{k}={v}}}' for k, v in labels)): total
+                        for (name, labels), total in self.counters.items()}
+        return {'stages': stages, 'counters': counters}
+    
+    def flush(self, **fields):
+        """Log a summary event (end of a batch)"""
+        event = {'ts': round(time.time(), 3), 'type': 'summary'}
+        event.update(fields)
+        event.update(self.summary())
+        self.log(event)
+    
+    def prometheus(self):
+        """Returns: all metrics in Prometheus text exposition format"""
+        lines = ['# TYPE autowhisk_stage_seconds histogram']
+        with self.lock:
+            stages = {stage: list(agg) for stage, agg in self.stages.items()}
+            counters = dict(self.counters)
+        for stage, agg in sorted(stages.items()):
+            cumulative = 0
+            for i, bound in enumerate(METRICS_BUCKETS):
+                cumulative += agg[3 + i]
+                lines.append(f'autowhisk_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'autowhisk_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {agg[0]}')
+            lines.append(f'autowhisk_stage_seconds_sum{{stage="{stage}"}} {agg[1]:.6f}')
+            lines.append(f'autowhisk_stage_seconds_count{{stage="{stage}"}} {agg[0]}')
+        typed = set()
+        for (name, labels), total in sorted(counters.items()):
+            metric = f'autowhisk_{name}_total'
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f'# TYPE {metric} counter')
+            label_text = ','.join(f'{k}="{str(v).replace(chr(34), "")}"' for k, v in labels)
+            lines.append(f'{metric}{{{label_text}}} {total}' if label_text else f'{metric} {total}')
+        return '\n'.join(lines) + '\n'
+    
+    def serve(self, port=METRICS_PORT, host='127.0.0.1'):
+        """Start the Prometheus endpoint on a daemon thread. Returns: URL, or None if off/failed"""
+        if not port or self.server:
+            return None
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        metrics = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+            
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        
+        try:
+            self.server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            print(f"[METRICS] Endpoint failed on port {port}: {e}")
+            return None
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='whisk-metrics', daemon=True).start()
+        url = f'http://{host}:{self.server.server_address[1]}/metrics'
+        print(f"[METRICS] Serving {url}")
+        return url
+    
+    def close(self):
+        """Flush the log (listener drains its queue) and stop the endpoint"""
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+            for handler in list(self.logger.handlers):
+                self.logger.removeHandler(handler)
+        if self.server:
+            self.server.shutdown()
+            self.server = None
+
+METRICS = Metrics()
+atexit.register(METRICS.close)
+
+
+# ==================== FOLDER MANAGEMENT ====================
+
+def normalize_turkish(text):
+    """Normalize Turkish characters and lowercase"""
+    replacements = {
+        'ı': 'i', 'İ': 'i', 'I': 'i',
+        'ş': 's', 'Ş': 's',
+        'ğ': 'g', 'Ğ': 'g',
+        'ü': 'u', 'Ü': 'u',
+        'ö': 'o', 'Ö': 'o',
+        'ç': 'c', 'Ç': 'c'
+    }
+    for old, new in replacements.items():
+        text = text.replace(old, new)
+    return text.lower()
+
+def get_file_base_name(filename):
+    """
+    Extract clean name from filename
+    'Kırmızı_Şapkalı_Kedi.jpg' → 'kirmizi sapkali kedi'
+    """
+    name = os.path.splitext(filename)[0]  # Remove extension
+    name = name.replace('_', ' ')  # Underscores to spaces
+    name = normalize_turkish(name)
+    return name.strip()
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+def scan_folder(folder_path):
+    """
+    Scan folder for image files
+    Returns: list of (filename, base_name) tuples
+    """
+    if not os.path.exists(folder_path):
+        return []
+    
+    files = []
+    for filename in os.listdir(folder_path):
+        if filename.lower().endswith(IMAGE_EXTENSIONS):
+            base_name = get_file_base_name(filename)
+            files.append((filename, base_name))
+    
+    return files
+
+# Turkish suffixes (possessive, locative, etc.)
+TURKISH_SUFFIXES = [
+    'in', 'nin', 'un', 'nun', 'ın', 'nın', 'ün', 'nün',  # Possessive
+    'da', 'de', 'ta', 'te', 'nda', 'nde',  # Locative
+    'a', 'e', 'na', 'ne', 'ya', 'ye',  # Dative
+    'i', 'ı', 'u', 'ü', 'ni', 'nı', 'nu', 'nü',  # Accusative
+    'dan', 'den', 'tan', 'ten', 'ndan', 'nden'  # Ablative
+]
+
+@functools.lru_cache(maxsize=None)
+def name_pattern(file_norm):
+    """
+    Compiled matcher for one normalized name: the bare name or the name
+    plus any Turkish suffix, between word boundaries
+    """
+    suffixes = '|'.join(re.escape(s) for s in TURKISH_SUFFIXES)
+    return re.compile(r'\b' + re.escape(file_norm) + r'(?:' + suffixes + r')?\b')
+
+def is_exact_match(file_base_name, prompt):
+    """
+    Check if file base name EXACTLY matches in prompt
+    Uses word boundaries and Turkish suffixes
+    
+    Examples:
+        file: "ahmet", prompt: "ahmet parkta" → TRUE
+        file: "ahmet", prompt: "ahmetin arabası" → TRUE (suffix)
+        file: "park", prompt: "otopark" → FALSE (word boundary)
+    """
+    prompt_norm = normalize_turkish(prompt)
+    file_norm = file_base_name  # Already normalized
+    
+    if file_norm not in prompt_norm:
+        return False
+    return name_pattern(file_norm).search(prompt_norm) is not None
+
+def match_files_in_folder(folder_files, prompt):
+    """
+    Match files from folder against prompt
+    Accepts a scan_folder() list or a prebuilt NameMatcher
+    Returns: list of matching filenames
+    """
+    if isinstance(folder_files, NameMatcher):
+        return folder_files.match(prompt)
+    
+    matches = []
+    
+    for filename, base_name in folder_files:
+        if is_exact_match(base_name, prompt):
+            matches.append(filename)
+            print(f"[MATCH] '{base_name}' → {filename}")
+    
+    return matches
+
+class NameMatcher:
+    """
+    Name index over one scan_folder() result
+    - Aho-Corasick automaton over normalized base names finds every
+      occurrence in a single pass over the prompt
+    - Each occurrence is confirmed with the name's precompiled
+      boundary/suffix pattern, so results equal is_exact_match
+    """
+    
+    def __init__(self, folder_files, folder=''):
+        self.folder = folder
+        self.files = list(folder_files)
+        self.owners = {}   # base_name → [index into self.files]
+        for idx, (filename, base_name) in enumerate(self.files):
+            self.owners.setdefault(base_name, []).append(idx)
+        
+        # Trie
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for base_name in self.owners:
+            if not base_name:
+                continue
+            node = 0
+            for ch in base_name:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[node][ch] = nxt
+                node = nxt
+            self.out[node].append(base_name)
+        
+        # Failure links (BFS)
+        pending = collections.deque(self.goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for ch, nxt in self.goto[node].items():
+                pending.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+    
+    def __len__(self):
+        return len(self.files)
+    
+    def match(self, prompt):
+        """Returns: list of matching filenames, in folder order"""
+        prompt_norm = normalize_turkish(prompt)
+        found = set()
+        
+        node = 0
+        for i, ch in enumerate(prompt_norm):
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            for base_name in self.out[node]:
+                if base_name not in found and name_pattern(base_name).match(prompt_norm, i - len(base_name) + 1):
+                    found.add(base_name)
+        
+        if '' in self.owners and name_pattern('').search(prompt_norm):
+            found.add('')
+        
+        matches = []
+        for idx in sorted(idx for base_name in found for idx in self.owners[base_name]):
+            filename, base_name = self.files[idx]
+            matches.append(filename)
+            print(f"[MATCH] '{base_name}' → {filename}")
+        
+        return matches
+
+class LibraryStore:
+    """
+    Persisted directory listings of the reference library (library_index.json)
+    - dirs: dir_path → {'mtime': mtime_ns, 'subdirs': [...], 'files': {name: [mtime_ns, size]}}
+    - hashes: file_path → [mtime_ns, size, sha256], seeds MediaCache.hash_memo
+    A directory whose mtime is unchanged is not listed again on startup
+    path=None keeps everything in memory
+    """
+    
+    def __init__(self, path=LIBRARY_INDEX_FILE):
+        self.path = path
+        self.dirs = {}
+        self.hashes = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.load()
+    
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.dirs = data.get('dirs', {})
+            self.hashes = data.get('hashes', {})
+        except:
+            self.dirs, self.hashes = {}, {}
+    
+    def file_stat(self, file_path):
+        """[mtime_ns, size] from the stored listing, or None"""
+        entry = self.dirs.get(os.path.dirname(file_path))
+        return entry['files'].get(os.path.basename(file_path)) if entry else None
+    
+    def hash_memo(self):
+        """Stored hashes in MediaCache.hash_memo form"""
+        return {path: tuple(h) for path, h in self.hashes.items()}
+    
+    def save(self, hash_memo=None):
+        """Write if anything changed; hash_memo adds hashes of files still in the library"""
+        with self.lock:
+            hashes = {}
+            for path, h in list((hash_memo or {}).items()) + list(self.hashes.items()):
+                st = self.file_stat(path)
+                if st and list(st) == [h[0], h[1]] and path not in hashes:
+                    hashes[path] = [h[0], h[1], h[2]]
+            if hashes != self.hashes:
+                self.hashes = hashes
+                self.dirty = True
+            if not self.dirty or not self.path:
+                return
+            
+            tmp = self.path + '.tmp'
+            try:
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump({'dirs': self.dirs, 'hashes': self.hashes}, f)
+                os.replace(tmp, self.path)
+                self.dirty = False
+            except OSError as e:
+                print(f"[LIBRARY] Save failed: {e}")
+
+def library_folders(name, roots=None):
+    """One category folder (KARAKTER/MEKAN/STIL) under every library root"""
+    return [os.path.join(root, name) for root in (LIBRARY_ROOTS if roots is None else roots)]
+
+class FolderIndex:
+    """
+    Live name index over one reference category
+    - Spans several folders (one per library root) and all their subfolders
+    - Name → path: when a name exists more than once, the first root wins,
+      then the shallowest path, then alphabetical order
+    - refresh() walks the directory tree but only lists directories whose
+      mtime changed since the last walk (or since the persisted listing);
+      the NameMatcher is only rebuilt when files were added or removed
+    - Files in unchanged directories are re-stat'ed on refresh, so in-place
+      edits are reported as modified; the startup walk trusts the persisted
+      listing for them unless stat_files (used for the small STIL folder)
+    - A rename shows up as removed + added
+    """
+    
+    def __init__(self, folders, store=None, stat_files=False):
+        self.folders = [folders] if isinstance(folders, str) else list(folders)
+        self.folder = self.folders[0]
+        self.store = store or LibraryStore(path=None)
+        self.stat_files = stat_files
+        self.lock = threading.Lock()
+        self.dirs = []
+        self.walked = False   # after the startup walk every walk re-stats files
+        self.snapshot = self.walk()
+        self.matcher = self.build_matcher()
+    
+    def __len__(self):
+        return len(self.snapshot)
+    
+    @property
+    def exists(self):
+        return any(os.path.isdir(folder) for folder in self.folders)
+    
+    def first(self):
+        """First image in library order (default STIL), or None"""
+        return next(iter(self.snapshot), None)
+    
+    def list_dir(self, directory, mtime):
+        subdirs, files = [], {}
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                        elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                            st = entry.stat()
+                            files[entry.name] = [st.st_mtime_ns, st.st_size]
+                    except OSError:
+                        continue   # deleted between listing and stat
+        except OSError:
+            return None
+        return {'mtime': mtime, 'subdirs': sorted(subdirs), 'files': dict(sorted(files.items()))}
+    
+    def restat(self, directory, entry):
+        """Returns: True if a file of the listing changed"""
+        changed = False
+        for name, old in list(entry['files'].items()):
+            try:
+                st = os.stat(os.path.join(directory, name))
+                new = [st.st_mtime_ns, st.st_size]
+            except OSError:
+                new = None
+            if new != list(old):
+                changed = True
+                if new:
+                    entry['files'][name] = new
+                else:
+                    del entry['files'][name]
+        return changed
+    
+    def walk(self):
+        """Returns: {file_path: (mtime_ns, size)} in library order"""
+        with METRICS.span('scan', folders=len(self.folders)) as span, self.store.lock:
+            current = self._walk()
+            span['files'] = len(current)
+            return current
+    
+    def _walk(self):
+        dirs = self.store.dirs
+        restat = self.stat_files or self.walked
+        current = {}
+        visited = []
+        for folder in self.folders:
+            stack = [folder]
+            while stack:
+                directory = stack.pop()
+                try:
+                    mtime = os.stat(directory).st_mtime_ns
+                except OSError:
+                    continue
+                
+                entry = dirs.get(directory)
+                if not entry or entry['mtime'] != mtime:
+                    entry = self.list_dir(directory, mtime)
+                    if entry is None:
+                        continue
+                    dirs[directory] = entry
+                    self.store.dirty = True
+                elif restat:
+                    if self.restat(directory, entry):
+                        self.store.dirty = True
+                
+                visited.append(directory)
+                for name, st in entry['files'].items():
+                    current[os.path.join(directory, name)] = tuple(st)
+                stack.extend(os.path.join(directory, d) for d in reversed(entry['subdirs']))
+        
+        # Forget listings of directories that are gone
+        seen = set(visited)
+        for directory in [d for d in dirs if d not in seen]:
+            if any(directory == f or directory.startswith(f + os.sep) for f in self.folders):
+                del dirs[directory]
+                self.store.dirty = True
+        
+        self.dirs = visited
+        self.walked = True
+        return dict(sorted(current.items(), key=lambda kv: self.rank(kv[0])))
+    
+    def rank(self, file_path):
+        """Sort key: root order, depth, path"""
+        for i, folder in enumerate(self.folders):
+            if file_path.startswith(folder + os.sep):
+                rel = file_path[len(folder) + 1:]
+                return (i, rel.count(os.sep), rel.lower())
+        return (len(self.folders), 0, file_path.lower())
+    
+    def build_matcher(self):
+        by_name = {}
+        for file_path in self.snapshot:
+            by_name.setdefault(get_file_base_name(os.path.basename(file_path)), file_path)
+        shadowed = len(self.snapshot) - len(by_name)
+        if shadowed:
+            print(f"[LIBRARY] {os.path.basename(self.folder)}: {shadowed} duplicate names (first match wins)")
+        return NameMatcher([(path, name) for name, path in by_name.items()], '')
+    
+    def refresh(self):
+        """
+        Pick up changes on disk
+        Returns: {'added': [...], 'removed': [...], 'modified': [...]} of full
+        paths, or None if nothing changed
+        """
+        with self.lock:
+            current = self.walk()
+            added = [f for f in current if f not in self.snapshot]
+            removed = [f for f in self.snapshot if f not in current]
+            modified = [f for f in current if f in self.snapshot and current[f] != self.snapshot[f]]
+            if not (added or removed or modified):
+                return None
+            
+            self.snapshot = current
+            if added or removed:
+                self.matcher = self.build_matcher()
+        
+        print(f"[WATCH] {os.path.basename(self.folder)}/: +{len(added)} -{len(removed)} ~{len(modified)}")
+        return {'added': added, 'removed': removed, 'modified': modified}
+
+class FolderWatcher:
+    """
+    Polling watcher for FolderIndex objects (headless, or wherever native
+    file notifications are unavailable)
+    on_change(index, changes) is called from the watcher thread
+    """
+    
+    def __init__(self, indexes, on_change, interval=FOLDER_POLL_INTERVAL):
+        self.indexes = list(indexes)
+        self.on_change = on_change
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._loop, name='whisk-watch', daemon=True)
+    
+    def _loop(self):
+        while not self.stopped.wait(self.interval):
+            for index in self.indexes:
+                changes = index.refresh()
+                if changes:
+                    try:
+                        self.on_change(index, changes)
+                    except Exception as e:
+                        print(f"[WATCH] Update failed: {e}")
+    
+    def start(self):
+        self.thread.start()
+        return self
+    
+    def stop(self):
+        self.stopped.set()
+
+def changed_paths(changes):
+    """Paths whose old contents are gone (removed or modified)"""
+    return changes['removed'] + changes['modified'] if changes else []
+
+# ==================== API UTILITIES ====================
+
+def parse_cookie_input(raw):
+    """Parse various cookie formats"""
+    raw = raw.strip()
+    if not raw:
+        return ''
+    
+    # JSON format
+    if raw.startswith('[') or raw.startswith('{'):
+        try:
+            data = json.loads(raw)
+            if isinstance(data, dict):
+                data = [data]
+            cookies = [f"{c['name']}={c['value']}" for c in data if 'name' in c and 'value' in c]
+            if cookies:
+                return '; '.join(cookies)
+        except:
+            pass
+    
+    # JWT token
+    if raw.startswith('ey'):
+        return f'__Secure-next-auth.session-token={raw}'
+    
+    return raw
+
+def sha256_file(file_path):
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def prepare_reference(file_path, digest=None):
+    """
+    Upload copy of a reference image: EXIF-rotated, downscaled to
+    REF_MAX_SIDE, metadata stripped, re-encoded (JPEG, or PNG with alpha)
+    Cached in REF_CACHE_DIR by source hash (digest: precomputed SHA-256)
+    Returns: path to upload — the original when Pillow is missing,
+    decoding fails or the copy would not be smaller
+    """
+    if Image is None or not REF_PREPROCESS:
+        return file_path
+    
+    try:
+        base = os.path.join(REF_CACHE_DIR, f'{digest or sha256_file(file_path)}_{REF_MAX_SIDE}')
+        for ext in ('.jpg', '.png', '.orig'):
+            if os.path.exists(base + ext):
+                METRICS.count('cache_hits', cache='ref')
+                touch(base + ext)   # keep in-use copies from being pruned
+                return file_path if ext == '.orig' else base + ext
+        
+        METRICS.count('cache_misses', cache='ref')
+        os.makedirs(REF_CACHE_DIR, exist_ok=True)
+        with METRICS.span('preprocess'), Image.open(file_path) as im:
+            im = ImageOps.exif_transpose(im)
+            im.thumbnail((REF_MAX_SIDE, REF_MAX_SIDE), Image.LANCZOS)
+            if im.mode in ('RGBA', 'LA') or (im.mode == 'P' and 'transparency' in im.info):
+                ext, fmt, options = '.png', 'PNG', {'optimize': True}
+                im = im.convert('RGBA')
+            else:
+                ext, fmt, options = '.jpg', 'JPEG', {'quality': REF_JPEG_QUALITY, 'optimize': True}
+                im = im.convert('RGB')
+            # Own temp file: two workers may prepare the same source at once
+            fd, tmp = tempfile.mkstemp(prefix='.', suffix=ext + '.tmp', dir=REF_CACHE_DIR)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    im.save(f, fmt, **options)   # no exif/icc passed → stripped
+                
+                before, after = os.path.getsize(file_path), os.path.getsize(tmp)
+                if after >= before:
+                    open(base + '.orig', 'w').close()   # remember: original is smallest
+                    return file_path
+                
+                os.replace(tmp, base + ext)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        print(f"[PREP] {os.path.basename(file_path)}: {before // 1024} KB → {after // 1024} KB")
+        return base + ext
+    except Exception as e:
+        print(f"[PREP] {os.path.basename(file_path)}: {e} (uploading original)")
+        return file_path
+
+def touch(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def prune_ref_cache(max_age=REF_CACHE_MAX_AGE):
+    """Delete upload copies (and leftover temp files) not used for max_age seconds"""
+    now = time.time()
+    try:
+        entries = list(os.scandir(REF_CACHE_DIR))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if now - entry.stat().st_mtime > max_age:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+def image_data_uri(file_path, digest=None):
+    """Read image file (preprocessed upload copy) → base64 data URI"""
+    file_path = prepare_reference(file_path, digest)
+    with open(file_path, 'rb') as f:
+        b64 = base64.b64encode(f.read()).decode('utf-8')
+    
+    # Detect MIME
+    ext = os.path.splitext(file_path)[1].lower()
+    if '.png' in ext:
+        mime = 'image/png'
+    elif '.webp' in ext:
+        mime = 'image/webp'
+    else:
+        mime = 'image/jpeg'
+    
+    return f'data:{mime};base64,{b64}'
+
+def set_api_base(base):
+    """
+    Send every API call to another host, keeping the endpoint paths
+    (local mock server, see whisk_mock.py / whisk_bench.py)
+    """
+    base = base.rstrip('/')
+    for name in API_ENDPOINTS:
+        url = globals()[name]
+        globals()[name] = base + url[url.index('/', url.index('//') + 2):]
+    print(f"[API] Using {base}")
+
+if os.getenv('AUTOWHISK_API_BASE'):
+    set_api_base(os.environ['AUTOWHISK_API_BASE'])
+
+def whisk_headers(cookie_str, token):
+    return {
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'application/json',
+        'User-Agent': USER_AGENT,
+        'Origin': 'https://labs.google',
+        'Referer': 'https://labs.google/fx/tools/whisk',
+        'Cookie': parse_cookie_input(cookie_str)
+    }
+
+class WhiskClient:
+    """
+    Shared HTTP client for all Whisk/Labs API calls
+    - One requests.Session with keep-alive pools (one pool per host,
+      up to pool_size connections each) reused by every thread
+    - Cookie is parsed and auth headers built once, rebuilt only by set_token
+    """
+    
+    def __init__(self, cookie_str, token='', pool_size=HTTP_POOL_SIZE):
+        self.cookie_str = cookie_str
+        self.cookie = parse_cookie_input(cookie_str)
+        self.pool_size = pool_size
+        
+        self.session = requests.Session()
+        # Cookies are sent explicitly; never let responses mutate shared state
+        self.session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        
+        self.set_token(token)
+    
+    def set_token(self, token):
+        self.token = token
+        self.headers = whisk_headers(self.cookie_str, token)
+    
+    @property
+    def cookie_headers(self):
+        """Headers for the cookie → token exchange"""
+        return {'Cookie': self.cookie, 'User-Agent': USER_AGENT}
+    
+    def post(self, url, **kwargs):
+        kwargs.setdefault('headers', self.headers)
+        return self.session.post(url, **kwargs)
+    
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+    
+    def close(self):
+        self.session.close()
+
+def fetch_access_token(client):
+    """
+    Exchange the session cookie for an access token
+    Returns: (token, exp) – ('', 0) on failure, exp 0 if unknown
+    """
+    try:
+        r = client.get(API_AUTH_SESSION, headers=client.cookie_headers, timeout=20)
+        
+        if r.status_code != 200:
+            return ('', 0)
+        
+        token = r.json().get('access_token') or r.json().get('accessToken')
+        if not token:
+            return ('', 0)
+        
+        # Get expiry
+        try:
+            ri = client.get(f'{API_TOKEN_INFO}?access_token={token}', timeout=10)
+            exp = int(ri.json().get('exp', 0)) if ri.status_code == 200 else 0
+            return (token, exp)
+        except:
+            return (token, 0)
+            
+    except:
+        return ('', 0)
+
+def request_caption(data_uri, category, client, sess_id):
+    """backbone.captionImage → caption text ('' on any failure)"""
+    try:
+        with METRICS.span('caption', bytes=len(data_uri)) as span:
+            r = client.post(
+                API_CAPTION_IMAGE,
+                json={
+                    'json': {
+                        'clientContext': {'workflowId': '', 'sessionId': sess_id},
+                        'captionInput': {
+                            'candidatesCount': 1,
+                            'mediaInput': {
+                                'mediaCategory': category,
+                                'rawBytes': data_uri
+                            }
+                        }
+                    }
+                },
+                timeout=40
+            )
+            span['status'] = r.status_code
+        count_response(API_CAPTION_IMAGE, r)
+        if r.status_code == 200:
+            cands = r.json().get('result', {}).get('data', {}).get('json', {}).get('result', {}).get('candidates', [])
+            if cands:
+                return cands[0].get('output', '')
+    except:
+        pass
+    return ''
+
+def caption_image(file_path, category, client, digest=None):
+    """Caption a local image on demand. Returns: caption ('' on failure)"""
+    if not os.path.exists(file_path):
+        return ''
+    try:
+        data_uri = image_data_uri(file_path, digest)
+    except OSError:
+        return ''
+    sess_id = f';{int(datetime.now().timestamp() * 1000)}'
+    return request_caption(data_uri, category, client, sess_id)
+
+def upload_payload(category, data_uri, sess_id):
+    return {
+        'json': {
+            'clientContext': {'workflowId': '', 'sessionId': sess_id},
+            'uploadMediaInput': {
+                'mediaCategory': category,
+                'rawBytes': data_uri
+            }
+        }
+    }
+
+def upload_media_id(data):
+    """uploadImage response JSON → uploadMediaGenerationId (or None)"""
+    return data.get('result', {}).get('data', {}).get('json', {}).get('result', {}).get('uploadMediaGenerationId')
+
+def upload_image_to_google(file_path, category, client, with_caption=False, digest=None):
+    """
+    Upload image to Google Labs
+    with_caption: also run captionImage, in parallel with the upload
+    (callers that only need the media ID should leave it off)
+    digest: SHA-256 of the file, if known (preprocessing cache key)
+    Returns: (media_id, caption, error)
+    """
+    if not os.path.exists(file_path):
+        return (None, '', 'File not found')
+    
+    try:
+        data_uri = image_data_uri(file_path, digest)
+        sess_id = f';{int(datetime.now().timestamp() * 1000)}'
+        
+        # Get caption (optional, overlapped with the upload)
+        caption_future = None
+        caption_pool = None
+        if with_caption:
+            caption_pool = ThreadPoolExecutor(max_workers=1)
+            caption_future = caption_pool.submit(request_caption, data_uri, category, client, sess_id)
+        
+        try:
+            # Upload
+            with METRICS.span('upload', file=os.path.basename(file_path), bytes=len(data_uri)) as span:
+                r = post_with_retry(
+                    API_UPLOAD_IMAGE,
+                    client=client,
+                    json=upload_payload(category, data_uri, sess_id),
+                    timeout=60
+                )
+                span['status'] = r.status_code
+        finally:
+            caption = caption_future.result() if caption_future else ''
+            if caption_pool:
+                caption_pool.shutdown(wait=False)
+        
+        if r.status_code != 200:
+            return (None, '', f'HTTP {r.status_code}')
+        
+        mid = upload_media_id(r.json())
+        if mid:
+            return (mid, caption, None)
+        
+        return (None, '', 'No media ID')
+        
+    except Exception as e:
+        return (None, '', str(e))
+
+
+# ==================== MEDIA CACHE ====================
+
+def account_key(cookie_str):
+    """Stable short ID for the account behind a cookie (upload IDs are account-scoped)"""
+    cookie = parse_cookie_input(cookie_str)
+    m = re.search(r'__Secure-next-auth\.session-token=([^;]+)', cookie)
+    return hashlib.sha256((m.group(1) if m else cookie).encode('utf-8')).hexdigest()[:16]
+
+class MediaCache:
+    """
+    Persistent media-ID cache for uploaded reference images
+    - Key: account + category + SHA-256 of file contents
+    - Entries expire after MEDIA_CACHE_TTL
+    - Editing a file changes its hash, so stale IDs are never reused
+    - Files are hashed outside the lock; new entries are written at most
+      every MEDIA_CACHE_FLUSH_INTERVAL, the rest by flush() (engine end)
+    """
+    
+    def __init__(self, path=MEDIA_CACHE_FILE, ttl=MEDIA_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        self.hash_memo = {}   # file_path → (mtime_ns, size, sha256)
+        self.lock = threading.Lock()        # entries / dirty
+        self.save_lock = threading.Lock()   # one writer of the cache file
+        self.dirty = False
+        self.saved_at = 0.0
+        self.load()
+    
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            now = time.time()
+            self.entries = {k: v for k, v in data.items() if now - v.get('created', 0) < self.ttl}
+        except:
+            self.entries = {}
+    
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                data = dict(self.entries)
+                self.dirty = False
+                self.saved_at = time.monotonic()
+            tmp = self.path + '.tmp'
+            try:
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump(data, f)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                print(f"[CACHE] Save failed: {e}")
+    
+    def flush(self):
+        """Write entries added since the last save"""
+        if self.dirty:
+            self.save()
+    
+    def changed(self):
+        """Entries were modified (call with lock held). Returns: True if a save is due now"""
+        self.dirty = True
+        return time.monotonic() - self.saved_at >= MEDIA_CACHE_FLUSH_INTERVAL
+    
+    def file_hash(self, file_path):
+        """SHA-256 of file contents, re-read only when mtime/size change"""
+        st = os.stat(file_path)
+        memo = self.hash_memo.get(file_path)
+        if memo and memo[0] == st.st_mtime_ns and memo[1] == st.st_size:
+            return memo[2]
+        
+        digest = sha256_file(file_path)
+        self.hash_memo[file_path] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+    
+    def key(self, file_path, category, account):
+        return f'{account}:{category}:{self.file_hash(file_path)}'
+    
+    def get(self, file_path, category, account):
+        """Returns: (media_id, caption) or None"""
+        key = self.key(file_path, category, account)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry.get('created', 0) >= self.ttl:
+                del self.entries[key]
+                entry = None
+        METRICS.count('cache_hits' if entry else 'cache_misses', cache='media')
+        return (entry['media_id'], entry.get('caption', '')) if entry else None
+    
+    def has(self, file_path, category, account):
+        """True if a live entry exists (no upload needed); not counted as a hit/miss"""
+        try:
+            key = self.key(file_path, category, account)
+        except OSError:
+            return False
+        with self.lock:
+            entry = self.entries.get(key)
+        return bool(entry) and time.time() - entry.get('created', 0) < self.ttl
+    
+    def put(self, file_path, category, account, media_id, caption=''):
+        key = self.key(file_path, category, account)
+        with self.lock:
+            self.entries[key] = {
+                'media_id': media_id,
+                'caption': caption,
+                'file': os.path.basename(file_path),
+                'created': time.time()
+            }
+            due = self.changed()
+        if due:
+            self.save()
+    
+    def set_caption(self, file_path, category, account, caption):
+        key = self.key(file_path, category, account)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                entry['caption'] = caption
+            due = entry is not None and self.changed()
+        if due:
+            self.save()
+    
+    def forget(self, file_paths):
+        """
+        Drop memoized hashes of removed/modified files (folder watcher)
+        Entries stay: they are keyed by content, so a file that is renamed
+        or restored still hits
+        """
+        with self.lock:
+            for file_path in file_paths:
+                self.hash_memo.pop(file_path, None)
+
+
+def upload_cached(file_path, category, client, cache, with_caption=False):
+    """
+    upload_image_to_google through a MediaCache
+    with_caption: make sure a caption is available; on a cache hit without
+    one it is fetched lazily and stored with the entry
+    Returns: (media_id, caption, error)
+    """
+    if not os.path.exists(file_path):
+        return (None, '', 'File not found')
+    
+    account = account_key(client.cookie_str)
+    hit = cache.get(file_path, category, account)
+    if hit:
+        print(f"[CACHE] {os.path.basename(file_path)} → {hit[0][:12]}...")
+        mid, cap = hit
+        if with_caption and not cap:
+            cap = caption_image(file_path, category, client, cache.file_hash(file_path))
+            if cap:
+                cache.set_caption(file_path, category, account, cap)
+        return (mid, cap, None)
+    
+    mid, cap, err = upload_image_to_google(file_path, category, client, with_caption, cache.file_hash(file_path))
+    if mid:
+        cache.put(file_path, category, account, mid, cap)
+    return (mid, cap, err)
+
+
+# ==================== RATE LIMITING ====================
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket shared by all generation slots
+    - Refill rate creeps up while requests succeed (additive increase)
+    - Halves on 429/503 and honours Retry-After (multiplicative decrease)
+    """
+    
+    def __init__(self, rate=RATE_INITIAL, min_rate=RATE_MIN, max_rate=RATE_MAX, burst=RATE_BURST):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+    
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+    
+    def try_acquire(self):
+        """Take a token if available. Returns: 0 if taken, else seconds to wait."""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now >= self.blocked_until and self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return max(self.blocked_until - now, (1 - self.tokens) / self.rate, 0.01)
+    
+    def acquire(self, should_continue=lambda: True):
+        """Block until a request may be sent. Returns False if cancelled."""
+        while should_continue():
+            wait = self.try_acquire()
+            if not wait:
+                return True
+            time.sleep(min(wait, 0.5))
+        return False
+    
+    async def acquire_async(self, should_continue=lambda: True):
+        """acquire() for the asyncio engine"""
+        while should_continue():
+            wait = self.try_acquire()
+            if not wait:
+                return True
+            await asyncio.sleep(min(wait, 0.5))
+        return False
+    
+    def on_success(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate + RATE_STEP)
+    
+    def on_throttle(self, retry_after=None):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate * 0.5)
+            self.tokens = 0.0
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+        print(f"[RATE] Throttled → {self.rate:.2f} req/s" + (f", retry after {retry_after:.1f}s" if retry_after else ''))
+
+
+def parse_retry_after(value):
+    """Retry-After header (seconds or HTTP date) → seconds, or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+def sleep_while(seconds, should_continue=lambda: True):
+    """Sleep in short steps so stop requests are honoured"""
+    end = time.monotonic() + seconds
+    while should_continue():
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            return True
+        time.sleep(min(remaining, 0.5))
+    return False
+
+def api_call(url):
+    """Metric label of an endpoint: 'backbone.uploadImage', 'whisk:runImageRecipe', ..."""
+    return url.rsplit('/', 1)[-1]
+
+def count_response(url, r):
+    """Status and request/response body sizes of one requests call"""
+    METRICS.count('responses', status=r.status_code, call=api_call(url))
+    request = getattr(r, 'request', None)
+    METRICS.count('bytes_sent', len(getattr(request, 'body', None) or b''), call=api_call(url))
+    METRICS.count('bytes_received', len(r.content or b''), call=api_call(url))
+
+def post_with_retry(url, limiter=None, should_continue=lambda: True, client=None, **kwargs):
+    """
+    POST (through client if given) with automatic retry of transient
+    failures (TRANSIENT_STATUS, connection errors, timeouts)
+    Returns: final response (may be non-200), or None if cancelled
+    """
+    attempt = 0
+    while True:
+        if limiter:
+            with METRICS.span('rate_wait'):
+                if not limiter.acquire(should_continue):
+                    return None
+        
+        retry_after = None
+        try:
+            r = client.post(url, **kwargs) if client else requests.post(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= MAX_RETRIES:
+                raise
+            reason = type(e).__name__
+            METRICS.count('responses', status=reason, call=api_call(url))
+        else:
+            count_response(url, r)
+            if r.status_code not in TRANSIENT_STATUS:
+                if limiter and r.status_code == 200:
+                    limiter.on_success()
+                return r
+            
+            retry_after = parse_retry_after(r.headers.get('Retry-After'))
+            if limiter and r.status_code in (429, 503):
+                limiter.on_throttle(retry_after)
+            if attempt >= MAX_RETRIES:
+                return r
+            reason = f'HTTP {r.status_code}'
+        
+        delay = retry_after if retry_after is not None else backoff_delay(attempt)
+        attempt += 1
+        METRICS.count('retries', reason=reason)
+        print(f"[RETRY] {reason} → attempt {attempt}/{MAX_RETRIES} in {delay:.1f}s")
+        if not sleep_while(delay, should_continue):
+            return None
+
+
+# ==================== ACCOUNTS ====================
+
+class Account:
+    """
+    One Whisk account of an AccountPool
+    - Own HTTP client (cookie + token) and rate limiter
+    - Daily image quota; media IDs stay account-scoped through account_key()
+    """
+    
+    def __init__(self, cookie_str, token='', exp=0, quota=ACCOUNT_DAILY_QUOTA, used=0, day='',
+                 client=None, limiter=None, pool_size=HTTP_POOL_SIZE):
+        self.cookie_str = cookie_str
+        self.key = account_key(cookie_str)
+        self.client = client or WhiskClient(cookie_str, token, pool_size)
+        if token and self.client.token != token:
+            self.client.set_token(token)
+        self.exp = exp
+        self.limiter = limiter or AdaptiveRateLimiter()
+        self.quota = quota
+        self.used = used
+        self.day = day
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.error = ''
+        self.retry_at = 0.0            # next refresh attempt after a failure
+        self.lock = threading.Lock()   # one token exchange at a time
+    
+    @property
+    def token(self):
+        return self.client.token
+    
+    @property
+    def label(self):
+        return self.key[:8]
+    
+    def remaining(self):
+        """Returns: images left today (inf without a quota)"""
+        today = time.strftime('%Y-%m-%d')
+        if self.day != today:
+            self.day, self.used = today, 0
+        return self.quota - self.used if self.quota else float('inf')
+    
+    def usable(self, now):
+        return not self.error and now >= self.cooldown_until and self.remaining() > self.in_flight
+    
+    def score(self):
+        """Fewest requests in flight first, then most quota left"""
+        return (-self.in_flight, self.remaining() - self.in_flight)
+    
+    def needs_refresh(self, margin=TOKEN_REFRESH_MARGIN):
+        return not self.token or bool(self.exp and self.exp - time.time() < margin)
+    
+    def refresh(self):
+        """
+        Cookie → token exchange (skipped if another thread just did it)
+        Returns: True if the account has a usable token
+        """
+        with self.lock:
+            if not self.needs_refresh():
+                self.error = ''
+                return True
+            token, exp = fetch_access_token(self.client) if self.cookie_str else ('', 0)
+            if not token:
+                self.error = 'Token refresh failed'
+                self.retry_at = time.time() + AUTH_RETRY_INTERVAL
+                print(f"[AUTH] {self.label}: token refresh failed")
+                return False
+            # Hot swap: WhiskClient headers are read per request attempt
+            self.client.set_token(token)
+            self.exp = exp
+            self.error = ''
+            print(f"[AUTH] {self.label}: token refreshed (expires {time.strftime('%H:%M', time.localtime(exp)) if exp else 'unknown'})")
+            return True
+    
+    def to_dict(self):
+        return {'cookie': self.cookie_str, 'token': self.token, 'exp': self.exp,
+                'quota': self.quota, 'used': self.used, 'day': self.day}
+
+
+class AccountPool:
+    """
+    Accounts sharing one batch
+    - acquire() spreads requests over the usable accounts (fewest in
+      flight, then most quota left)
+    - A final 429 rests an account for ACCOUNT_COOLDOWN, a 401 marks its
+      token for refresh
+    - Persisted in ACCOUNTS_FILE (cookie, token, expiry, quota usage)
+    """
+    
+    def __init__(self, accounts=(), path=None):
+        self.accounts = list(accounts)
+        self.path = path
+        self.lock = threading.Lock()
+    
+    @classmethod
+    def load(cls, path=ACCOUNTS_FILE, pool_size=HTTP_POOL_SIZE):
+        entries = []
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    entries = json.load(f)
+            except:
+                entries = []
+        accounts = [Account(e['cookie'], e.get('token', ''), e.get('exp', 0), e.get('quota', ACCOUNT_DAILY_QUOTA),
+                            e.get('used', 0), e.get('day', ''), pool_size=pool_size)
+                    for e in entries if e.get('cookie')]
+        return cls(accounts, path)
+    
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = [account.to_dict() for account in self.accounts]
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"[ACCOUNTS] Save failed: {e}")
+    
+    def __len__(self):
+        return len(self.accounts)
+    
+    def __iter__(self):
+        return iter(list(self.accounts))
+    
+    def add(self, cookie_str, token='', exp=0, client=None):
+        """Add an account, or update the token of a known one. Returns: the Account"""
+        key = account_key(cookie_str)
+        with self.lock:
+            account = next((a for a in self.accounts if a.key == key), None)
+            if account is None:
+                account = Account(cookie_str, client=client)
+                self.accounts.append(account)
+            elif client is not None:
+                account.client = client
+            if token and (token != account.token or exp):
+                account.client.set_token(token)
+                account.exp = exp
+                account.error = ''
+        return account
+    
+    def remove(self, key):
+        with self.lock:
+            self.accounts = [a for a in self.accounts if a.key != key]
+    
+    def acquire(self):
+        """Returns: the account for the next request (counted in flight), or None"""
+        with self.lock:
+            now = time.time()
+            candidates = [a for a in self.accounts if a.usable(now)]
+            if not candidates:
+                return None
+            account = max(candidates, key=Account.score)
+            account.in_flight += 1
+            return account
+    
+    def release(self, account, status=None):
+        """status: final HTTP status of the request (None if it was not sent)"""
+        with self.lock:
+            account.in_flight -= 1
+            if status == 200:
+                account.remaining()
+                account.used += 1
+            elif status == 429:
+                account.cooldown_until = time.time() + ACCOUNT_COOLDOWN
+                print(f"[ACCOUNTS] {account.label}: rate limited, resting {ACCOUNT_COOLDOWN // 60} min")
+            elif status == 401:
+                account.exp = 1   # due for refresh on its next acquire
+    
+    def cooling(self):
+        """True if some account is only resting (it will be usable again)"""
+        now = time.time()
+        return any(not a.error and a.cooldown_until > now for a in self.accounts)
+    
+    def failed(self):
+        """True if some account is out because its token could not be refreshed"""
+        return any(a.error for a in self.accounts)
+    
+    def busy(self):
+        return any(a.in_flight for a in self.accounts)
+    
+    def in_flight(self):
+        return sum(a.in_flight for a in self.accounts)
+    
+    def usable(self):
+        now = time.time()
+        with self.lock:
+            return any(a.usable(now) for a in self.accounts)
+    
+    def refresh_due(self):
+        """
+        Refresh tokens close to expiry; retry failed refreshes every
+        AUTH_RETRY_INTERVAL
+        Returns: True if a failed account recovered
+        """
+        recovered = False
+        for account in self:
+            if account.error:
+                if time.time() >= account.retry_at and account.refresh():
+                    recovered = True
+            elif account.needs_refresh():
+                account.refresh()
+        return recovered
+
+
+# ==================== BATCH PLANNING ====================
+
+def as_matcher(folder_files, folder):
+    """NameMatcher for a scan_folder() list (matchers pass through)"""
+    return folder_files if isinstance(folder_files, NameMatcher) else NameMatcher(folder_files, folder)
+
+def plan_prompt(prompt, karakter_files, mekan_files, stil_file=None, stil_files=None):
+    """
+    Resolve which reference files a prompt needs
+    stil_files: optional STIL name index; a style named in the prompt
+    replaces the default stil_file
+    Returns: plan dict
+        karakter/mekan: matched file paths (max 1 scene)
+        stil: style file or None
+        stil_ref: path of a style named in the prompt (uploaded with the plan), or None
+        model: imageModel for runImageRecipe, None for plain generateImage
+        endpoint: generation URL
+    """
+    karakter_files = as_matcher(karakter_files, KARAKTER_FOLDER)
+    mekan_files = as_matcher(mekan_files, MEKAN_FOLDER)
+    karakter_matches = [os.path.join(karakter_files.folder, f) for f in karakter_files.match(prompt)]
+    mekan_matches = [os.path.join(mekan_files.folder, f) for f in mekan_files.match(prompt)]
+    
+    # Limit to 1 scene
+    if len(mekan_matches) > 1:
+        print(f"[INFO] Multiple scenes matched, using first: {os.path.basename(mekan_matches[0])}")
+        mekan_matches = mekan_matches[:1]
+    
+    # Named style (max 1)
+    stil_ref = None
+    if stil_files is not None:
+        stil_files = as_matcher(stil_files, STIL_FOLDER)
+        stil_matches = [os.path.join(stil_files.folder, f) for f in stil_files.match(prompt)]
+        if stil_matches:
+            stil_file = stil_ref = stil_matches[0]
+    
+    ref_count = len(karakter_matches) + len(mekan_matches) + (1 if stil_file else 0)
+    return {
+        'prompt': prompt,
+        'karakter': karakter_matches,
+        'mekan': mekan_matches,
+        'stil': stil_file,
+        'stil_ref': stil_ref,
+        'model': ('GEM_PIX' if ref_count == 1 else 'R2I') if ref_count else None,
+        'endpoint': API_RUN_RECIPE if ref_count else API_GENERATE_IMAGE
+    }
+
+def plan_files(plan):
+    """Returns: [(file_path, category)] a plan needs uploaded (KARAKTER/MEKAN, named STIL)"""
+    files = [(path, 'MEDIA_CATEGORY_SUBJECT') for path in plan['karakter']]
+    files += [(path, 'MEDIA_CATEGORY_SCENE') for path in plan['mekan']]
+    if plan.get('stil_ref'):
+        files.append((plan['stil_ref'], 'MEDIA_CATEGORY_STYLE'))
+    return files
+
+def reference_set(plan):
+    """Returns: hashable key of the references a plan uploads (prompts sharing it share media IDs)"""
+    return tuple(plan_files(plan))
+
+def build_plan(prompts, karakter_files, mekan_files, stil_file=None, stil_files=None):
+    """
+    Plan every prompt of a batch up front
+    Returns: {prompt: plan}
+    """
+    plans = {}
+    with METRICS.span('match', prompts=len(prompts)):
+        for prompt in prompts:
+            if prompt not in plans:
+                plans[prompt] = plan_prompt(prompt, karakter_files, mekan_files, stil_file, stil_files)
+    
+    unique = {fc for plan in plans.values() for fc in plan_files(plan)}
+    no_refs = sum(1 for plan in plans.values() if not plan['karakter'] and not plan['mekan'])
+    print(f"[PLAN] {len(plans)} prompts, {len(unique)} unique references, {no_refs} without KARAKTER/MEKAN matches")
+    return plans
+
+def describe_plan(plan):
+    """Short one-line summary for the UI"""
+    parts = [f'👤 {os.path.splitext(os.path.basename(f))[0]}' for f in plan['karakter']]
+    parts += [f'🏞 {os.path.splitext(os.path.basename(f))[0]}' for f in plan['mekan']]
+    if plan['stil']:
+        parts.append(f"🎨 {os.path.splitext(os.path.basename(plan['stil']))[0]}")
+    return ' · '.join(parts) if parts else '— no references'
+
+def upload_references(files, client, media_cache, should_continue=lambda: True,
+                      workers=UPLOAD_CONCURRENCY):
+    """
+    Upload a set of (file_path, category) in parallel through the media cache
+    Returns: {(file_path, category): error} for failed uploads
+    """
+    errors = {}
+    files = list(dict.fromkeys(files))
+    if not files:
+        return errors
+    
+    def upload(fc):
+        if not should_continue():
+            return fc, 'Stopped'
+        mid, cap, err = upload_cached(fc[0], fc[1], client, media_cache)
+        return fc, None if mid else err
+    
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='whisk-upload') as pool:
+        for fc, err in pool.map(upload, files):
+            if err:
+                errors[fc] = err
+                print(f"[UPLOAD] ❌ {os.path.basename(fc[0])}: {err}")
+    
+    print(f"[UPLOAD] {len(files) - len(errors)}/{len(files)} references ready")
+    return errors
+
+
+# ==================== OUTPUT WRITER ====================
+
+def write_b64_atomic(b64, filepath):
+    """
+    Decode base64 into filepath without a full decoded copy in memory
+    - Decodes B64_CHUNK characters at a time into a temp file
+    - fsyncs, then renames into place (no half-written images)
+    """
+    if '\n' in b64 or ' ' in b64:
+        b64 = ''.join(b64.split())  # chunking needs an unbroken base64 string
+    
+    fd, tmp = tempfile.mkstemp(prefix='.', suffix='.part', dir=os.path.dirname(filepath) or '.')
+    try:
+        with METRICS.span('write', bytes=len(b64) * 3 // 4), os.fdopen(fd, 'wb') as f:
+            for start in range(0, len(b64), B64_CHUNK):
+                f.write(base64.b64decode(b64[start:start + B64_CHUNK]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filepath)
+    except:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+class ImageWriter:
+    """
+    Background I/O thread for generated images
+    submit() returns immediately; on_done(error) runs on the writer
+    thread once the file is in place (error is None on success)
+    """
+    
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, name='whisk-writer', daemon=True)
+        self.thread.start()
+    
+    def _loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            b64, filepath, on_done = job
+            del job
+            try:
+                write_b64_atomic(b64, filepath)
+                error = None
+            except Exception as e:
+                error = e
+            del b64
+            on_done(error)
+    
+    def submit(self, b64, filepath, on_done):
+        self.jobs.put((b64, filepath, on_done))
+    
+    def close(self):
+        """Finish pending writes and stop the thread"""
+        self.jobs.put(None)
+        self.thread.join()
+
+
+# ==================== JOB JOURNAL ====================
+
+class JobJournal:
+    """
+    Append-only JSONL journal of one generation batch
+    - First line: batch header (prompts, settings, output dir, image count)
+    - Then one line per state change of a (row, image index):
+      inflight (seed) / done (path, seed) / failed (error)
+    - Every (row, index) without a 'done' record is pending
+    Replaying the file after a crash gives exactly the missing work.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.prompts = []
+        self.states = {}    # (row, index) → last task record
+        self.done = set()   # (row, index)
+        self.complete = False
+        self.file = None
+        self.unsynced = 0
+        self.lock = threading.Lock()
+    
+    @classmethod
+    def create(cls, prompts, settings, output_dir, num_images, directory=JOURNAL_DIR):
+        os.makedirs(directory, exist_ok=True)
+        batch_id = datetime.now().strftime('%Y%m%d_%H%M%S_') + f'{random.randint(0, 0xffff):04x}'
+        journal = cls(os.path.join(directory, f'job_{batch_id}.jsonl'))
+        journal.write({
+            'type': 'batch',
+            'id': batch_id,
+            'created': time.time(),
+            'prompts': list(prompts),
+            'settings': settings,
+            'output_dir': output_dir,
+            'num_images': num_images
+        })
+        return journal
+    
+    @classmethod
+    def load(cls, path):
+        journal = cls(path)
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue   # torn last line after a crash
+                journal.apply(record)
+        if not journal.header:
+            raise ValueError(f'Not a job journal: {path}')
+        return journal
+    
+    @staticmethod
+    def find_unfinished(directory=JOURNAL_DIR):
+        """Newest journal that still has missing images, or None"""
+        if not os.path.isdir(directory):
+            return None
+        names = sorted((n for n in os.listdir(directory) if n.startswith('job_') and n.endswith('.jsonl')), reverse=True)
+        for name in names[:JOURNAL_SCAN_LIMIT]:
+            try:
+                journal = JobJournal.load(os.path.join(directory, name))
+            except (OSError, ValueError):
+                continue
+            if not journal.complete and journal.missing():
+                return journal
+        return None
+    
+    # --- batch header ---
+    
+    @property
+    def settings(self):
+        return self.header['settings']
+    
+    @property
+    def output_dir(self):
+        return self.header['output_dir']
+    
+    @property
+    def num_images(self):
+        return self.header['num_images']
+    
+    @property
+    def total(self):
+        return len(self.prompts) * self.num_images
+    
+    # --- records ---
+    
+    def apply(self, record):
+        kind = record.get('type')
+        if kind == 'batch':
+            self.header = record
+            self.prompts = list(record['prompts'])
+        elif kind == 'prompt':
+            self.prompts[record['row']] = record['prompt']
+        elif kind == 'task':
+            key = (record['row'], record['index'])
+            self.states[key] = record
+            if record['state'] == 'done':
+                self.done.add(key)
+            else:
+                self.done.discard(key)
+        elif kind == 'complete':
+            self.complete = True
+    
+    def write(self, record):
+        with self.lock:
+            self.apply(record)
+            if self.file is None:
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.file.flush()
+            self.unsynced += 1
+            if self.unsynced >= JOURNAL_SYNC_EVERY:
+                os.fsync(self.file.fileno())
+                self.unsynced = 0
+    
+    def record(self, row, index, state, **info):
+        """state: 'inflight' | 'done' | 'failed'"""
+        self.write(dict(type='task', row=row, index=index, state=state, ts=time.time(), **info))
+        if state == 'done' and not self.complete and len(self.done) >= self.total:
+            self.write({'type': 'complete', 'ts': time.time()})
+    
+    def set_prompt(self, row, prompt):
+        """Record an edited (retried) prompt text for a row"""
+        if 0 <= row < len(self.prompts) and self.prompts[row] != prompt:
+            self.write({'type': 'prompt', 'row': row, 'prompt': prompt})
+    
+    # --- resume ---
+    
+    def done_images(self):
+        """Returns: [(row, index, path)] of finished images still on disk"""
+        result = []
+        for row, index in sorted(self.done):
+            path = self.states[(row, index)].get('path')
+            if path and os.path.exists(path):
+                result.append((row, index, path))
+        return result
+    
+    def missing(self):
+        """Returns: {row: [image indices]} still to generate"""
+        finished = {(row, index) for row, index, _ in self.done_images()}
+        missing = {}
+        for row in range(len(self.prompts)):
+            indices = [i for i in range(self.num_images) if (row, i) not in finished]
+            if indices:
+                missing[row] = indices
+        return missing
+    
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+
+
+# ==================== GENERATION ENGINE ====================
+
+class RowProgress:
+    """
+    Per-image state of every row, kept by the engine
+    - states: {row: bytearray} (one byte per image index)
+    - counts: {row: [idle, pending, done, failed]}, updated on each
+      transition so row status is O(1) for the UI
+    - totals: the same four counts over every row seen so far
+    """
+    IDLE, PENDING, DONE, FAILED = 0, 1, 2, 3
+    
+    def __init__(self, num_images):
+        self.num_images = num_images
+        self.states = {}
+        self.counts = {}
+        self.totals = [0, 0, 0, 0]
+        self.lock = threading.Lock()
+    
+    def set(self, row, index, state):
+        with self.lock:
+            self._set(row, index, state)
+    
+    def _set(self, row, index, state):
+        states = self.states.get(row)
+        if states is None:
+            states = self.states[row] = bytearray(self.num_images)
+            self.counts[row] = [self.num_images, 0, 0, 0]
+            self.totals[self.IDLE] += self.num_images
+        if not 0 <= index < len(states):
+            return
+        counts = self.counts[row]
+        counts[states[index]] -= 1
+        counts[state] += 1
+        self.totals[states[index]] -= 1
+        self.totals[state] += 1
+        states[index] = state
+    
+    def mark(self, row, indices, state):
+        with self.lock:
+            for index in indices:
+                self._set(row, index, state)
+    
+    def fail_pending(self, row):
+        """Reference preparation failed: every queued image of the row is lost"""
+        with self.lock:
+            for index, state in enumerate(self.states.get(row, ())):
+                if state == self.PENDING:
+                    self._set(row, index, self.FAILED)
+    
+    def reset_pending(self):
+        """Stopped: images that never finished go back to idle"""
+        with self.lock:
+            for row, states in self.states.items():
+                for index, state in enumerate(states):
+                    if state == self.PENDING:
+                        self._set(row, index, self.IDLE)
+    
+    def row(self, row):
+        """Returns: (done, failed, pending) image counts"""
+        counts = self.counts.get(row)
+        if counts is None:
+            return (0, 0, 0)
+        return (counts[self.DONE], counts[self.FAILED], counts[self.PENDING])
+    
+    def state(self, row, index):
+        states = self.states.get(row)
+        return states[index] if states is not None and 0 <= index < len(states) else self.IDLE
+    
+    def total(self):
+        """Returns: (done, failed, pending) image counts over all rows"""
+        totals = self.totals
+        return (totals[self.DONE], totals[self.FAILED], totals[self.PENDING])
+    
+    def missing(self, row):
+        """Returns: image indices still to generate (idle or failed)"""
+        with self.lock:
+            states = self.states.get(row)
+            if states is None:
+                return list(range(self.num_images))
+            return [i for i, state in enumerate(states) if state in (self.IDLE, self.FAILED)]
+
+
+class TaskScheduler(queue.Queue):
+    """
+    Task queue that hands out one image at a time
+    - put((row, prompt[, indices]), priority=...): lower levels go first:
+      RETRY (failed/401 images), BUMP (rows moved up by hand), WARM (rows
+      whose references are already uploaded), NORMAL
+    - Rows of a level take turns: get() returns (row, prompt, [index], key)
+      of the next row in rotation, so every prompt gets a first image early
+      and one row's uploads overlap other rows' generations
+    - group(prompt) (optional, see regroup): rows of a level are bucketed
+      by key and a bucket is worked through before the next one starts;
+      release(key) once per image get() handed out from it
+    - qsize() counts queued images; re-queuing a queued row merges indices
+    - Unbounded (maxsize is ignored)
+    """
+    RETRY, BUMP, WARM, NORMAL = 0, 1, 2, 3
+    
+    def __init__(self, num_images, warm=None, group=None):
+        self.num_images = num_images
+        self.warm = warm     # prompt → True if its references are cached (set by the engine)
+        self.group = group   # prompt → bucket key, None = one bucket (set by regroup)
+        self.on_get = None   # (row, index) as get() hands an image out, under the mutex (set by the engine)
+        super().__init__()
+    
+    def _init(self, maxsize):
+        # Per level: bucket key → {row → [prompt, deque of indices]} (both in arrival order)
+        self.levels = [collections.OrderedDict() for _ in range(4)]
+        self.where = {}   # row → (level, bucket key)
+        self.taken = collections.Counter()   # bucket key → images handed out, not released
+        self.size = 0
+    
+    def _qsize(self):
+        return self.size
+    
+    @property
+    def queue(self):
+        """Snapshot [(row, prompt, indices)] in hand-out order of buckets (call with mutex held)"""
+        return [(row, prompt, list(indices)) for level in self.levels for rows in level.values()
+                for row, (prompt, indices) in rows.items()]
+    
+    def _add(self, row, entry, level, key):
+        self.levels[level].setdefault(key, collections.OrderedDict())[row] = entry
+        self.where[row] = (level, key)
+    
+    def _remove(self, row):
+        level, key = self.where.pop(row)
+        rows = self.levels[level][key]
+        entry = rows.pop(row)
+        if not rows:
+            del self.levels[level][key]
+        return entry, level
+    
+    def put(self, item, block=True, timeout=None, priority=None):
+        row, prompt = item[0], item[1]
+        indices = list(item[2]) if len(item) > 2 else list(range(self.num_images))
+        if priority is None:
+            priority = self.WARM if self.warm and self.warm(prompt) else self.NORMAL
+        key = self.group(prompt) if self.group else None
+        
+        with self.not_full:
+            if row in self.where:
+                entry, level = self._remove(row)
+                entry[0] = prompt
+                priority = min(priority, level)
+            else:
+                entry = [prompt, collections.deque()]
+            self._add(row, entry, priority, key)
+            added = [i for i in dict.fromkeys(indices) if i not in entry[1]]
+            entry[1].extend(added)
+            self.size += len(added)
+            self.unfinished_tasks += len(added)
+            if added:
+                self.not_empty.notify(len(added))
+    
+    def _get(self):
+        for level in self.levels:
+            if level:
+                key, rows = next(iter(level.items()))
+                row, entry = rows.popitem(last=False)
+                index = entry[1].popleft()
+                if entry[1]:
+                    rows[row] = entry   # back of the rotation
+                else:
+                    self.where.pop(row)
+                    if not rows:
+                        level.popitem(last=False)
+                self.size -= 1
+                if self.group:
+                    self.taken[key] += 1
+                if self.on_get:
+                    self.on_get(row, index)
+                return (row, entry[0], [index], key)
+    
+    def regroup(self, group):
+        """Bucket rows by group(prompt) from now on, including those already queued"""
+        with self.mutex:
+            self.group = group
+            queued = [(row, self._remove(row)) for level in self.levels
+                      for rows in list(level.values()) for row in list(rows)]
+            for row, (entry, level) in queued:
+                self._add(row, entry, level, group(entry[0]) if group else None)
+    
+    def rewarm(self, warm):
+        """Use warm(prompt) from now on; NORMAL rows already queued move up if it holds"""
+        with self.mutex:
+            self.warm = warm
+            queued = {row: entry[0] for rows in self.levels[self.NORMAL].values() for row, entry in rows.items()}
+        cached = {prompt: warm(prompt) for prompt in set(queued.values())}   # may hash files: no mutex
+        with self.mutex:
+            for row, prompt in queued.items():
+                level, key = self.where.get(row, (None, None))
+                if cached[prompt] and level == self.NORMAL and self.levels[level][key][row][0] == prompt:
+                    self._add(row, self._remove(row)[0], self.WARM, key)
+    
+    def release(self, key):
+        """An image handed out from a bucket is finished. Returns: True if the bucket is now done"""
+        with self.mutex:
+            self.taken[key] -= 1
+            if self.taken[key] <= 0:
+                del self.taken[key]
+                return not any(key in level for level in self.levels)
+            return False
+    
+    def bump(self, row):
+        """Move a queued row ahead of normal work. Returns: True if it was queued"""
+        with self.mutex:
+            if row not in self.where:
+                return False
+            if self.where[row][0] > self.BUMP:
+                key = self.where[row][1]
+                self._add(row, self._remove(row)[0], self.BUMP, key)
+            return True
+    
+    def discard(self, row=None, key=None, before=None):
+        """
+        Drop the queued images of a row, or of every row in a bucket
+        before(): runs under the mutex first, so no get() falls in between
+        Returns: {row: indices}
+        """
+        with self.mutex:
+            if before:
+                before()
+            if key is not None:
+                rows = [r for level in self.levels for r in level.get(key, ())]
+            else:
+                rows = [row] if row in self.where else []
+            dropped = {r: list(self._remove(r)[0][1]) for r in rows}
+            count = sum(map(len, dropped.values()))
+            self.size -= count
+            self.unfinished_tasks -= count
+            if not self.unfinished_tasks:
+                self.all_tasks_done.notify_all()
+            return dropped
+
+
+def recipe_media_inputs(files, media_ids, stil_file=None, stil_media_id=None):
+    """
+    [(file_path, category)] + {file_path: media_id} → recipeMediaInputs
+    Style is appended last when it has been uploaded
+    """
+    refs = []
+    for file_path, category in files:
+        refs.append({
+            'caption': get_file_base_name(os.path.basename(file_path)),
+            'mediaInput': {
+                'mediaCategory': category,
+                'mediaGenerationId': media_ids[file_path]
+            }
+        })
+    
+    if stil_media_id:
+        refs.append({
+            'caption': get_file_base_name(os.path.basename(stil_file)) if stil_file else '',
+            'mediaInput': {
+                'mediaCategory': 'MEDIA_CATEGORY_STYLE',
+                'mediaGenerationId': stil_media_id
+            }
+        })
+    return refs
+
+def generation_request(prompt, refs, settings):
+    """Returns: (url, payload) for one image with a fresh seed"""
+    sess_id = f';{int(datetime.now().timestamp() * 1000)}'
+    seed = random.randint(1, 2147483647)
+    
+    if refs:
+        settings = settings.copy()
+        settings['imageModel'] = 'GEM_PIX' if len(refs) == 1 else 'R2I'
+        
+        return API_RUN_RECIPE, {
+            'clientContext': {'workflowId': '', 'tool': 'BACKBONE', 'sessionId': sess_id},
+            'imageModelSettings': settings,
+            'userInstruction': prompt,
+            'recipeMediaInputs': refs,
+            'seed': seed
+        }
+    
+    return API_GENERATE_IMAGE, {
+        'clientContext': {'workflowId': '', 'tool': 'BACKBONE', 'sessionId': sess_id},
+        'imageModelSettings': settings,
+        'prompt': prompt,
+        'mediaCategory': 'MEDIA_CATEGORY_BOARD',
+        'seed': seed
+    }
+
+def encoded_image(data):
+    """Generation response JSON → base64 image ('' if none)"""
+    panels = data.get('imagePanels', [])
+    if panels and panels[0].get('generatedImages'):
+        return panels[0]['generatedImages'][0].get('encodedImage', '')
+    return ''
+
+def output_image_path(output_dir, row_idx, prompt, i):
+    safe_prompt = re.sub(r'[^\w\s-]', '', prompt).strip().replace(' ', '_')[:40]
+    filename = f"{row_idx+1}_{safe_prompt}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{i+1}.jpg"
+    return os.path.join(output_dir, filename)
+
+
+class GenerationEngine:
+    """
+    FOLDER-BASED GENERATION ENGINE (worker pool)
+    - Scans folders for matches per prompt
+    - Keeps up to `concurrency` generation requests in flight
+    - Guarantees no character mixing
+
+    Qt-free: results are reported through the on_* callbacks, which
+    GenerationWorker wires to its signals. Callbacks are invoked from
+    pool threads.
+    """
+    backend = 'thread'
+    
+    def __init__(self, task_queue, settings, output_dir, num_images,
+                 karakter_files, mekan_files, stil_file, stil_media_id,
+                 cookie_str, token, concurrency=DEFAULT_CONCURRENCY, limiter=None,
+                 media_cache=None, plans=None, client=None, exit_when_idle=False, journal=None,
+                 stil_files=None, accounts=None, locality=False):
+        self.task_queue = task_queue
+        self.settings = settings
+        self.output_dir = output_dir
+        self.num_images = num_images
+        self.stil_file = stil_file
+        self.stil_media_id = stil_media_id
+        self.concurrency = max(1, min(int(concurrency), MAX_CONCURRENCY))
+        
+        # Pooled HTTP client shared by uploads and generation
+        self.client = client or WhiskClient(cookie_str, token, self.concurrency + UPLOAD_CONCURRENCY)
+        self.running = True
+        self.paused = False
+        self.auth_paused = False               # paused by a failed token refresh
+        self.exit_when_idle = exit_when_idle   # finish once the queue is drained (headless)
+        self.journal = journal                 # JobJournal for crash-safe resume
+        
+        # One slot per in-flight generation request
+        self.slots = threading.Semaphore(self.concurrency)
+        
+        # Request pacing shared by all slots
+        self.limiter = limiter or AdaptiveRateLimiter()
+        
+        # Accounts requests are spread over (default: just the client's)
+        self.accounts = accounts or AccountPool([Account(cookie_str, client=self.client, limiter=self.limiter)])
+        self.auth_retries = {}   # (row_idx, image index) → HTTP 401 re-queues
+        
+        # Output I/O thread (created per run)
+        self.writer = None
+        
+        # Persistent cache for uploaded media IDs
+        self.media_cache = media_cache or MediaCache()
+        
+        # Name indexes (built once per folder scan)
+        self.karakter_files = as_matcher(karakter_files, KARAKTER_FOLDER)
+        self.mekan_files = as_matcher(mekan_files, MEKAN_FOLDER)
+        self.stil_files = stil_files   # styles that prompts can name
+        
+        # Per-image progress, seeded with images a resumed batch already has
+        self.progress = RowProgress(num_images)
+        if journal:
+            for row, index, _ in journal.done_images():
+                self.progress.set(row, index, RowProgress.DONE)
+        
+        # Reference plans by prompt text (see build_plan)
+        self.plans = dict(plans or {})
+        self.plan_lock = threading.Lock()   # plans/indexes are swapped by the folder watcher
+        
+        # Recipe media inputs per (refs key, account key), resolved by the
+        # first image that needs them; with a TaskScheduler rows interleave
+        self.row_refs = {}
+        self.refs_lock = threading.Lock()
+        
+        # Locality: prompts sharing a reference set run as one group, its
+        # uploads happen when the group starts and are released after it
+        self.locality = locality and isinstance(task_queue, TaskScheduler)
+        if isinstance(task_queue, TaskScheduler):
+            task_queue.on_get = lambda row, index: self.progress.set(row, index, RowProgress.PENDING)
+            if self.locality:
+                task_queue.regroup(self.refs_group)
+        
+        # Callbacks (row_idx, progress_text) / (row_idx, col_idx, path|error) / ()
+        self.on_task_started = lambda row_idx, text: None
+        self.on_task_success = lambda row_idx, col_idx, path: None
+        self.on_task_failed = lambda row_idx, col_idx, error: None
+        self.on_all_done = lambda: None
+        self.on_auth_paused = lambda message: None
+        self.on_auth_resumed = lambda: None
+    
+    def upload_if_needed(self, file_path, category, account):
+        """Upload file for an account if not cached, return media_id"""
+        mid, cap, err = upload_cached(file_path, category, account.client, self.media_cache)
+        
+        if mid:
+            print(f"[UPLOAD] {os.path.basename(file_path)} → {mid[:12]}...")
+            return mid
+        else:
+            raise Exception(f"Upload failed: {err}")
+    
+    def wait_if_paused(self):
+        while self.paused and self.running:
+            time.sleep(0.5)
+    
+    def next_account(self):
+        """
+        Account for the next request, its token refreshed if due
+        Waits while every account is resting and pauses while no token can
+        be refreshed. Returns None if every quota is used up.
+        """
+        while self.running:
+            account = self.accounts.acquire()
+            if account is None:
+                if self.accounts.cooling() and sleep_while(1, lambda: self.running):
+                    continue
+                if self.accounts.failed():
+                    if not self.accounts.refresh_due():
+                        self.pause_for_auth()
+                        self.wait_if_paused()
+                    continue
+                return None
+            if not account.needs_refresh() or account.refresh():
+                return account
+            self.accounts.release(account)
+        return None
+    
+    def style_media_id(self, plan, account):
+        """Default style media ID for an account (None if the prompt names its own)"""
+        if plan['stil_ref'] or not self.stil_media_id:
+            return None
+        if account.client is self.client:
+            return self.stil_media_id
+        return self.upload_if_needed(self.stil_file, 'MEDIA_CATEGORY_STYLE', account)
+    
+    def account_files(self, files, account):
+        """Preflight uploads for one account (others need the default style too)"""
+        if self.stil_media_id and account.client is not self.client:
+            return files + [(self.stil_file, 'MEDIA_CATEGORY_STYLE')]
+        return files
+    
+    def pause_for_auth(self):
+        """No account has a token: hold the queue until refresh_tokens recovers one"""
+        if self.auth_paused:
+            return
+        self.auth_paused = True
+        self.paused = True
+        print(f"[AUTH] ⏸ Token refresh failed, paused (retrying every {AUTH_RETRY_INTERVAL}s)")
+        self.on_auth_paused('Token refresh failed')
+    
+    def refresh_tokens(self, stopped):
+        """
+        Background thread: refresh tokens shortly before they expire and
+        resume an auth pause once an account has a token again
+        """
+        while not stopped.wait(TOKEN_CHECK_INTERVAL) and self.running:
+            self.accounts.refresh_due()
+            if self.auth_paused and self.accounts.usable():
+                print("[AUTH] ▶ Token refreshed, resuming")
+                self.resume()
+                self.on_auth_resumed()
+    
+    def start_refresher(self):
+        """Returns: Event that stops the token refresh thread"""
+        stopped = threading.Event()
+        threading.Thread(target=self.refresh_tokens, args=(stopped,), name='whisk-auth', daemon=True).start()
+        return stopped
+    
+    def requeue_unauthorized(self, row_idx, prompt, i):
+        """
+        HTTP 401: queue the image again; its account refreshes the token on
+        the next acquire. Returns: False once AUTH_RETRIES are used up.
+        """
+        with self.plan_lock:
+            n = self.auth_retries[(row_idx, i)] = self.auth_retries.get((row_idx, i), 0) + 1
+        if n > AUTH_RETRIES:
+            return False
+        print(f"[AUTH] #{row_idx+1}.{i+1}: HTTP 401, queued again after token refresh")
+        self.requeue((row_idx, prompt, [i]))
+        return True
+    
+    def requeue(self, item):
+        """Queue again, ahead of new work when the queue is a TaskScheduler"""
+        if isinstance(self.task_queue, TaskScheduler):
+            self.task_queue.put(item, priority=TaskScheduler.RETRY)
+        else:
+            self.task_queue.put(item)
+    
+    def fail_row(self, row_idx):
+        """
+        References failed: the row's dispatched images fail and its queued
+        ones are dropped, in one step against get() (a TaskScheduler marks
+        images PENDING as it hands them out), so none is prepared again
+        """
+        if not isinstance(self.task_queue, TaskScheduler):
+            self.progress.fail_pending(row_idx)
+            return
+        dropped = self.task_queue.discard(row=row_idx, before=lambda: self.progress.fail_pending(row_idx))
+        self.progress.mark(row_idx, dropped.get(row_idx, ()), RowProgress.FAILED)   # reported with the row
+    
+    def refs_failed(self, entry, key):
+        """
+        After a failed preparation (its row is reported): without locality a
+        retry prepares again. Locality keeps the failed result until the
+        group drains (release_refs), so in-flight images of its other rows
+        fail with it instead of uploading again, and drops its queued images.
+        """
+        if not self.locality:
+            with self.refs_lock:
+                self.row_refs.pop(entry, None)
+            return
+        for row, indices in self.task_queue.discard(key=key).items():
+            for i in indices:
+                self.report_failure(row, i + 1, 'References failed')
+    
+    def refs_group(self, prompt):
+        return reference_set(self.plan_for(prompt))
+    
+    def refs_key(self, item):
+        """Prepared references are shared per row, or per scheduler bucket with locality"""
+        return item[3] if self.locality else (item[0], item[1])
+    
+    def release_refs(self, key):
+        """Locality: a group with nothing queued or in flight forgets its prepared references"""
+        if not self.locality or not self.task_queue.release(key):
+            return
+        with self.refs_lock:
+            for k in [k for k in self.row_refs if k[0] == key]:
+                del self.row_refs[k]
+        self.evict_uploads(key)
+        names = ', '.join(os.path.basename(file_path) for file_path, _ in key) or 'no references'
+        print(f"[GROUP] Done: {names}")
+    
+    def evict_uploads(self, files):
+        """Drop in-memory upload state of finished files (media IDs stay in the MediaCache)"""
+    
+    def warm_queue(self):
+        """Queued rows whose references are already uploaded go first (hashes files: call on the engine thread)"""
+        if isinstance(self.task_queue, TaskScheduler) and self.task_queue.warm is None:
+            self.task_queue.rewarm(self.refs_cached)
+    
+    def refs_cached(self, prompt):
+        """True if every reference of a prompt is already uploaded for every pooled account (scheduler: WARM)"""
+        files = plan_files(self.plan_for(prompt))
+        return all(self.media_cache.has(file_path, category, account.key)
+                   for account in self.accounts for file_path, category in files)
+    
+    def refs_for(self, row_idx, prompt, i, account, key):
+        """
+        Recipe media inputs for an account: the first image with this refs
+        key prepares them, concurrent ones wait for its result
+        Returns: refs, or None if preparation failed (reported)
+        """
+        entry = (key, account.key)
+        with self.refs_lock:
+            future = self.row_refs.get(entry)
+            owner = future is None
+            if owner:
+                if self.progress.state(row_idx, i) != RowProgress.PENDING:
+                    return None   # its row already failed and was reported
+                future = self.row_refs[entry] = Future()
+        if not owner:
+            return self.waited_refs(future.result(), row_idx, i)
+        
+        refs = None
+        try:
+            refs = self.prepare_refs(row_idx, prompt, account)
+        finally:
+            if refs is None:
+                self.refs_failed(entry, key)
+            future.set_result(refs)
+        return refs
+    
+    def waited_refs(self, refs, row_idx, i):
+        """Another image's preparation failed: report this image unless its row already was"""
+        if refs is None and self.progress.state(row_idx, i) == RowProgress.PENDING:
+            self.report_failure(row_idx, i + 1, 'References failed')
+        return refs
+    
+    def idle(self):
+        """Headless: nothing queued and nothing in flight (401s may still re-queue)"""
+        return not self.accounts.busy() and self.task_queue.empty()
+    
+    def stats(self):
+        """
+        Live counters for a dashboard (cheap, any thread)
+        Returns: {done, failed, pending (dequeued, unfinished images),
+                  in_flight (generation requests), queued (images; rows for a plain queue)}
+        """
+        done, failed, pending = self.progress.total()
+        return {'done': done, 'failed': failed, 'pending': pending,
+                'in_flight': self.accounts.in_flight(), 'queued': self.task_queue.qsize()}
+    
+    def acquire_slot(self):
+        """Block until a generation slot is free. Returns False if stopped."""
+        while self.running:
+            if self.slots.acquire(timeout=0.5):
+                return True
+        return False
+    
+    def plan_for(self, prompt):
+        """Cached plan for a prompt (planned lazily for edited/retried prompts)"""
+        with self.plan_lock:
+            plan = self.plans.get(prompt)
+            if plan is None:
+                plan = self.plans[prompt] = plan_prompt(prompt, self.karakter_files, self.mekan_files,
+                                                        self.stil_file, self.stil_files)
+            return plan
+    
+    def queued_reference_files(self):
+        """Plan everything already queued. Returns: [(file_path, category)] it needs"""
+        with self.task_queue.mutex:
+            prompts = [item[1] for item in self.task_queue.queue]
+        
+        with self.plan_lock:
+            missing = [p for p in dict.fromkeys(prompts) if p not in self.plans]
+            if missing:
+                self.plans.update(build_plan(missing, self.karakter_files, self.mekan_files,
+                                             self.stil_file, self.stil_files))
+            plans = dict(self.plans)
+        
+        return list(dict.fromkeys(fc for p in prompts for fc in plan_files(plans[p])))
+    
+    def update_references(self, karakter_files=None, mekan_files=None, stil=None, changed=(),
+                          stil_files=None):
+        """
+        Hot-swap reference data while running (folder watcher)
+        karakter_files/mekan_files/stil_files: new name indexes
+        stil: (stil_file, stil_media_id) of the default style
+        changed: paths removed or modified on disk
+        Cached plans are dropped, so prompts not yet dispatched are
+        re-resolved against the new indexes; rows already generating keep
+        the references they were started with
+        """
+        with self.plan_lock:
+            if karakter_files is not None:
+                self.karakter_files = as_matcher(karakter_files, KARAKTER_FOLDER)
+            if mekan_files is not None:
+                self.mekan_files = as_matcher(mekan_files, MEKAN_FOLDER)
+            if stil is not None:
+                self.stil_file, self.stil_media_id = stil
+            if stil_files is not None:
+                self.stil_files = stil_files
+            self.plans = {}
+        if self.locality:
+            self.task_queue.regroup(self.refs_group)   # in-flight images keep their bucket key
+        self.media_cache.forget(changed)
+        print(f"[WATCH] References updated, {len(changed)} changed files")
+    
+    def preflight(self):
+        """
+        Upload the union of all queued prompts' references in parallel,
+        before the first generation request (locality: per group instead)
+        """
+        if self.locality:
+            self.describe_groups()
+            return
+        files = self.queued_reference_files()
+        for account in self.accounts:
+            if not self.running:
+                break
+            if account.needs_refresh() and not account.refresh():
+                continue
+            upload_references(self.account_files(files, account), account.client, self.media_cache,
+                              lambda: self.running)
+    
+    def describe_groups(self):
+        with self.task_queue.mutex:
+            groups = sum(len(level) for level in self.task_queue.levels)
+            rows = len(self.task_queue.where)
+        print(f"[GROUP] {rows} prompts in {groups} reference groups, uploading per group")
+    
+    def prepare_refs(self, row_idx, prompt, account):
+        """
+        Resolve the recipe media inputs for a prompt from its plan, for one
+        account (uploads are cache hits after preflight)
+        Returns: list of recipe media inputs, or None on failure
+        """
+        print(f"\n{'='*60}")
+        print(f"[PROMPT {row_idx+1}] {prompt[:50]}...")
+        
+        plan = self.plan_for(prompt)
+        
+        if not plan['karakter']:
+            print("[INFO] No character matches")
+        if not plan['mekan']:
+            print("[INFO] No scene matches")
+        
+        # === PREPARE REFERENCES ===
+        try:
+            # Characters, scenes
+            files = plan_files(plan)
+            media_ids = {file_path: self.upload_if_needed(file_path, category, account) for file_path, category in files}
+            
+            # Style (default unless the prompt names one)
+            stil_media_id = self.style_media_id(plan, account)
+        except Exception as e:
+            print(f"[ERROR] Reference preparation: {str(e)}")
+            self.report_failure(row_idx, 0, str(e)[:30])
+            return None
+        
+        refs = recipe_media_inputs(files, media_ids, self.stil_file, stil_media_id)
+        if stil_media_id or plan['stil_ref']:
+            print(f"[INFO] Style: {os.path.basename(plan['stil'])}")
+        
+        print(f"[REFS] Total: {len(refs)} references prepared")
+        print(f"{'='*60}\n")
+        return refs
+    
+    def generate_image(self, row_idx, prompt, i, account, key):
+        """Run one generation request (pool thread). Releases its slot, account and refs key."""
+        col_idx = i + 1
+        status = None
+        try:
+            self.wait_if_paused()
+            if not self.running:
+                return
+            
+            # Uploads run here, so a cold row doesn't hold up dispatching the others
+            refs = self.refs_for(row_idx, prompt, i, account, key)
+            if refs is None or not self.running:
+                return
+            
+            self.on_task_started(row_idx, f'{i+1}/{self.num_images}')
+            
+            try:
+                url, payload = generation_request(prompt, refs, self.settings)
+                seed = payload['seed']
+                self.journal_record(row_idx, col_idx, 'inflight', seed=seed)
+                
+                with METRICS.span('generate', row=row_idx, image=col_idx, account=account.label) as span:
+                    r = post_with_retry(url, account.limiter, lambda: self.running,
+                                        client=account.client, json=payload, timeout=60)
+                    span['status'] = r.status_code if r is not None else None
+                
+                if r is None or not self.running:
+                    return
+                
+                status = r.status_code
+                if r.status_code == 200:
+                    b64 = encoded_image(r.json())
+                    del r
+                    if b64:
+                        filepath = output_image_path(self.output_dir, row_idx, prompt, i)
+                        self.save_image(b64, filepath, row_idx, col_idx, seed)
+                    else:
+                        self.report_failure(row_idx, col_idx, 'No image data')
+                elif r.status_code == 401 and self.requeue_unauthorized(row_idx, prompt, i):
+                    pass
+                else:
+                    self.report_failure(row_idx, col_idx, f'HTTP {r.status_code}')
+                    
+            except Exception as e:
+                self.report_failure(row_idx, col_idx, str(e)[:30])
+        finally:
+            self.accounts.release(account, status)
+            self.slots.release()
+            self.release_refs(key)
+    
+    def journal_record(self, row_idx, col_idx, state, **info):
+        if self.journal and col_idx:
+            self.journal.record(row_idx, col_idx - 1, state, **info)
+    
+    def report_success(self, row_idx, col_idx, filepath, seed=None):
+        self.journal_record(row_idx, col_idx, 'done', path=filepath, seed=seed)
+        self.progress.set(row_idx, col_idx - 1, RowProgress.DONE)
+        self.on_task_success(row_idx, col_idx, filepath)
+    
+    def report_failure(self, row_idx, col_idx, error):
+        """col_idx 0: reference preparation failed for the whole row"""
+        self.journal_record(row_idx, col_idx, 'failed', error=error)
+        if col_idx:
+            self.progress.set(row_idx, col_idx - 1, RowProgress.FAILED)
+        else:
+            self.fail_row(row_idx)
+        self.on_task_failed(row_idx, col_idx, error)
+    
+    def save_image(self, b64, filepath, row_idx, col_idx, seed=None):
+        """Write a generated image (on the I/O thread if enabled), then report it"""
+        def done(error):
+            if error:
+                print(f"[ERROR] Write {os.path.basename(filepath)}: {error}")
+                self.report_failure(row_idx, col_idx, str(error)[:30])
+            else:
+                self.report_success(row_idx, col_idx, filepath, seed)
+        
+        if self.writer:
+            self.writer.submit(b64, filepath, done)
+            return
+        
+        try:
+            write_b64_atomic(b64, filepath)
+        except Exception as e:
+            done(e)
+        else:
+            done(None)
+    
+    def run(self):
+        """Dispatch queued prompts to the pool until stopped"""
+        self.writer = ImageWriter() if BACKGROUND_WRITES else None
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='whisk-gen')
+        stop_refresher = self.start_refresher()
+        try:
+            prune_ref_cache()
+            self.warm_queue()
+            self.preflight()
+            
+            while self.running:
+                self.wait_if_paused()
+                
+                try:
+                    item = self.task_queue.get(timeout=1)
+                    row_idx, prompt = item if len(item) == 2 else (item[0], item[1])
+                    indices = range(self.num_images) if len(item) == 2 else item[2]
+                except queue.Empty:
+                    if self.exit_when_idle and self.idle():
+                        break
+                    continue
+                
+                if self.journal:
+                    self.journal.set_prompt(row_idx, prompt)
+                if not isinstance(self.task_queue, TaskScheduler):   # it marks them in get()
+                    self.progress.mark(row_idx, indices, RowProgress.PENDING)
+                
+                # === GENERATE IMAGES ===
+                for i in indices:
+                    self.wait_if_paused()
+                    if not self.acquire_slot():
+                        break
+                    account = self.next_account()
+                    key = self.refs_key(item)
+                    if account is None:
+                        self.slots.release()
+                        self.release_refs(key)
+                        if self.running:
+                            self.report_failure(row_idx, i + 1, 'No usable account')
+                        continue
+                    executor.submit(self.generate_image, row_idx, prompt, i, account, key)
+                
+                self.task_queue.task_done()
+        finally:
+            stop_refresher.set()
+            executor.shutdown(wait=True)
+            self.row_refs = {}
+            if self.writer:
+                self.writer.close()
+            self.progress.reset_pending()
+            self.accounts.save()
+            self.media_cache.flush()
+            METRICS.flush(backend=self.backend, concurrency=self.concurrency)
+        
+        self.on_all_done()
+    
+    def stop(self):
+        self.running = False
+    
+    def pause(self):
+        self.paused = True
+    
+    def resume(self):
+        self.paused = False
+        self.auth_paused = False
+
+
+# ==================== ASYNC ENGINE ====================
+
+async def sleep_while_async(seconds, should_continue=lambda: True):
+    end = time.monotonic() + seconds
+    while should_continue():
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            return True
+        await asyncio.sleep(min(remaining, 0.5))
+    return False
+
+async def post_with_retry_async(session, url, limiter=None, should_continue=lambda: True, client=None, **kwargs):
+    """
+    post_with_retry for aiohttp
+    client: WhiskClient whose auth headers are read on every attempt
+    Returns: (status, JSON body of a 200 or None), or None if cancelled
+    """
+    if 'json' in kwargs:
+        # Serialized once: the size is counted and retries resend the same bytes
+        kwargs['data'] = json.dumps(kwargs.pop('json')).encode()
+        kwargs.setdefault('headers', {'Content-Type': 'application/json'})
+    
+    attempt = 0
+    while True:
+        if limiter:
+            with METRICS.span('rate_wait'):
+                if not await limiter.acquire_async(should_continue):
+                    return None
+        
+        retry_after = None
+        try:
+            if client:
+                kwargs['headers'] = client.headers   # picks up a refreshed token
+            async with session.post(url, **kwargs) as r:
+                status = r.status
+                body = await r.read()
+                METRICS.count('responses', status=status, call=api_call(url))
+                METRICS.count('bytes_sent', len(kwargs.get('data') or b''), call=api_call(url))
+                METRICS.count('bytes_received', len(body), call=api_call(url))
+                if status not in TRANSIENT_STATUS:
+                    data = json.loads(body) if status == 200 else None
+                    if limiter and status == 200:
+                        limiter.on_success()
+                    return (status, data)
+                retry_after = parse_retry_after(r.headers.get('Retry-After'))
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt >= MAX_RETRIES:
+                raise
+            reason = type(e).__name__
+            METRICS.count('responses', status=reason, call=api_call(url))
+        else:
+            if limiter and status in (429, 503):
+                limiter.on_throttle(retry_after)
+            if attempt >= MAX_RETRIES:
+                return (status, None)
+            reason = f'HTTP {status}'
+        
+        delay = retry_after if retry_after is not None else backoff_delay(attempt)
+        attempt += 1
+        METRICS.count('retries', reason=reason)
+        print(f"[RETRY] {reason} → attempt {attempt}/{MAX_RETRIES} in {delay:.1f}s")
+        if not await sleep_while_async(delay, should_continue):
+            return None
+
+
+class AsyncGenerationEngine(GenerationEngine):
+    """
+    asyncio backend (needs aiohttp)
+    - One thread, one event loop: up to `concurrency` generations and
+      UPLOAD_CONCURRENCY uploads in flight without an OS thread each
+    - Same callbacks, plans, media cache, limiter and writer as GenerationEngine
+    """
+    backend = 'async'
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = None
+        self.uploads = {}   # (account key, file_path, category) → in-flight upload task
+    
+    async def wait_if_paused_async(self):
+        while self.paused and self.running:
+            await asyncio.sleep(0.5)
+    
+    async def _upload(self, file_path, category, account):
+        hit = await asyncio.to_thread(self.media_cache.get, file_path, category, account.key)
+        if hit:
+            return hit[0]
+        if not os.path.exists(file_path):
+            raise Exception('Upload failed: File not found')
+        
+        async with self.upload_slots:
+            digest = await asyncio.to_thread(self.media_cache.file_hash, file_path)
+            data_uri = await asyncio.to_thread(image_data_uri, file_path, digest)
+            sess_id = f';{int(datetime.now().timestamp() * 1000)}'
+            with METRICS.span('upload', file=os.path.basename(file_path), bytes=len(data_uri)) as span:
+                result = await post_with_retry_async(
+                    self.session, API_UPLOAD_IMAGE, None, lambda: self.running,
+                    client=account.client, json=upload_payload(category, data_uri, sess_id)
+                )
+                span['status'] = result[0] if result else None
+        
+        if result is None:
+            raise Exception('Stopped')
+        status, data = result
+        if status != 200:
+            raise Exception(f'Upload failed: HTTP {status}')
+        mid = upload_media_id(data or {})
+        if not mid:
+            raise Exception('Upload failed: No media ID')
+        
+        await asyncio.to_thread(self.media_cache.put, file_path, category, account.key, mid)
+        print(f"[UPLOAD] {os.path.basename(file_path)} → {mid[:12]}...")
+        return mid
+    
+    def update_references(self, karakter_files=None, mekan_files=None, stil=None, changed=(),
+                          stil_files=None):
+        super().update_references(karakter_files, mekan_files, stil, changed, stil_files)
+        # Shared upload tasks are keyed by path: drop those whose file changed
+        changed = set(changed)
+        for key in [key for key in list(self.uploads) if key[1] in changed]:
+            self.uploads.pop(key, None)
+    
+    def upload_async(self, file_path, category, account):
+        """Cached upload; concurrent requests for one file share a single upload"""
+        key = (account.key, file_path, category)
+        task = self.uploads.get(key)
+        if task is None or (task.done() and (task.cancelled() or task.exception())):
+            task = self.uploads[key] = asyncio.ensure_future(self._upload(file_path, category, account))
+        return task
+    
+    async def preflight_async(self):
+        if self.locality:
+            self.describe_groups()
+            return
+        files = self.queued_reference_files()
+        if not files:
+            return
+        uploads = []
+        for account in self.accounts:
+            if account.needs_refresh() and not await asyncio.to_thread(account.refresh):
+                continue
+            uploads += [(fp, cat, account) for fp, cat in self.account_files(files, account)]
+        files = uploads
+        results = await asyncio.gather(*(self.upload_async(*upload) for upload in uploads), return_exceptions=True)
+        for (file_path, _, _), result in zip(files, results):
+            if isinstance(result, Exception):
+                print(f"[UPLOAD] ❌ {os.path.basename(file_path)}: {result}")
+        ok = sum(1 for result in results if not isinstance(result, Exception))
+        print(f"[UPLOAD] {ok}/{len(files)} references ready")
+    
+    async def prepare_refs_async(self, row_idx, prompt, account):
+        """prepare_refs without blocking the loop. Returns refs or None."""
+        plan = self.plan_for(prompt)
+        files = plan_files(plan)
+        stil_media_id = None if plan['stil_ref'] else self.stil_media_id
+        try:
+            mids = await asyncio.gather(*(self.upload_async(fp, cat, account) for fp, cat in files))
+            if stil_media_id and account.client is not self.client:
+                stil_media_id = await self.upload_async(self.stil_file, 'MEDIA_CATEGORY_STYLE', account)
+        except Exception as e:
+            print(f"[ERROR] Reference preparation: {str(e)}")
+            self.report_failure(row_idx, 0, str(e)[:30])
+            return None
+        
+        refs = recipe_media_inputs(files, {fp: mid for (fp, _), mid in zip(files, mids)},
+                                   self.stil_file, stil_media_id)
+        print(f"[PROMPT {row_idx+1}] {prompt[:50]}... → {len(refs)} references")
+        return refs
+    
+    async def refs_async(self, row_idx, prompt, i, account, key):
+        """refs_for on the loop: one preparation task per (refs key, account)"""
+        entry = (key, account.key)
+        task = self.row_refs.get(entry)
+        owner = task is None
+        if owner:
+            if self.progress.state(row_idx, i) != RowProgress.PENDING:
+                return None   # its row already failed and was reported
+            task = self.row_refs[entry] = asyncio.ensure_future(self.prepare_refs_async(row_idx, prompt, account))
+        refs = await task
+        if not owner:
+            return self.waited_refs(refs, row_idx, i)
+        if refs is None:
+            self.refs_failed(entry, key)
+        return refs
+    
+    def evict_uploads(self, files):
+        files = set(files)
+        for upload in [upload for upload in self.uploads if upload[1:] in files]:
+            del self.uploads[upload]
+    
+    async def generate_image_async(self, row_idx, prompt, i, account, key):
+        """One generation request. Releases its slot, account and refs key."""
+        col_idx = i + 1
+        status = None
+        try:
+            await self.wait_if_paused_async()
+            if not self.running:
+                return
+            
+            refs = await self.refs_async(row_idx, prompt, i, account, key)
+            if refs is None or not self.running:
+                return
+            
+            self.on_task_started(row_idx, f'{i+1}/{self.num_images}')
+            
+            try:
+                url, payload = generation_request(prompt, refs, self.settings)
+                seed = payload['seed']
+                self.journal_record(row_idx, col_idx, 'inflight', seed=seed)
+                with METRICS.span('generate', row=row_idx, image=col_idx, account=account.label) as span:
+                    result = await post_with_retry_async(self.session, url, account.limiter, lambda: self.running,
+                                                         client=account.client, json=payload)
+                    span['status'] = result[0] if result else None
+                if result is None or not self.running:
+                    return
+                
+                status, data = result
+                if status == 200:
+                    b64 = encoded_image(data or {})
+                    del data
+                    if b64:
+                        filepath = output_image_path(self.output_dir, row_idx, prompt, i)
+                        self.save_image(b64, filepath, row_idx, col_idx, seed)
+                    else:
+                        self.report_failure(row_idx, col_idx, 'No image data')
+                elif status == 401 and self.requeue_unauthorized(row_idx, prompt, i):
+                    pass
+                else:
+                    self.report_failure(row_idx, col_idx, f'HTTP {status}')
+                    
+            except Exception as e:
+                self.report_failure(row_idx, col_idx, (str(e) or type(e).__name__)[:30])
+        finally:
+            self.accounts.release(account, status)
+            self.slots_async.release()
+            self.release_refs(key)
+    
+    async def run_async(self):
+        self.writer = ImageWriter() if BACKGROUND_WRITES else None
+        self.slots_async = asyncio.Semaphore(self.concurrency)
+        self.upload_slots = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+        self.uploads = {}
+        tasks = set()
+        
+        connector = aiohttp.TCPConnector(limit_per_host=self.client.pool_size)
+        timeout = aiohttp.ClientTimeout(total=60)
+        stop_refresher = self.start_refresher()
+        try:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                             cookie_jar=aiohttp.DummyCookieJar()) as session:
+                self.session = session
+                await asyncio.to_thread(prune_ref_cache)
+                await asyncio.to_thread(self.warm_queue)
+                await self.preflight_async()
+                
+                while self.running:
+                    await self.wait_if_paused_async()
+                    
+                    try:
+                        item = self.task_queue.get_nowait()
+                    except queue.Empty:
+                        if self.exit_when_idle and self.idle():
+                            break
+                        await asyncio.sleep(0.2)
+                        continue
+                    row_idx, prompt = item[0], item[1]
+                    indices = range(self.num_images) if len(item) == 2 else item[2]
+                    if self.journal:
+                        self.journal.set_prompt(row_idx, prompt)
+                    if not isinstance(self.task_queue, TaskScheduler):   # it marks them in get()
+                        self.progress.mark(row_idx, indices, RowProgress.PENDING)
+                    
+                    for i in indices:
+                        await self.wait_if_paused_async()
+                        if not self.running:
+                            break
+                        await self.slots_async.acquire()
+                        account = await asyncio.to_thread(self.next_account)
+                        key = self.refs_key(item)
+                        if account is None:
+                            self.slots_async.release()
+                            self.release_refs(key)
+                            if self.running:
+                                self.report_failure(row_idx, i + 1, 'No usable account')
+                            continue
+                        task = asyncio.create_task(self.generate_image_async(row_idx, prompt, i, account, key))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                    
+                    self.task_queue.task_done()
+                
+                if tasks:
+                    await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            stop_refresher.set()
+            self.session = None
+            self.row_refs = {}
+            if self.writer:
+                self.writer.close()
+            self.progress.reset_pending()
+            self.accounts.save()
+            self.media_cache.flush()
+            METRICS.flush(backend=self.backend, concurrency=self.concurrency)
+        
+        self.on_all_done()
+    
+    def run(self):
+        """Run the event loop on the calling thread until stopped"""
+        asyncio.run(self.run_async())
+
+
+ENGINE_BACKENDS = {
+    'thread': GenerationEngine,
+    'async': AsyncGenerationEngine
+}
+
+def create_engine(backend, *args, **kwargs):
+    """Engine for a backend name ('thread' or 'async'); falls back to threads without aiohttp"""
+    if backend == 'async' and aiohttp is None:
+        print("[ENGINE] aiohttp not installed, using thread backend")
+        backend = 'thread'
+    return ENGINE_BACKENDS.get(backend, GenerationEngine)(*args, **kwargs)
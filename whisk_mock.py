@@ -0,0 +1,253 @@
+"""
+Auto Whisk - Mock Whisk API
+===========================
+Local stand-in for the Labs/Whisk endpoints the app calls, so throughput
+can be measured offline (whisk_bench.py) and the GUI/CLI tried without
+an account.
+
+Usage:
+    python whisk_mock.py --port 8765 --latency 2 --error-rate 0.02 --throttle-rate 0.05
+    AUTOWHISK_API_BASE=http://127.0.0.1:8765 python whisk_cli.py prompts.txt --cookie mock
+
+Endpoints (same paths as the real service):
+    GET  /fx/api/auth/session              cookie → access token
+    GET  /oauth2/v3/tokeninfo              token expiry
+    POST /fx/api/trpc/backbone.captionImage
+    POST /fx/api/trpc/backbone.uploadImage
+    POST /v1/whisk:runImageRecipe
+    POST /v1/whisk:generateImage
+    GET  /_stats                           request counts and bytes (JSON)
+"""
+
+import sys
+import os
+import json
+import time
+import random
+import base64
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+ENDPOINTS = {
+    '/fx/api/auth/session': 'auth',
+    '/oauth2/v3/tokeninfo': 'tokeninfo',
+    '/fx/api/trpc/backbone.captionImage': 'caption',
+    '/fx/api/trpc/backbone.uploadImage': 'upload',
+    '/v1/whisk:runImageRecipe': 'recipe',
+    '/v1/whisk:generateImage': 'generate'
+}
+
+
+class MockWhisk:
+    """
+    Mock server state and behaviour
+    - latency / upload_latency: mean seconds per generation / upload
+      (±jitter as a fraction of the mean)
+    - error_rate: share of POSTs answered HTTP 500
+    - throttle_rate: share of POSTs answered HTTP 429 with Retry-After
+    - image_kb: size of every generated image
+    - token_ttl: seconds an issued access token is accepted (then 401)
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=1.0, upload_latency=0.3, jitter=0.25,
+                 error_rate=0.0, throttle_rate=0.0, retry_after=1.0, image_kb=1500, token_ttl=3600,
+                 seed=None):
+        self.latency = latency
+        self.upload_latency = upload_latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.token_ttl = token_ttl
+        self.rng = random.Random(seed)
+        self.tokens = {}   # access token → expiry (epoch seconds)
+        self.stats = {'requests': {}, 'status': {}, 'bytes_in': {}, 'bytes_out': {}}
+        self.lock = threading.Lock()
+
+        # One generated image, serialized once (the response is the same every time)
+        image = base64.b64encode(os.urandom(image_kb * 1024)).decode()
+        self.image_body = json.dumps({
+            'imagePanels': [{'generatedImages': [{'encodedImage': image}]}]
+        }).encode()
+
+        mock = self
+
+        class Handler(MockHandler):
+            server_mock = mock
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """Serve on a background thread. Returns: self"""
+        self.thread = threading.Thread(target=self.server.serve_forever, name='whisk-mock', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, endpoint, status, bytes_in, bytes_out):
+        with self.lock:
+            for key, value in (('requests', 1), ('bytes_in', bytes_in), ('bytes_out', bytes_out)):
+                self.stats[key][endpoint] = self.stats[key].get(endpoint, 0) + value
+            self.stats['status'][str(status)] = self.stats['status'].get(str(status), 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+    def delay(self, mean):
+        if mean > 0:
+            time.sleep(mean * self.rng.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def fault(self):
+        """Returns: 429, 500 or None for the next POST"""
+        roll = self.rng.random()
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 500
+        return None
+
+    def issue_token(self):
+        token = f'mock-{self.rng.getrandbits(64):016x}'
+        exp = int(time.time() + self.token_ttl)
+        with self.lock:
+            self.tokens[token] = exp
+        return token, exp
+
+    def authorized(self, header):
+        token = (header or '').replace('Bearer ', '', 1)
+        with self.lock:
+            exp = self.tokens.get(token)
+        return exp is not None and exp > time.time()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Request handler bound to a MockWhisk through server_mock"""
+    protocol_version = 'HTTP/1.1'   # keep-alive, like the real service
+    server_mock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, endpoint, status, body=b'', bytes_in=0, headers=None):
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server_mock.count(endpoint, status, bytes_in, len(body))
+
+    def do_GET(self):
+        mock = self.server_mock
+        url = urlparse(self.path)
+        endpoint = ENDPOINTS.get(url.path, url.path)
+
+        if url.path == '/_stats':
+            self.reply(endpoint, 200, mock.snapshot())
+        elif endpoint == 'auth':
+            if not self.headers.get('Cookie'):
+                self.reply(endpoint, 401, {})
+                return
+            token, exp = mock.issue_token()
+            self.reply(endpoint, 200, {'access_token': token, 'expires': exp})
+        elif endpoint == 'tokeninfo':
+            token = parse_qs(url.query).get('access_token', [''])[0]
+            with mock.lock:
+                exp = mock.tokens.get(token)
+            if exp:
+                self.reply(endpoint, 200, {'exp': str(exp)})
+            else:
+                self.reply(endpoint, 400, {'error': 'invalid_token'})
+        else:
+            self.reply(endpoint, 404, {})
+
+    def do_POST(self):
+        mock = self.server_mock
+        endpoint = ENDPOINTS.get(urlparse(self.path).path, self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        if endpoint not in ('caption', 'upload', 'recipe', 'generate'):
+            self.reply(endpoint, 404, {}, len(body))
+            return
+        if not mock.authorized(self.headers.get('Authorization')):
+            self.reply(endpoint, 401, {}, len(body))
+            return
+
+        status = mock.fault()
+        if status == 429:
+            self.reply(endpoint, 429, {}, len(body), {'Retry-After': str(mock.retry_after)})
+            return
+
+        if endpoint in ('recipe', 'generate'):
+            mock.delay(mock.latency)
+            if status:
+                self.reply(endpoint, status, {}, len(body))
+            else:
+                self.reply(endpoint, 200, mock.image_body, len(body))
+            return
+
+        mock.delay(mock.upload_latency)
+        if status:
+            self.reply(endpoint, status, {}, len(body))
+        elif endpoint == 'upload':
+            media_id = 'mock-media-' + hashlib.sha1(body).hexdigest()[:16]
+            self.reply(endpoint, 200, {'result': {'data': {'json': {'result': {'uploadMediaGenerationId': media_id}}}}}, len(body))
+        else:
+            self.reply(endpoint, 200, {'result': {'data': {'json': {'result': {'candidates': [{'output': 'a mock caption'}]}}}}}, len(body))
+
+
+def add_mock_args(parser):
+    """Mock behaviour options (shared with whisk_bench.py)"""
+    parser.add_argument('--latency', type=float, default=1.0, help='mean seconds per generation')
+    parser.add_argument('--upload-latency', type=float, default=0.3, help='mean seconds per upload/caption')
+    parser.add_argument('--jitter', type=float, default=0.25, help='latency spread (fraction of the mean)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of POSTs answered HTTP 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of POSTs answered HTTP 429')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After seconds sent with 429s')
+    parser.add_argument('--image-kb', type=int, default=1500, help='size of each generated image')
+    parser.add_argument('--token-ttl', type=int, default=3600, help='seconds an access token stays valid')
+    parser.add_argument('--seed', type=int, help='random seed for reproducible faults')
+
+def mock_kwargs(args):
+    return dict(latency=args.latency, upload_latency=args.upload_latency, jitter=args.jitter,
+                error_rate=args.error_rate, throttle_rate=args.throttle_rate, retry_after=args.retry_after,
+                image_kb=args.image_kb, token_ttl=args.token_ttl, seed=args.seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='whisk_mock', description='Local mock of the Whisk API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765, help='0 picks a free port')
+    add_mock_args(parser)
+    args = parser.parse_args(argv)
+
+    mock = MockWhisk(args.host, args.port, **mock_kwargs(args))
+    print(f'[MOCK] Listening on {mock.url}', flush=True)
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock.server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())